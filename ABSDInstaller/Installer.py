@@ -3,6 +3,8 @@ Experimental ArchBSD Installation UI.
 """
 
 from . import utils
+from . import mount
+from . import space
 from .MainWindow import MainWindow
 
 import os
@@ -33,6 +35,7 @@ class Installer(object):
 
         self.setup    = {}
         self.data     = {}
+        self.mounts   = None
 
         try:
             with open(CONFIG_FILE, 'r', encoding='utf-8') as cfgfile:
@@ -238,27 +241,19 @@ class Installer(object):
         #for path, disk in fstab:
         #    os.makedirs('%s/%s' % (root, path), mode=0o755, exist_ok=True)
 
-    @staticmethod
-    def __mount(mounts, what, where, fstype=None):
-        """Mount a filesystem if not already mounted,
-        after creating its path first."""
-        if where in mounts:
-            return
-        os.makedirs(where, mode=0o755, exist_ok=True)
-        if fstype is not None:
-            subprocess.check_call(['mount', '-t', fstype, what, where])
-        else:
-            subprocess.check_call(['mount', what, where])
-
-    @staticmethod
-    def __mount_paths(root, fstab):
+    def __mount_paths(self, root, fstab):
         """Mount (and if required create) all the future fstab entries."""
-        mounts = [ where for what, where in geom.util.genmounts() ]
-        Installer.__mount(mounts, 'procfs', '%s/proc' % root, fstype='procfs')
-        Installer.__mount(mounts, 'devfs',  '%s/dev'  % root, fstype='devfs')
-
+        if self.mounts is None:
+            self.mounts = geom.util.MountTable()
+        entries = [mount.Entry('procfs', '%s/proc' % root, 'procfs'),
+                   mount.Entry('devfs',  '%s/dev'  % root, 'devfs')]
         for path, disk in fstab:
-            Installer.__mount(mounts, disk, '%s/%s' % (root, path))
+            entries.append(mount.Entry(mount.device_path(disk),
+                                       '%s/%s' % (root, path)))
+        try:
+            mount.MountEngine(mounts=self.mounts).mount_all(entries)
+        except mount.MountError as err:
+            raise InstallerException(str(err))
 
     def pacstrap(self):
         # can raise some exceptions, but stores completed operations
@@ -289,18 +284,73 @@ class Installer(object):
                 raise InstallerException(L('Failed to sync database.'))
             done.append('sync')
 
+        packages = [ 'base' ] + self.setup['extra_packages']
+        cache    = '%s/var/cache/pacman/pkg' % root
         if 'download' not in done:
+            print(L('Checking free space...'))
+            needed = self.__download_needed(pacman, cache, packages)
             print(L('Downloading packages...'))
-            packages = [ '-Sw', 'base' ] + self.setup['extra_packages']
-            if subprocess.call(pacman + packages) != 0:
-                raise InstallerException(L('Failed to install packages.'))
-            done.append('packages')
+            self.__run_pacman(root, pacman + ['-Sw'] + packages, needed)
+            done.append('download')
 
         if 'packages' not in done:
+            print(L('Checking free space...'))
+            needed = self.__install_needed(root, cache,
+                                           pacman + ['--cachedir', cache],
+                                           packages)
             print(L('Installing packages...'))
-            packages = [ '-S', 'base' ] + self.setup['extra_packages']
-            if subprocess.call(pacman + packages) != 0:
-                raise InstallerException(L('Failed to install packages.'))
+            self.__run_pacman(root, pacman + ['-S'] + packages, needed)
             done.append('packages')
 
+    def __mount_table(self):
+        if self.mounts is None:
+            self.mounts = geom.util.MountTable()
+        return self.mounts
+
+    def __download_needed(self, pacman, cache, packages):
+        """Check whether the packages fit into the cache directory, returns
+        the bytes the download writes per mount point. How the installed
+        size is split across the mounts is only known once the packages
+        are available, see __install_needed()."""
+        try:
+            download, _ = space.package_sizes(pacman, packages)
+        except subprocess.CalledProcessError:
+            raise InstallerException(L('Failed to query package sizes.'))
+        needed = space.requirements(self.__mount_table(), [(cache, download)])
+        short  = space.shortfalls(needed)
+        if len(short):
+            raise InstallerException(L('Not enough free space:\n%s') %
+                                     space.describe(short))
+        return needed
+
+    def __install_needed(self, root, cache, pacman, packages):
+        """Split the installed size of the downloaded packages across the
+        target mounts by the directories their files go to, check that it
+        fits and return the bytes per mount point."""
+        mounts = self.__mount_table()
+        try:
+            archives = space.package_archives(pacman, packages, cache)
+            paths    = space.installed_paths(root, archives)
+        except (OSError, subprocess.CalledProcessError):
+            raise InstallerException(L('Failed to read the packages.'))
+        needed = space.requirements(mounts, paths)
+        short  = space.shortfalls(needed)
+        if len(short):
+            raise InstallerException(L('Not enough free space:\n%s') %
+                                     space.describe(short))
+        return needed
+
+    @staticmethod
+    def __run_pacman(root, command, needed):
+        """Run pacman while watching the free space on the target. When it
+        had to be stopped a lock file it left behind is removed so the step
+        can be retried."""
+        status, short = space.run_monitored(command, needed)
+        if len(short):
+            space.remove_stale_lock('%s/var/lib/pacman/db.lck' % root)
+            raise InstallerException(L('Aborted, running out of space:\n%s')
+                                     % space.describe(short))
+        if status != 0:
+            raise InstallerException(L('Failed to install packages.'))
+
 __all__ = ['Installer']
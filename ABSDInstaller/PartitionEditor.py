@@ -30,7 +30,8 @@ PartitionActions = Entry([('part_use',      L("Use")),
                           ('part_boot',     L("Choose Bootcode")),
                          ])
 FreeActions      = Entry([('part_create',   L("Create Partition"))])
-DiskActions      = Entry([('disk_setup',    L("Setup Partition Table"))])
+DiskActions      = Entry([('disk_setup',    L("Setup Partition Table")),
+                          ('disk_auto',     L("Automatic Layout"))])
 # pylint: enable=invalid-name
 
 Window = utils.Window
@@ -46,9 +47,16 @@ class PartitionEditor(Window):
         self.partlist.name   = L('Partition Editor')
         self.partlist.selection_changed = self.__selection_changed
 
+        self.inventory   = part.InventoryCache()
+        self.shown       = None
+        self.segments    = {}
         self.tables      = []
         self.unused      = []
         self.zpools      = []
+        self.devices     = {}
+        self.misaligned  = {}
+        # part.Draft while in dry run mode
+        self.draft       = None
 
         self.act_pos     = None
         self.actions     = [ '' ]
@@ -62,33 +70,111 @@ class PartitionEditor(Window):
         self.win.mvwin(0, 0)
         self.partlist.size = (self.size[0] - 1, self.size[1])
 
+    @staticmethod
+    def __table_segment(tab):
+        """Entry generator function for a single table"""
+        yield (TableActions, (tab,))
+        gaps = tab.gaps()
+        idx  = 0
+        for par in tab.partitions:
+            while idx < len(gaps) and gaps[idx][0] < par.start:
+                start, end = gaps[idx]
+                yield (FreeActions, (tab, start, end - start + 1))
+                idx += 1
+            yield (PartitionActions, (tab, par))
+        for start, end in gaps[idx:]:
+            yield (FreeActions, (tab, start, end - start + 1))
+
     def __iterate(self):
-        """Entry generator function"""
+        """Entry generator function, reusing the entries of the tables which
+        are still in self.segments."""
         tab_longest = 0
         for tab in self.tables:
+            segment = self.segments.get(tab.name, None)
+            if segment is None:
+                segment = list(self.__table_segment(tab))
+                self.segments[tab.name] = segment
             tab_longest = max(tab_longest, len(tab.name))
-            yield (TableActions, (tab,))
-            sector = tab.first
             for par in tab.partitions:
-                if par.start > sector:
-                    yield (FreeActions, (tab, sector, par.start - sector))
                 tab_longest = max(tab_longest, len(par.name))
-                yield (PartitionActions, (tab, par))
-                sector = par.end + 1
-            if sector < tab.last:
-                yield (FreeActions, (tab, sector, tab.last - sector))
+            for entry in segment:
+                yield entry
         for unused in self.unused:
             yield (DiskActions, (unused,))
         self.partlist.userdata = tab_longest
 
     def __load(self):
         """Load the disk geometry, setup its entry tuples, clamp the selection
-        position and update the available actions."""
+        position and update the available actions.
+        Only the entries of tables which changed are recreated."""
         self.win.clear()
-        self.tables, self.unused, self.zpools = part.load()
+        if self.draft is not None:
+            return self.__load_draft()
+        inventory = self.inventory.get()
+        if inventory is not self.shown:
+            if self.shown is None:
+                self.segments = {}
+            else:
+                changes = part.diff(self.shown, inventory)
+                for name in changes.changed_tables():
+                    self.segments.pop(name, None)
+            self.shown = inventory
+            self.tables, self.unused, self.zpools = inventory
+            self.devices = inventory.devices
+            self.misaligned = misaligned_notes(self.tables)
+            self.partlist.entries = list(self.__iterate())
+        self.__set_actions()
+
+    def __load_draft(self):
+        """Like __load() but showing the tables of the dry run."""
+        for name in self.draft.take_changed():
+            self.segments.pop(name, None)
+        self.tables     = self.draft.tables
+        self.unused     = self.draft.unused
+        self.misaligned = misaligned_notes(self.tables)
         self.partlist.entries = list(self.__iterate())
         self.__set_actions()
 
+    def toggle_draft(self):
+        """Switch the dry run mode on or off. In dry run mode the actions
+        only change a part.Draft, when leaving it the simulated changes can
+        be applied to the disks."""
+        if self.draft is None:
+            self.draft = part.Draft(self.inventory.get())
+            self.partlist.name = L('Partition Editor (dry run)')
+        else:
+            self.partlist.name = L('Partition Editor')
+            self.__leave_draft()
+        self.shown    = None
+        self.segments = {}
+        self.__load()
+        self.draw()
+
+    def __leave_draft(self):
+        """End the dry run, asking whether its changes should be applied."""
+        draft, self.draft = self.draft, None
+        if draft and utils.no_yes(self.app, L("Apply changes?"),
+                                  L("Apply the simulated changes?\n")
+                                  + '\n'.join(draft.describe())):
+            self.__apply_draft(draft)
+
+    def __apply_draft(self, draft):
+        """Replay a draft to geom and use the layouts planned in it."""
+        errors = draft.apply()
+        if len(errors):
+            msg = '\n'.join(['%s: %s' % (disk, part.errstr(errors[disk]))
+                             for disk in sorted(errors)])
+            utils.message(self.app, L("Error"), msg)
+        for plan in draft.plans:
+            self.__use_plan(plan, errors)
+        # forget about deleted partitions unless their name was reused
+        existing = set(par.name for table in draft.tables
+                       for par in table.partitions)
+        for name in draft.deleted:
+            if name not in existing:
+                self.__unuse(name)
+        self.inventory.invalidate()
+
     def __set_actions(self):
         """Pull the current entry's actions into self.actions and set act_pos
         to point to their default action."""
@@ -120,6 +206,8 @@ class PartitionEditor(Window):
     def event(self, key, name):
         if name == b'q':
             return False
+        elif name == b'd':
+            self.toggle_draft()
         elif self.partlist.event(key, name):
             pass
         elif utils.isk_tab(key, name) or utils.isk_right(key, name):
@@ -176,6 +264,13 @@ class PartitionEditor(Window):
 
     def table_destroy(self, table):
         """Destroy a partition table: equivalent of gpart destroy"""
+        if self.draft is not None:
+            msg = self.draft.destroy_table(table)
+            if msg is not None:
+                utils.message(self.app, L("Error"), msg)
+            else:
+                self.__load()
+            return
         text = ((L("Do you want to destroy %s?\n") % table.name)
                + L("WARNING: THIS OPERATION CANNOT BE UNDONE!")
                )
@@ -214,15 +309,53 @@ class PartitionEditor(Window):
             result = dlg.run()
             if result is None:
                 return
-            msg = part.create_partition_table(provider, result[0][2])
+            if self.draft is not None:
+                msg = self.draft.create_table(provider, result[0][2])
+            else:
+                msg = part.create_partition_table(provider, result[0][2])
             if msg is not None:
                 utils.message(self.app, L("Error"), msg)
             else:
                 self.__load()
 
+    def disk_auto(self, provider):
+        """Partition a disk with the default layout and use it"""
+        source = self.draft if self.draft is not None else self.shown
+        try:
+            plan = part.plan_layout(source, disks=[provider.name])
+        except part.PlanError as err:
+            utils.message(self.app, L("Error"), str(err))
+            return
+        text = (L("Create the following partitions on %s?\n") % provider.name
+                + '\n'.join(plan.describe()))
+        if not utils.no_yes(self.app, L("Automatic Layout"), text):
+            return
+        if self.draft is not None:
+            self.draft.adopt(plan)
+        else:
+            errors = plan.apply()
+            if len(errors):
+                msg = '\n'.join(['%s: %s' % (disk, part.errstr(errors[disk]))
+                                 for disk in sorted(errors)])
+                utils.message(self.app, L("Error"), msg)
+            self.__use_plan(plan, errors)
+        self.__load()
+
+    def __use_plan(self, plan, failed):
+        """Set the mount points and boot code of a part.Plan, except for the
+        failed disks."""
+        self.app.undone('mount')
+        self.app.undone('paths')
+        self.app.undone('bootcode')
+        self.app.fstab.update(plan.fstab(failed))
+        self.app.bootcode.update(plan.bootcode(failed))
+
     def part_create(self, table, start, size):
         """Create a partition: equivalent of gpart add"""
         minsz  = table.sectorsize
+        placed = part.allocate(table, start, size)
+        if placed is not None:
+            start, size = placed
         start *= table.sectorsize
         size  *= table.sectorsize
         partype = geom.partition_type_for(table.scheme, 'freebsd-ufs')
@@ -243,7 +376,11 @@ class PartitionEditor(Window):
             type_  = result[3][2]
             ustart = max(ustart, start)
             usize  = min(usize,  size)
-            msg = part.create_partition(table, label, ustart, usize, type_)
+            if self.draft is not None:
+                msg = self.draft.add(table, label, ustart, usize, type_)
+            else:
+                msg = part.create_partition(table, label, ustart, usize,
+                                            type_)
             if msg is not None:
                 utils.message(self.app, L("Error"), msg)
             else:
@@ -251,6 +388,13 @@ class PartitionEditor(Window):
 
     def part_delete(self, _, partition):
         """Delete a partition: equivalent of gpart delete"""
+        if self.draft is not None:
+            msg = self.draft.delete(partition)
+            if msg is not None:
+                utils.message(self.app, L("Error"), msg)
+            else:
+                self.__load()
+            return
         text = ((L("Do you want to delete partition %s?\n") % partition.name)
                + L("WARNING: THIS OPERATION CANNOT BE UNDONE!")
                )
@@ -294,7 +438,7 @@ class PartitionEditor(Window):
         """Performs the actual task of making a partition not being used as
         a mountpoint or for bootcode installation."""
         if partname in self.app.bootcode:
-            del self.app.bootcode.pop[partname]
+            del self.app.bootcode[partname]
             self.app.undone('bootcode')
         if partname in self.app.fstab:
             del self.app.fstab[partname]
@@ -311,9 +455,12 @@ class PartitionEditor(Window):
     def used_as(self, partition):
         """Get a textual representation of what the partition is being used as,
         or None if it's not being used."""
-        for pool in self.zpools:
-            if partition.name in pool.children:
-                return 'zpool: %s' % pool.name
+        member = self.devices.get(partition.name, None)
+        if member is not None:
+            pool, vdev = member
+            if vdev.role != 'data':
+                return 'zpool: %s (%s)' % (pool.name, vdev.role)
+            return 'zpool: %s' % pool.name
         fstab = self.app.fstab.get(partition.name, None)
         if fstab is not None:
             return 'mountpoint: %s' % fstab['mount']
@@ -420,11 +567,19 @@ class PartitionEditor(Window):
         """When there are pending geom changes, ask whether they should be
         committed or rolled back before quitting.
         Note that the rollback happens automatically in atexit."""
-        if len(geom.Uncommitted):
+        if self.draft is not None:
+            self.__leave_draft()
+        disks = geom.pending()
+        if len(disks):
             msg = L("Do you want to commit your changes"
-                    " to the following disks?\n") + ', '.join(geom.Uncommitted)
+                    " to the following disks?\n") + ', '.join(disks)
             if utils.no_yes(self.app, L("Commit changes?"), msg):
-                geom.geom_commit_all()
+                errors = geom.geom_commit_all()
+                if len(errors):
+                    msg = '\n'.join(['%s: %s' % (disk,
+                                                  part.errstr(errors[disk]))
+                                     for disk in sorted(errors)])
+                    utils.message(self.app, L("Error"), msg)
 
 
 def text_entry_table(self, maxlen, unused_win_width, table):
@@ -449,6 +604,13 @@ def text_entry_free(self, maxlen, win_width, table, beg, size):
     return '   * free: (%s)' % part.bytes2str(size * table.sectorsize)
 FreeActions.entry_text = text_entry_free
 
+def misaligned_notes(tables):
+    """Map the names of misaligned partitions to the note shown after
+    them, formatted once per load rather than on every redraw."""
+    note = L(' (misaligned by %u bytes)')
+    return dict((par.name, note % off)
+                for _, par, off in part.misaligned(tables))
+
 def text_entry_partition(self, maxlen, win_width, table, partition):
     """text representation for a partition"""
     # pylint: disable=unused-argument
@@ -456,6 +618,8 @@ def text_entry_partition(self, maxlen, win_width, table, partition):
     usage   = self.used_as(partition)
     if usage is None:
         usage = ''
+    if partition.name in self.misaligned:
+        usage += self.misaligned[partition.name]
     return '  => %s%s%- 14s [%s] %s' % (partition.name,
                                         ' ' * (maxlen - len(partition.name)),
                                         partition.partype,
@@ -2,5 +2,7 @@ __all__ = ['Installer',
            'MainWindow',
            'KeyboardSelector',
            'PartitionEditor',
+           'mount',
            'part',
+           'space',
            'utils']
@@ -0,0 +1,168 @@
+"""
+Mounting the target file systems.
+
+The fstab entries are grouped into waves: a mount point has to wait for the
+closest entry above it (eg. /usr/local for /usr), but siblings like /var
+and /home do not depend on each other, so every wave is mounted
+concurrently.
+
+The actual mounting is done by a mounter object: nmount(2) through ctypes
+when libc is available, the mount(8) command otherwise, or a
+RecordingMounter which only remembers the calls (eg. for testing on Linux).
+"""
+
+import os
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from geom import util
+
+import gettext
+L = gettext.gettext
+
+MAX_WORKERS = 8
+
+class MountError(Exception):
+    """Raised when entries of a wave failed to mount. Contains a list of
+    (entry, error) tuples."""
+    def __init__(self, failed):
+        Exception.__init__(self, L('failed to mount: %s') %
+                           ', '.join('%s (%s)' % (ent.target, err)
+                                     for ent, err in failed))
+        self.failed = failed
+
+class Entry(object):
+    """A file system to mount."""
+    # pylint: disable=too-few-public-methods
+    __slots__ = ('source', 'target', 'fstype', 'options')
+
+    def __init__(self, source, target, fstype='ufs', options=None):
+        self.source  = source
+        self.target  = os.path.normpath(target)
+        self.fstype  = fstype
+        self.options = options or []
+
+    def __repr__(self):
+        return 'Entry(%r, %r, %r)' % (self.source, self.target, self.fstype)
+
+def device_path(name):
+    """Partition names like ada0p2 are relative to /dev."""
+    if name.startswith('/'):
+        return name
+    return '/dev/' + name
+
+class SyscallMounter(object):
+    """Mount via nmount(2)."""
+    # nullfs calls its source 'target'
+    SOURCE_OPTION = {'nullfs': 'target'}
+
+    def mount(self, entry):
+        source = self.SOURCE_OPTION.get(entry.fstype, 'from')
+        options = [('fstype', entry.fstype),
+                   ('fspath', entry.target),
+                   (source,   entry.source)]
+        util.nmount(options + list(entry.options))
+
+class CommandMounter(object):
+    """Mount via the mount(8) command."""
+
+    def mount(self, entry):
+        cmd = ['mount', '-t', entry.fstype]
+        for name, value in entry.options:
+            cmd.extend(['-o', name if value is None else
+                        '%s=%s' % (name, value)])
+        subprocess.check_call(cmd + [entry.source, entry.target])
+
+class RecordingMounter(object):
+    """Only records the mount calls in self.calls, optionally failing for
+    the targets in self.fail."""
+    def __init__(self, fail=()):
+        self.calls = []
+        self.fail  = set(fail)
+        self.lock  = threading.Lock()
+
+    def mount(self, entry):
+        with self.lock:
+            self.calls.append(entry)
+        if entry.target in self.fail:
+            raise OSError(16, os.strerror(16), entry.target)
+
+def default_mounter():
+    """nmount(2) if available, the mount command otherwise."""
+    if util.libc:
+        return SyscallMounter()
+    return CommandMounter()
+
+def waves(entries):
+    """Group the entries into lists which can be mounted concurrently. An
+    entry is placed into the wave after the one of the closest entry whose
+    target contains it."""
+    targets = dict((ent.target, ent) for ent in entries)
+    depth   = {}
+
+    def depth_of(target):
+        if target in depth:
+            return depth[target]
+        level = 0
+        parent = target
+        # stops at '/' or, for relative targets, at ''
+        while os.path.dirname(parent) != parent:
+            parent = os.path.dirname(parent)
+            if parent in targets:
+                level = depth_of(parent) + 1
+                break
+        depth[target] = level
+        return level
+
+    result = []
+    for ent in sorted(entries, key=lambda ent: ent.target):
+        level = depth_of(ent.target)
+        while len(result) <= level:
+            result.append([])
+        result[level].append(ent)
+    return result
+
+class MountEngine(object):
+    """Mounts lists of entries wave by wave, skipping targets which are
+    already mounted according to a geom.util.MountTable."""
+    def __init__(self, mounter=None, mounts=None, workers=None):
+        if mounter is None:
+            mounter = default_mounter()
+        self.mounter = mounter
+        self.mounts  = mounts
+        self.workers = workers or MAX_WORKERS
+
+    def __mount(self, entry):
+        """Returns None or the error."""
+        try:
+            os.makedirs(entry.target, mode=0o755, exist_ok=True)
+            self.mounter.mount(entry)
+        except (OSError, subprocess.CalledProcessError) as err:
+            return err
+        return None
+
+    def mount_all(self, entries):
+        """Mount all entries, raises a MountError after the first wave in
+        which something failed."""
+        for wave in waves(entries):
+            if self.mounts is not None:
+                wave = [ent for ent in wave
+                        if not self.mounts.is_mounted(ent.target)]
+            if not len(wave):
+                continue
+            if self.mounts is not None:
+                self.mounts.invalidate()
+            if len(wave) == 1:
+                results = [self.__mount(wave[0])]
+            else:
+                with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                    results = list(pool.map(self.__mount, wave))
+            failed = [(ent, err) for ent, err in zip(wave, results)
+                      if err is not None]
+            if len(failed):
+                raise MountError(failed)
+
+__all__ = ['MountError', 'Entry', 'device_path', 'SyscallMounter',
+           'CommandMounter', 'RecordingMounter', 'default_mounter', 'waves',
+           'MountEngine']
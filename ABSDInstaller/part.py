@@ -5,19 +5,21 @@ Helper function and classes wrapping geom and zfs code.
 # pylint: disable=too-few-public-methods
 #   The classes here are just informative structures
 
+import bisect
+import math
+import os
+import re
 import string
+import subprocess
 from geom import geom, zfs
-from ctypes import byref, POINTER, c_uint
+from .mount import device_path
 
 import gettext
 L = gettext.gettext
 
 def find_cfg(gobj, name):
     """lookup a <config> entry by name"""
-    for cfg in gobj.configs():
-        if cfg.name == name:
-            return cfg.value
-    return None
+    return gobj.config.get(name, None)
 
 class Partition(object):
     """Contains all the used information about a partition."""
@@ -42,160 +44,601 @@ class Partition(object):
                          provider.name,
                          provider.mediasize,
                          provider.sectorsize,
-                         find_cfg(provider, 'type'),
-                         find_cfg(provider, 'rawtype'),
-                         int(find_cfg(provider, 'start')),
-                         int(find_cfg(provider, 'end')),
-                         int(find_cfg(provider, 'index')),
-                         find_cfg(provider, 'label'))
+                         provider.cfg_str('type'),
+                         provider.cfg_str('rawtype'),
+                         provider.cfg_int('start'),
+                         provider.cfg_int('end'),
+                         provider.cfg_int('index'),
+                         provider.cfg_str('label'))
+
+    def state(self):
+        """Tuple of the values compared by diff()"""
+        return (self.bytes_, self.sectorsize, self.partype, self.rawtype,
+                self.start, self.end, self.index, self.label)
 
 class PartitionTable(object):
     """This usually wraps a disk containing a partition table.
     Keeps around a list of all partitions, and information about the disk's
-    layout, such as size, sector-size, partitioning scheme..."""
+    layout, such as size, sector-size, partitioning scheme...
+
+    The partitions are kept sorted by their start sector, and the free
+    extents between first and last are kept in an interval map which is
+    updated by add() and remove(). Extents are (start, end) tuples of
+    sectors, both inclusive."""
 
     # pylint: disable=too-many-arguments
-    def __init__(self, name, scheme, first, last, size, sectorsize):
-        self.name       = name
-        self.scheme     = scheme
-        self.first      = first
-        self.last       = last
-        self.size       = size
-        self.sectorsize = sectorsize
-        self.partitions = []
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, name, scheme, first, last, size, sectorsize,
+                 stripesize=0, stripeoffset=0):
+        self.name         = name
+        self.scheme       = scheme
+        self.first        = first
+        self.last         = last
+        self.size         = size
+        self.sectorsize   = sectorsize
+        self.stripesize   = stripesize
+        self.stripeoffset = stripeoffset
+        self.partitions   = []
+        # bisect keys of self.partitions
+        self.__starts   = []
+        # free extents ordered by start, their starts and (size, start)
+        self.__gaps     = []
+        self.__gap_keys = []
+        self.__by_size  = []
+        if last >= first:
+            self.__add_gap(first, last)
+
+    def state(self):
+        """Tuple of the values compared by diff(), not including the
+        partitions, which are compared separately."""
+        return (self.scheme, self.first, self.last, self.size,
+                self.sectorsize, self.stripesize, self.stripeoffset)
+
+    def __add_gap(self, start, end):
+        idx = bisect.bisect_left(self.__gap_keys, start)
+        self.__gaps.insert(idx, (start, end))
+        self.__gap_keys.insert(idx, start)
+        bisect.insort(self.__by_size, (end - start + 1, start))
+
+    def __del_gap(self, idx):
+        start, end = self.__gaps.pop(idx)
+        del self.__gap_keys[idx]
+        pos = bisect.bisect_left(self.__by_size, (end - start + 1, start))
+        del self.__by_size[pos]
+
+    def __carve(self, start, end):
+        """Remove [start, end] from the free extents."""
+        idx = bisect.bisect_right(self.__gap_keys, start) - 1
+        if idx < 0:
+            idx = 0
+        while idx < len(self.__gaps):
+            gstart, gend = self.__gaps[idx]
+            if gstart > end:
+                break
+            if gend < start:
+                idx += 1
+                continue
+            self.__del_gap(idx)
+            if gstart < start:
+                self.__add_gap(gstart, start - 1)
+                idx += 1
+            if gend > end:
+                self.__add_gap(end + 1, gend)
+                break
+
+    def __release(self, start, end):
+        """Add [start, end] to the free extents, merging it with its
+        neighbours."""
+        start = max(start, self.first)
+        end   = min(end, self.last)
+        if end < start:
+            return
+        idx = bisect.bisect_left(self.__gap_keys, start)
+        if idx < len(self.__gaps) and self.__gaps[idx][0] == end + 1:
+            end = self.__gaps[idx][1]
+            self.__del_gap(idx)
+        if idx > 0 and self.__gaps[idx-1][1] == start - 1:
+            start = self.__gaps[idx-1][0]
+            self.__del_gap(idx-1)
+        self.__add_gap(start, end)
 
     def add(self, part):
         """Insert a partition while keeping the list sorted by physical
         position."""
-        for i in range(0, len(self.partitions)):
-            if part.start < self.partitions[i].start:
-                self.partitions.insert(i, part)
-                return
-        self.partitions.append(part)
+        idx = bisect.bisect_right(self.__starts, part.start)
+        self.partitions.insert(idx, part)
+        self.__starts.insert(idx, part.start)
+        self.__carve(part.start, part.end)
+
+    def remove(self, part):
+        """Remove a partition, its sectors become free."""
+        idx = bisect.bisect_left(self.__starts, part.start)
+        while self.partitions[idx] is not part:
+            idx += 1
+        del self.partitions[idx]
+        del self.__starts[idx]
+        self.__release(part.start, part.end)
+
+    def gaps(self):
+        """The free extents in order."""
+        return list(self.__gaps)
+
+    def gap_at(self, lba):
+        """The free extent containing a sector, or None."""
+        idx = bisect.bisect_right(self.__gap_keys, lba) - 1
+        if idx >= 0 and self.__gaps[idx][1] >= lba:
+            return self.__gaps[idx]
+        return None
+
+    def largest(self):
+        """The largest free extent, the first one if there are several of
+        that size, or None."""
+        if not len(self.__by_size):
+            return None
+        size = self.__by_size[-1][0]
+        idx  = bisect.bisect_left(self.__by_size, (size, -1))
+        start = self.__by_size[idx][1]
+        return (start, start + size - 1)
+
+    def first_gap(self, size):
+        """The first free extent in order of size which can hold size
+        sectors, ie. the best fit, or None."""
+        idx = bisect.bisect_left(self.__by_size, (size, -1))
+        if idx >= len(self.__by_size):
+            return None
+        gsize, start = self.__by_size[idx]
+        return (start, start + gsize - 1)
+
+    def copy(self):
+        """A copy with copies of the partitions, eg. for a Draft."""
+        table = PartitionTable(self.name, self.scheme, self.first, self.last,
+                               self.size, self.sectorsize, self.stripesize,
+                               self.stripeoffset)
+        for par in self.partitions:
+            table.add(Partition(table, par.name, par.bytes_, par.sectorsize,
+                                par.partype, par.rawtype, par.start, par.end,
+                                par.index, par.label))
+        return table
 
     @staticmethod
     def from_geom(gobj):
         """Create a PartitionTable from a 'geom' object."""
-        scheme = None
-        first  = 0
-        last   = 0
+        scheme = gobj.cfg_str('scheme')
+        first  = gobj.cfg_int('first', 0)
+        last   = gobj.cfg_int('last', 0)
         size   = 0
         sector = 0
-        for cfg in gobj.configs():
-            if cfg.name == 'scheme':
-                scheme = cfg.val
-            elif cfg.name == 'first':
-                first  = int(cfg.val)
-            elif cfg.name == 'last':
-                last   = int(cfg.val)
-        if bool(gobj.lg_consumer):
-            consumer = gobj.lg_consumer[0]
-            if bool(consumer.lg_provider):
-                size   = consumer.lg_provider[0].mediasize
-                sector = consumer.lg_provider[0].sectorsize
-        table = PartitionTable(gobj.name, scheme, first, last, size, sector)
+        stripe = 0
+        offset = 0
+        consumer = next(gobj.consumers(), None)
+        if consumer is not None:
+            provider = next(consumer.providers(), None)
+            if provider is not None:
+                size   = provider.mediasize
+                sector = provider.sectorsize
+                stripe = provider.stripesize
+                offset = provider.stripeoffset
+        table = PartitionTable(gobj.name, scheme, first, last, size, sector,
+                               stripe, offset)
         for provider in gobj.providers():
             table.add(Partition.from_provider(table, provider))
         return table
 
+# Default partition alignment in bytes.
+ALIGNMENT = 1024*1024
+
+def _lcm(a, b):
+    return a * b // math.gcd(a, b)
+
+class Alignment(object):
+    """A grid of byte offsets on a partition table's provider. An offset X
+    is aligned when (X + offset) is a multiple of grain, where offset is
+    the provider's stripeoffset: the stripes of a partition at X start at
+    its beginning exactly then."""
+    def __init__(self, sectorsize, grain, offset=0):
+        self.sectorsize = sectorsize
+        self.grain      = grain
+        self.offset     = offset % grain
+
+    @staticmethod
+    def for_table(table, boundary=None):
+        """The alignment used for new partitions: boundary bytes (by default
+        ALIGNMENT) combined with the sector and stripe size."""
+        sector = max(table.sectorsize, 1)
+        grain  = _lcm(boundary or ALIGNMENT, sector)
+        if table.stripesize > 0:
+            grain = _lcm(grain, table.stripesize)
+        return Alignment(sector, grain, table.stripeoffset)
+
+    @staticmethod
+    def physical(table):
+        """The alignment required by the provider itself, the stripe size
+        or, without one, the sector size."""
+        sector = max(table.sectorsize, 1)
+        grain  = sector
+        if table.stripesize > sector:
+            grain = _lcm(sector, table.stripesize)
+        return Alignment(sector, grain, table.stripeoffset)
+
+    def up(self, lba):
+        """The first aligned sector at or after lba."""
+        pos = lba * self.sectorsize + self.offset
+        pos = -(-pos // self.grain) * self.grain
+        return (pos - self.offset) // self.sectorsize
+
+    def down(self, lba):
+        """The last aligned sector at or before lba."""
+        pos = lba * self.sectorsize + self.offset
+        pos = (pos // self.grain) * self.grain
+        return (pos - self.offset) // self.sectorsize
+
+    def error(self, lba):
+        """By how many bytes lba is off the grid."""
+        return (lba * self.sectorsize + self.offset) % self.grain
+
+def allocate(table, start, size, boundary=None):
+    """Compute an aligned (start, size) tuple in sectors for a new partition
+    in the free extent containing the start sector, with at most size
+    sectors. The end is aligned as well so a following partition can
+    start right after it, unless that would leave nothing. Returns None if
+    start is not inside a free extent or no aligned sector is left."""
+    gap = table.gap_at(max(start, table.first))
+    if gap is None:
+        return None
+    grid  = Alignment.for_table(table, boundary)
+    start = max(grid.up(max(start, table.first)), gap[0])
+    if start > gap[1]:
+        return None
+    end = min(start + size, gap[1] + 1)
+    aligned_end = grid.down(end)
+    if aligned_end > start:
+        end = aligned_end
+    return (start, end - start)
+
+def misaligned(tables):
+    """Report partitions whose start does not match the physical alignment
+    of their provider: a list of (table, partition, bytes off) tuples."""
+    result = []
+    for table in tables:
+        grid = Alignment.physical(table)
+        if grid.grain <= grid.sectorsize and grid.offset == 0:
+            continue
+        for par in table.partitions:
+            error = grid.error(par.start)
+            if error:
+                result.append((table, par, error))
+    return result
+
+# vdev_state_t
+VDEV_STATES = ['UNKNOWN', 'CLOSED', 'OFFLINE', 'REMOVED', 'CANT_OPEN',
+               'FAULTED', 'DEGRADED', 'ONLINE']
+
+class VDev(object):
+    """A node of a zpool's vdev tree. role is one of 'data', 'log', 'cache'
+    or 'spare' and is inherited by the children of a top-level vdev."""
+    # pylint: disable=too-many-instance-attributes
+    # pylint: disable=too-many-arguments
+    def __init__(self, type_, name, role='data', path=None, guid=None,
+                 ashift=None, asize=None, state=None, children=None):
+        self.type     = type_
+        self.name     = name
+        self.role     = role
+        self.path     = path
+        self.guid     = guid
+        self.ashift   = ashift
+        self.asize    = asize
+        self.state    = state
+        self.children = children or []
+
+    def is_leaf(self):
+        return not len(self.children)
+
+    def walk(self):
+        """Iterate over this vdev and all its descendants."""
+        yield self
+        for child in self.children:
+            for vdev in child.walk():
+                yield vdev
+
+    def state_tuple(self):
+        """Tuple of the values compared by diff()"""
+        return (self.type, self.name, self.role, self.path,
+                tuple(child.state_tuple() for child in self.children))
+
+    @staticmethod
+    def vdev_name(config):
+        """Name a vdev like zpool_vdev_name() does: leaves by their path
+        without /dev/, interior vdevs as type-id, eg. raidz2-0."""
+        path = config.get('path', None)
+        if path is not None:
+            if path.startswith('/dev/'):
+                path = path[5:]
+            return path
+        type_ = config.get('type', '')
+        if type_ == 'raidz':
+            type_ = 'raidz%u' % config.get('nparity', 1)
+        if 'id' in config:
+            return '%s-%u' % (type_, config['id'])
+        return type_
+
+    @staticmethod
+    def from_config(config, role='data'):
+        """Create a VDev tree from a vdev nvlist converted to a dictionary
+        (see geom.zfs.nvlist_to_dict)."""
+        stats = config.get('vdev_stats', None)
+        state = None
+        if stats is not None and len(stats) > 1 and \
+           stats[1] < len(VDEV_STATES):
+            state = VDEV_STATES[stats[1]]
+        children = [VDev.from_config(child, role)
+                    for child in config.get('children', [])]
+        return VDev(config.get('type', None), VDev.vdev_name(config), role,
+                    path=config.get('path', None),
+                    guid=config.get('guid', None),
+                    ashift=config.get('ashift', None),
+                    asize=config.get('asize', None),
+                    state=state, children=children)
+
 class ZPool(object):
-    """Represents a zpool, currently only contains name and its children,
-    flattened into a single array."""
-    def __init__(self, name, children):
+    """Represents a zpool with its tree of vdevs. The names of all vdevs
+    are also available flattened into the children array."""
+    def __init__(self, name, vdevs):
         self.name     = name
-        self.children = children
+        self.vdevs    = vdevs
+        self.children = [vdev.name for top in vdevs
+                         for vdev in top.walk()]
+
+    def state(self):
+        """Tuple of the values compared by diff()"""
+        return tuple(vdev.state_tuple() for vdev in self.vdevs)
+
+    def devices(self):
+        """Iterate over the leaf vdevs."""
+        for top in self.vdevs:
+            for vdev in top.walk():
+                if vdev.is_leaf():
+                    yield vdev
 
     @staticmethod
-    def from_handle(zhandle, pool):
-        """Create a ZPool from a libzfs and zpool handle. Parses the pool's
-        config to find its child-devices, and passes the list along to
-        the ZPool ctor."""
+    def from_config(name, config):
+        """Create a ZPool from its config dictionary."""
+        tree  = config.get('vdev_tree', {})
+        vdevs = []
+        for child in tree.get('children', []):
+            role = 'log' if child.get('is_log', 0) else 'data'
+            vdevs.append(VDev.from_config(child, role))
+        for child in tree.get('l2cache', []):
+            vdevs.append(VDev.from_config(child, 'cache'))
+        for child in tree.get('spares', []):
+            vdevs.append(VDev.from_config(child, 'spare'))
+        return ZPool(name, vdevs)
+
+    @staticmethod
+    def from_handle(pool):
+        """Create a ZPool from a libzfs zpool handle. Fetches the whole
+        config with a single call and builds the vdev tree from it."""
         name = zfs.zfs.zpool_get_name(pool)
         if not bool(name):
             return None, L('failed to get zpool name')
 
         name = name.decode('utf-8')
 
-        config = zfs.zfs.zpool_get_config(pool, None)
-        if not bool(config):
+        config = zfs.pool_config(pool)
+        if config is None:
             return None, (L('failed to get config for zpool %s') % name)
-
-        nvroot = zfs.nvlist_p()
-        res = zfs.zfs.nvlist_lookup_nvlist(config, b'vdev_tree', byref(nvroot))
-        if res != 0:
+        if 'vdev_tree' not in config:
             return None, (L('failed to get vdev tree for pool %s') % name)
 
-        children = ZPool.__children(zhandle, pool, nvroot)
+        return ZPool.from_config(name, config), None
 
-        return ZPool(name, children), None
+class Inventory(object):
+    """The result of load(): the partition tables, unused disks and zpools.
+    Can be unpacked like a tuple: tables, unused, zpools = load()"""
+    def __init__(self, tables, unused, zpools, generation=None):
+        self.tables     = tables
+        self.unused     = unused
+        self.zpools     = zpools
+        self.generation = generation
+        self.devices    = device_map(zpools)
 
-    @staticmethod
-    def __children(zhandle, pool, nvroot):
-        """Recursively list a zpool's child vdevs given a handle to the
-        libzfs, the zpool, and the current nvlist pointer from the zpool's
-        config."""
-
-        child    = POINTER(zfs.nvlist_p)()
-        children = c_uint()
-        zfs.zfs.nvlist_lookup_nvlist_array(nvroot, b'children',
-                                           byref(child), byref(children))
-
-        childlist = []
-        for i in range(children.value):
-            name = zfs.zfs.zpool_vdev_name(zhandle, pool, child[i], False)
-            if not bool(name):
-                continue
-            childlist.append(name.decode('utf-8'))
-            childlist.extend(ZPool.__children(zhandle, pool, child[i]))
+    def __iter__(self):
+        return iter((self.tables, self.unused, self.zpools))
 
-        return childlist
+def generation():
+    """Combined geom and zfs change generation, see geom.generation()"""
+    return (geom.generation(), zfs.generation())
 
-def load():
-    """Load the current disk geometry layout and provide a list of partition
-    tables, zpools, and a list of unused devices to be shown in the partition
-    editor."""
+class InventoryCache(object):
+    """Keeps the last Inventory around and only calls load() again when the
+    generation changed, or after invalidate(). The zpools are only reloaded
+    when the zfs part of the generation changed, so partitioning a disk does
+    not cause the pool configs to be refreshed."""
+    def __init__(self):
+        self.inventory = None
 
-    tables = []
-    used   = []
-    unused = []
-    errors = []
+    def invalidate(self):
+        """Force the next get() to reload the inventory."""
+        self.inventory = None
+
+    def get(self, force=False):
+        """Get the current Inventory, reloading it if required."""
+        current = generation()
+        old     = self.inventory
+        if old is None:
+            self.inventory = load()
+        elif old.generation == current and not force:
+            return old
+        elif old.generation[1] == current[1] and not force:
+            self.inventory = load(zpools=old.zpools)
+        else:
+            self.inventory = load(zpools=load_zpools(refresh=True))
+        self.inventory.generation = current
+        return self.inventory
+
+def _provider_state(provider):
+    """Tuple of the values of an unused provider compared by diff()"""
+    return (provider.mediasize, provider.sectorsize)
+
+class InventoryDiff(object):
+    """Differences between two Inventory objects, see diff().
+
+    For each category in CATEGORIES there are three dictionaries:
+        added[category]:    id -> new object
+        removed[category]:  id -> old object
+        modified[category]: id -> (old object, new object)
+    Tables, unused disks and zpools are identified by their names,
+    partitions by their table's name and their index."""
 
+    CATEGORIES = ('tables', 'partitions', 'unused', 'zpools')
+
+    def __init__(self):
+        self.added    = dict((cat, {}) for cat in self.CATEGORIES)
+        self.removed  = dict((cat, {}) for cat in self.CATEGORIES)
+        self.modified = dict((cat, {}) for cat in self.CATEGORIES)
+
+    def __bool__(self):
+        for cat in self.CATEGORIES:
+            if self.added[cat] or self.removed[cat] or self.modified[cat]:
+                return True
+        return False
+
+    def compare(self, category, old, new, state):
+        """Compare two dictionaries of objects by their state."""
+        added    = self.added[category]
+        removed  = self.removed[category]
+        modified = self.modified[category]
+        for key, obj in new.items():
+            prev = old.get(key, None)
+            if prev is None:
+                added[key] = obj
+            elif state(prev) != state(obj):
+                modified[key] = (prev, obj)
+        for key, obj in old.items():
+            if key not in new:
+                removed[key] = obj
+
+    def changed_tables(self):
+        """The set of names of tables which were added, removed, modified
+        or had any of their partitions changed."""
+        names = set()
+        for cat in (self.added, self.removed, self.modified):
+            names.update(cat['tables'])
+            names.update(table for table, _ in cat['partitions'])
+        return names
+
+    def describe(self):
+        """A list of lines describing the changes, eg. for logging."""
+        lines = []
+        for cat in self.CATEGORIES:
+            for sign, changes in (('+', self.added[cat]),
+                                  ('-', self.removed[cat]),
+                                  ('~', self.modified[cat])):
+                for key in sorted(changes):
+                    if cat == 'partitions':
+                        key = '%s index %u' % key
+                    lines.append('%s %s %s' % (sign, cat, key))
+        return lines
+
+def _partitions_by_id(tables):
+    """(table name, index) -> Partition"""
+    result = {}
+    for table in tables:
+        for par in table.partitions:
+            result[(table.name, par.index)] = par
+    return result
+
+def diff(old, new):
+    """Compare two Inventory objects, returns an InventoryDiff. This is
+    linear in the number of objects contained in the inventories."""
+    result = InventoryDiff()
+    result.compare('tables',
+                   dict((tab.name, tab) for tab in old.tables),
+                   dict((tab.name, tab) for tab in new.tables),
+                   PartitionTable.state)
+    result.compare('partitions',
+                   _partitions_by_id(old.tables),
+                   _partitions_by_id(new.tables),
+                   Partition.state)
+    result.compare('unused',
+                   dict((prov.name, prov) for prov in old.unused),
+                   dict((prov.name, prov) for prov in new.unused),
+                   _provider_state)
+    result.compare('zpools',
+                   dict((pool.name, pool) for pool in old.zpools),
+                   dict((pool.name, pool) for pool in new.zpools),
+                   ZPool.state)
+    return result
+
+def device_map(zpools):
+    """Map the device names of all leaf vdevs to (pool, vdev) tuples."""
+    devices = {}
+    for pool in zpools:
+        for vdev in pool.devices():
+            devices[vdev.name] = (pool, vdev)
+    return devices
+
+def load_zpools(refresh=False):
+    """Load the list of zpools from the shared geom.zfs session. Returns an
+    empty list when libzfs is not available. With refresh the pool configs
+    are reloaded first."""
     zpools = []
-    zhandle = zfs.zfs.libzfs_init()
-    if bool(zhandle):
-        def __pool_iter(pool, _):
-            """C callback: called for each zpool"""
-            # cannot raise exceptions past the C callback
-            obj, err = ZPool.from_handle(zhandle, pool)
+    errors = []
+    if not zfs.zfs:
+        return zpools
+    session = zfs.session()
+    with session:
+        if refresh:
+            session.refresh()
+        else:
+            session.open()
+        for name in sorted(session.pools.keys()):
+            obj, err = ZPool.from_handle(session.pools[name])
             if obj is not None:
                 zpools.append(obj)
-                used.extend(obj.children)
             else:
                 errors.append(err)
-            return 0
-
-        zfs.zfs.zpool_iter(zhandle, zfs.zpool_iter_f(__pool_iter), None)
-        zfs.zfs.libzfs_fini(zhandle)
-
-    with geom.Mesh() as mesh:
-        # first all the used ones
-        cls = mesh.find_class(b'PART')
-        if cls is not None:
-            for gobj in cls.geoms():
-                used.append(gobj.name)
-                tables.append(PartitionTable.from_geom(gobj))
-
-        # don't add RAID disks to the unused array
-        # ELI attached devices have the same structural layout
-        for cls in mesh.classes():
-            load_class_used(cls, used)
-
-        # now fill the unused-array
-        for cls in mesh.classes():
-            if cls.name == 'PART':
-                continue
-            load_class_unused(cls, used, unused)
-    return tables, unused, zpools
+    return zpools
+
+def load(mesh=None, zpools=None):
+    """Load the current disk geometry layout and provide an Inventory with a
+    list of partition tables, zpools, and a list of unused devices to be
+    shown in the partition editor.
+    A geom snapshot can be passed in as mesh, otherwise the current one is
+    used, see geom.snapshot(). Similarly an already loaded list of zpools
+    can be passed along."""
+
+    tables = []
+    used   = set()
+    unused = []
+
+    if zpools is None:
+        zpools = load_zpools()
+    for pool in zpools:
+        used.update(pool.children)
+
+    # the snapshot does not keep the C tree around, so the providers in the
+    # unused-array stay valid
+    if mesh is None:
+        mesh = geom.snapshot()
+
+    # first all the used ones
+    cls = mesh.find_class('PART')
+    if cls is not None:
+        for gobj in cls.geoms():
+            used.add(gobj.name)
+            tables.append(PartitionTable.from_geom(gobj))
+
+    # don't add RAID disks to the unused array
+    # ELI attached devices have the same structural layout
+    for cls in mesh.classes():
+        load_class_used(cls, used)
+
+    # now fill the unused-array
+    for cls in mesh.classes():
+        if cls.name == 'PART':
+            continue
+        load_class_unused(cls, used, unused)
+    return Inventory(tables, unused, zpools)
 
 def load_class_used(cls, used):
     """Load all the 'used' parts of a geom class which aren't handled
@@ -205,13 +648,15 @@ def load_class_used(cls, used):
     for gobj in cls.geoms():
         for consumer in gobj.consumers():
             for provider in consumer.providers():
-                used.append(provider.name)
+                used.add(provider.name)
 
 def load_class_unused(cls, used, unused):
     """Load unused class members into the unused-array, hard masking things
     such as 'CDs' and partitions by inspecting the name. Partitions usually
     have their owner prefixed with a slash in front of them, so this will not
-    add anything containing a slash."""
+    add anything containing a slash.
+    Names added to the unused-array are also put into the used-set so
+    duplicates are skipped."""
     for gobj in cls.geoms():
         for provider in gobj.providers():
             name = provider.name
@@ -223,10 +668,15 @@ def load_class_unused(cls, used, unused):
                 continue
             if name in used:
                 continue
-            if next((x for x in unused if x.name == name), None) is not None:
-                continue
+            used.add(name)
             unused.append(provider)
 
+def errstr(err):
+    """gctl errors are returned as bytes, convert them for display"""
+    if isinstance(err, bytes):
+        return err.decode('utf-8', 'replace')
+    return err
+
 def bytes2str(bytes_, precision=1):
     """convert an amount of bytes to a nice string with a unit suffix"""
     # gpart uses SI units so... not 1024
@@ -260,33 +710,51 @@ def str2bytes(bytestr):
     return int(num) * mul
 
 def delete_partition(partition):
-    """Delete the partition associated with a partition object."""
+    """Delete the partition associated with a partition object. The table
+    object is left alone, it belongs to an Inventory which is compared
+    against the next one by diff()."""
     owner = partition.owner
     index = partition.index
-    res = geom.geom_part_do(owner.name, 'delete', [('index', int, index)])
-    if res is not None:
-        return res
-    owner.partitions.remove(partition)
-    return None
-
-def create_partition(table, label, start, size, type_):
-    """Create a partition inside the provided partition table."""
-    data = []
-    if len(label) > 0:
-        data.append(('label', str, str(label)))
+    return geom.geom_part_do(owner.name, 'delete',
+                             [('index', str, str(index))])
 
+def _partition_request(table, start, size, type_, align, strict=False):
+    """Map the type and compute the sectors of a new partition for
+    create_partition() and Draft.add(). With strict the type is checked
+    against geom.PART_TYPES, otherwise gpart is left to reject it.
+    Returns ((type, start, size), None) or (None, error)."""
+    # pylint: disable=too-many-arguments
     if len(type_):
-        known_type = geom.partition_type_for(table.scheme, type_)
-        if known_type is None:
-            return 'invalid type: %s' % type_
-        data.append(('type', str, known_type))
+        type_ = geom.partition_type_for(table.scheme, type_)
+        if strict and not geom.partition_type_known(table.scheme, type_):
+            return None, 'invalid type: %s' % type_
 
     start = max(start // table.sectorsize, table.first)
-    size  = (size // table.sectorsize) + 1
+    if align:
+        placed = allocate(table, start, size // table.sectorsize)
+        if placed is None:
+            return None, 'no aligned free space at sector %u' % start
+        start, size = placed
+    else:
+        size = (size // table.sectorsize) + 1
 
     if start + size > table.last:
         size = table.last - start + 1
+    return (type_, start, size), None
+
+def create_partition(table, label, start, size, type_, align=True):
+    """Create a partition inside the provided partition table. start and
+    size are in bytes. With align the partition is placed by allocate()."""
+    request, err = _partition_request(table, start, size, type_, align)
+    if err is not None:
+        return err
+    type_, start, size = request
 
+    data = []
+    if len(label) > 0:
+        data.append(('label', str, str(label)))
+    if len(type_):
+        data.append(('type', str, type_))
     data.append(('start', str, str(start)))
     data.append(('size',  str, str(size)))
 
@@ -303,14 +771,858 @@ def destroy_partition_table(table):
         return "Disk is not empty, remove partitions first!"
     return geom.geom_part_do(table.name, 'destroy', [])
 
+def partition_name(disk, scheme, index):
+    """The provider name gpart uses for a partition."""
+    if scheme == 'GPT':
+        return '%sp%u' % (disk, index)
+    if scheme == 'MBR':
+        return '%ss%u' % (disk, index)
+    return '%s%s' % (disk, chr(ord('a') + index - 1))
+
+class DraftDisk(object):
+    """Stands in for the provider of a disk whose table was destroyed in a
+    Draft."""
+    # pylint: disable=too-many-arguments
+    __slots__ = ('name', 'mediasize', 'sectorsize', 'stripesize',
+                 'stripeoffset')
+
+    def __init__(self, name, mediasize, sectorsize, stripesize=0,
+                 stripeoffset=0):
+        self.name         = name
+        self.mediasize    = mediasize
+        self.sectorsize   = sectorsize
+        self.stripesize   = stripesize
+        self.stripeoffset = stripeoffset
+
+class Draft(object):
+    """Partitioning changes simulated on copies of the partition tables of
+    an Inventory. create_table(), destroy_table(), add() and delete() work
+    like create_partition_table(), destroy_partition_table(),
+    create_partition() and delete_partition(): they validate the request
+    (bounds, overlaps, the scheme's number of entries and the type) and
+    return None or an error message, but only update the copies and record
+    the verb. apply() replays the recorded verbs to geom."""
+    def __init__(self, inventory):
+        self.tables  = [table.copy() for table in inventory.tables]
+        self.unused  = list(inventory.unused)
+        self.ops     = []
+        self.plans   = []
+        self.deleted = []
+        self.changed = set()
+
+    def __bool__(self):
+        return len(self.ops) > 0
+
+    def table(self, name):
+        """The draft's table of a disk, or None."""
+        for table in self.tables:
+            if table.name == name:
+                return table
+        return None
+
+    def take_changed(self):
+        """The names of the tables changed since the last call."""
+        changed, self.changed = self.changed, set()
+        return changed
+
+    def __record(self, name, verb, *args):
+        self.ops.append((name, verb, args))
+        self.changed.add(name)
+
+    def create_table(self, provider, scheme):
+        """Simulated gpart create on an unused disk."""
+        scheme = scheme.upper()
+        if scheme not in geom.PART_SCHEMES:
+            return 'invalid scheme: %s' % scheme
+        if provider not in self.unused:
+            return 'not an unused disk: %s' % provider.name
+        sector = max(provider.sectorsize, 1)
+        try:
+            first, last = scheme_bounds(scheme, provider.mediasize // sector,
+                                        sector)
+        except PlanError as err:
+            return str(err)
+        if last <= first:
+            return 'disk too small: %s' % provider.name
+        self.unused.remove(provider)
+        self.tables.append(PartitionTable(provider.name, scheme, first, last,
+                                          provider.mediasize, sector,
+                                          provider.stripesize,
+                                          provider.stripeoffset))
+        self.__record(provider.name, 'create', scheme)
+        return None
+
+    def destroy_table(self, table):
+        """Simulated gpart destroy of an empty table."""
+        if len(table.partitions):
+            return "Disk is not empty, remove partitions first!"
+        self.tables.remove(table)
+        self.unused.append(DraftDisk(table.name, table.size, table.sectorsize,
+                                     table.stripesize, table.stripeoffset))
+        self.__record(table.name, 'destroy')
+        return None
+
+    def add(self, table, label, start, size, type_, align=True):
+        """Simulated gpart add, see create_partition()."""
+        # pylint: disable=too-many-arguments
+        if not len(type_):
+            return 'missing type'
+        request, err = _partition_request(table, start, size, type_, align,
+                                          strict=True)
+        if err is not None:
+            return err
+        type_, start, size = request
+        end = start + size - 1
+        if size <= 0 or start < table.first or end > table.last:
+            return 'outside of %s: sectors %u-%u' % (table.name, start, end)
+        gap = table.gap_at(start)
+        if gap is None or gap[1] < end:
+            for par in table.partitions:
+                if par.start <= end and start <= par.end:
+                    return 'overlaps %s' % par.name
+        # the number of entries is only known for the PART_SCHEMES
+        indices = set(par.index for par in table.partitions)
+        limit   = geom.PART_SCHEMES.get(table.scheme, None)
+        index   = 1
+        while index in indices:
+            index += 1
+        if limit is not None and index > limit:
+            return '%s holds at most %u partitions' % (table.scheme, limit)
+        table.add(Partition(table, partition_name(table.name, table.scheme,
+                                                  index),
+                            size * table.sectorsize, table.sectorsize,
+                            type_, type_, start, end, index, label or None))
+        self.__record(table.name, 'add', type_, start, size, label or None,
+                      index)
+        return None
+
+    def delete(self, partition):
+        """Simulated gpart delete."""
+        table = partition.owner
+        if table not in self.tables or partition not in table.partitions:
+            return 'no such partition: %s' % partition.name
+        table.remove(partition)
+        self.deleted.append(partition.name)
+        self.__record(table.name, 'delete', partition.index)
+        return None
+
+    def adopt(self, plan):
+        """Take over the tables of a Plan computed for the draft, see
+        plan_layout(). The plan is kept in self.plans."""
+        for disk in plan.disks:
+            if disk.create:
+                for provider in self.unused:
+                    if provider.name == disk.name:
+                        self.unused.remove(provider)
+                        break
+                self.__record(disk.name, 'create', disk.table.scheme)
+            else:
+                self.tables.remove(self.table(disk.name))
+            self.tables.append(disk.table)
+            for planned in disk.partitions:
+                self.__record(disk.name, 'add', planned.type, planned.start,
+                              planned.size, planned.label, planned.index)
+        self.plans.append(plan)
+
+    def describe(self):
+        """A list of lines describing the recorded verbs."""
+        return ['gpart %s %s %s' % (verb, name,
+                                    ' '.join(str(arg) for arg in args
+                                             if arg is not None))
+                for name, verb, args in self.ops]
+
+    def queue(self, txn):
+        """Queue the recorded verbs to a geom.PartTransaction."""
+        for name, verb, args in self.ops:
+            getattr(txn, verb)(name, *args)
+
+    def apply(self, txn=None, workers=None):
+        """Replay the recorded verbs as a single transaction, leaving them
+        uncommitted like the editor's. Returns the failed disks like
+        PartTransaction.execute()."""
+        if txn is None:
+            txn = geom.PartTransaction()
+        self.queue(txn)
+        self.ops = []
+        return txn.execute(workers)
+
+# Automatic layouts
+
+GiB = 1024*1024*1024
+
+# boot code for a partition table and its freebsd-boot partition per scheme
+BOOTCODE = {
+    'GPT': ('/boot/pmbr', '/boot/gptboot'),
+    'MBR': ('/boot/mbr',  '/boot/boot'),
+}
+
+class PlanError(Exception):
+    """Raised when a layout does not fit onto the disks."""
+    pass
+
+def physical_memory():
+    """The amount of RAM in bytes, or 0 if it cannot be determined."""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError):
+        return 0
+
+def scheme_bounds(scheme, sectors, sectorsize):
+    """The (first, last) usable sectors gpart will report for a new table
+    of a scheme on a disk of the given number of sectors."""
+    if scheme == 'GPT':
+        # protective MBR and header, and the entry array on both ends
+        entries = -(-geom.PART_SCHEMES['GPT'] * 128 // sectorsize)
+        return (2 + entries, sectors - 2 - entries)
+    if scheme == 'MBR':
+        # one track, and 32 bit sector numbers
+        return (63, min(sectors, 0xffffffff) - 1)
+    if scheme == 'BSD':
+        return (8192 // sectorsize, sectors - 1)
+    raise PlanError(L('unsupported scheme: %s') % scheme)
+
+class LayoutEntry(object):
+    """A partition of a LayoutProfile. Its size is either fixed (size), a
+    multiple of the RAM (memory) or a share of the space left once every
+    entry got its base size (ratio). minimum and maximum (None for no
+    limit) clamp the result, sizes are in bytes.
+    Entries with disk='boot' go onto the first disk, with disk='any' onto
+    the one with the most space left. mount is the fstab mount point, eg.
+    'swap' or '/var', or None."""
+    # pylint: disable=too-many-arguments
+    # pylint: disable=too-many-instance-attributes
+    __slots__ = ('mount', 'type', 'size', 'ratio', 'memory', 'minimum',
+                 'maximum', 'disk', 'label')
+
+    def __init__(self, mount, type_, size=0, ratio=0, memory=0, minimum=0,
+                 maximum=None, disk='boot', label=None):
+        self.mount   = mount
+        self.type    = type_
+        self.size    = size
+        self.ratio   = ratio
+        self.memory  = memory
+        self.minimum = minimum
+        self.maximum = maximum
+        self.disk    = disk
+        self.label   = label
+
+    def base(self, ram):
+        """The size before the remaining space is shared out."""
+        if self.size:
+            size = self.size
+        else:
+            size = int(ram * self.memory)
+        size = max(size, self.minimum)
+        if self.maximum is not None:
+            size = min(size, self.maximum)
+        return size
+
+class LayoutProfile(object):
+    """A list of LayoutEntry objects in the order in which they are placed
+    on a disk, the partitioning scheme and the alignment boundary."""
+    def __init__(self, entries, scheme='GPT', boundary=None):
+        self.entries  = entries
+        self.scheme   = scheme
+        self.boundary = boundary or ALIGNMENT
+
+    def validate(self):
+        """Raise a PlanError for entries the scheme cannot hold."""
+        if self.scheme not in geom.PART_SCHEMES:
+            raise PlanError(L('unsupported scheme: %s') % self.scheme)
+        if len(self.entries) > geom.PART_SCHEMES[self.scheme]:
+            raise PlanError(L('%s supports at most %u partitions')
+                            % (self.scheme, geom.PART_SCHEMES[self.scheme]))
+        for ent in self.entries:
+            if not geom.partition_type_known(self.scheme, ent.type):
+                raise PlanError(L('invalid type for %s: %s')
+                                % (self.scheme, ent.type))
+            if ent.disk not in ('boot', 'any'):
+                raise PlanError(L('invalid disk for %s: %s')
+                                % (ent.mount or ent.type, ent.disk))
+
+# boot, swap of the size of the RAM and ufs for /, /var and /home
+DEFAULT_PROFILE = LayoutProfile([
+    LayoutEntry(None,    'freebsd-boot', size=512*1024),
+    LayoutEntry('swap',  'freebsd-swap', memory=1,
+                minimum=1*GiB, maximum=16*GiB),
+    LayoutEntry('/',     'freebsd-ufs',  ratio=1,
+                minimum=8*GiB, maximum=64*GiB),
+    LayoutEntry('/var',  'freebsd-ufs',  ratio=1,
+                minimum=2*GiB, maximum=32*GiB),
+    LayoutEntry('/home', 'freebsd-ufs',  ratio=4,
+                minimum=1*GiB, disk='any'),
+])
+
+class PlannedPartition(object):
+    """A partition to be created by a Plan, start and size in sectors."""
+    # pylint: disable=too-many-arguments
+    __slots__ = ('disk', 'index', 'type', 'start', 'size', 'mount',
+                 'label')
+
+    def __init__(self, disk, index, type_, start, size, mount, label):
+        self.disk  = disk
+        self.index = index
+        self.type  = type_
+        self.start = start
+        self.size  = size
+        self.mount = mount
+        self.label = label
+
+    def name(self, scheme):
+        """The provider name gpart will use for the partition."""
+        return partition_name(self.disk, scheme, self.index)
+
+class DiskPlan(object):
+    """The partitions planned for one disk. create tells whether the table
+    has to be created first, table is a PartitionTable containing the
+    planned partitions."""
+    def __init__(self, table, create):
+        self.table      = table
+        self.create     = create
+        self.partitions = []
+
+    @property
+    def name(self):
+        return self.table.name
+
+    def place(self, entry, size, grid, rest=False):
+        """Place a partition of size bytes after the last one, or with rest
+        all the space after it."""
+        table  = self.table
+        sector = table.sectorsize
+        cursor = table.first
+        if len(self.partitions):
+            last   = self.partitions[-1]
+            cursor = last.start + last.size
+        sectors = -(-size // sector)
+        if sectors * sector >= grid.grain:
+            step    = grid.grain // sector
+            sectors = -(-sectors // step) * step
+        if rest:
+            sectors = table.last - cursor + 1
+        placed = allocate(table, cursor, sectors, grid.grain)
+        if placed is None or placed[1] <= 0:
+            raise PlanError(L('%s: no space left for %s')
+                            % (table.name, entry.mount or entry.type))
+        start, sectors = placed
+        index = len(self.partitions) + 1
+        planned = PlannedPartition(table.name, index, entry.type, start,
+                                   sectors, entry.mount, entry.label)
+        self.partitions.append(planned)
+        table.add(Partition(table, planned.name(table.scheme),
+                            sectors * sector, sector, entry.type,
+                            entry.type, start, start + sectors - 1, index,
+                            entry.label))
+
+class Plan(object):
+    """A computed layout for a set of disks, see plan_layout(). Nothing is
+    done to the disks until apply() is called."""
+    def __init__(self, profile, disks):
+        self.profile = profile
+        self.disks   = disks
+
+    def partitions(self):
+        """Iterate over (DiskPlan, PlannedPartition) tuples."""
+        for disk in self.disks:
+            for planned in disk.partitions:
+                yield disk, planned
+
+    def fstab(self, skip=()):
+        """The fstab entries of the planned partitions in the format of
+        the installer's setup['fstab'], leaving out the disks in skip."""
+        result = {}
+        for disk, planned in self.partitions():
+            if planned.mount is not None and disk.name not in skip:
+                result[planned.name(disk.table.scheme)] = {
+                    'mount': planned.mount
+                }
+        return result
+
+    def bootcode(self, skip=()):
+        """The boot code for the disks and their freebsd-boot partitions
+        in the format of the installer's setup['bootcode'], leaving out the
+        disks in skip."""
+        result = {}
+        for disk, planned in self.partitions():
+            codes = BOOTCODE.get(disk.table.scheme, None)
+            if (codes is None or planned.type != 'freebsd-boot' or
+                disk.name in skip):
+                continue
+            result[disk.name] = codes[0]
+            result[planned.name(disk.table.scheme)] = codes[1]
+        return result
+
+    def describe(self):
+        """A list of lines describing the plan."""
+        lines = []
+        for disk, planned in self.partitions():
+            lines.append('%-10s %-14s %10s  %s'
+                         % (planned.name(disk.table.scheme), planned.type,
+                            bytes2str(planned.size * disk.table.sectorsize),
+                            planned.mount or ''))
+        return lines
+
+    def queue(self, txn):
+        """Queue the gpart verbs to a geom.PartTransaction."""
+        for disk in self.disks:
+            if disk.create:
+                txn.create(disk.name, disk.table.scheme)
+            for planned in disk.partitions:
+                txn.add(disk.name, planned.type, start=planned.start,
+                        size=planned.size, label=planned.label,
+                        index=planned.index)
+
+    def provision(self, txn=None, workers=None):
+        """Issue the whole plan as a single transaction, the disks in
+        parallel. Yields the geom.PartEvent objects of
+        PartTransaction.run(), the failures end up in txn.failed. The
+        changes are left uncommitted like the editor's."""
+        if txn is None:
+            txn = geom.PartTransaction()
+        self.queue(txn)
+        return txn.run(workers)
+
+    def apply(self, txn=None, workers=None):
+        """Like provision() but only returns the dictionary of failed disks
+        from PartTransaction.execute()."""
+        if txn is None:
+            txn = geom.PartTransaction()
+        self.queue(txn)
+        return txn.execute(workers)
+
+def _candidates(inventory, scheme):
+    """name -> (PartitionTable, create) for the disks a layout can be
+    planned on: unused disks and empty tables of the scheme."""
+    result = {}
+    for provider in inventory.unused:
+        sector = max(provider.sectorsize, 1)
+        sectors = provider.mediasize // sector
+        first, last = scheme_bounds(scheme, sectors, sector)
+        result[provider.name] = (PartitionTable(provider.name, scheme,
+                                                first, last,
+                                                provider.mediasize, sector,
+                                                provider.stripesize,
+                                                provider.stripeoffset),
+                                 True)
+    for table in inventory.tables:
+        if len(table.partitions) or table.scheme != scheme:
+            continue
+        result[table.name] = (PartitionTable(table.name, scheme,
+                                             table.first, table.last,
+                                             table.size, table.sectorsize,
+                                             table.stripesize,
+                                             table.stripeoffset),
+                              False)
+    return result
+
+def _share(entries, bases, space):
+    """Distribute space among the ratio entries, honoring their maximum.
+    Updates and returns bases."""
+    open_ = [i for i, ent in enumerate(entries) if ent.ratio > 0]
+    while space > 0 and len(open_):
+        total = sum(entries[i].ratio for i in open_)
+        capped = []
+        given  = 0
+        for i in open_:
+            ent  = entries[i]
+            more = space * ent.ratio // total
+            if ent.maximum is not None and bases[i] + more >= ent.maximum:
+                more = max(0, ent.maximum - bases[i])
+                capped.append(i)
+            bases[i] += more
+            given    += more
+        space -= given
+        if not len(capped):
+            break
+        open_ = [i for i in open_ if i not in capped]
+    return bases
+
+def plan_layout(inventory, profile=None, disks=None, memory=None):
+    """Compute a Plan for a LayoutProfile (by default DEFAULT_PROFILE) on
+    the disks of an Inventory. disks is a list of names, by default every
+    unused disk and empty partition table in name order; the first one is
+    the boot disk. memory defaults to physical_memory().
+    Entries are first given their base size, then the space left on each
+    disk is shared out by ratio. The last partition of a disk whose
+    entry has a ratio and no maximum takes whatever is left at its end.
+    Raises a PlanError when the layout does not fit."""
+    # pylint: disable=too-many-locals
+    if profile is None:
+        profile = DEFAULT_PROFILE
+    if memory is None:
+        memory = physical_memory()
+    profile.validate()
+
+    candidates = _candidates(inventory, profile.scheme)
+    if disks is None:
+        disks = sorted(candidates)
+    if not len(disks):
+        raise PlanError(L('no unused disks'))
+    for name in disks:
+        if name not in candidates:
+            raise PlanError(L('%s is not an unused disk') % name)
+
+    tables = [candidates[name][0] for name in disks]
+    grids  = [Alignment.for_table(table, profile.boundary)
+              for table in tables]
+    # usable bytes, each partition is charged one grain for the alignment
+    free   = [(table.last - grid.up(table.first) + 1) * table.sectorsize
+              for table, grid in zip(tables, grids)]
+    bases  = [entry.base(memory) for entry in profile.entries]
+
+    assigned = [[] for _ in disks]
+    for i, entry in enumerate(profile.entries):
+        if entry.disk == 'boot':
+            assigned[0].append(i)
+            free[0] -= bases[i] + grids[0].grain
+    order = [i for i, entry in enumerate(profile.entries)
+             if entry.disk == 'any']
+    order.sort(key=lambda i: -bases[i])
+    for i in order:
+        best = max(range(len(disks)), key=lambda d: (free[d], -d))
+        assigned[best].append(i)
+        free[best] -= bases[i] + grids[best].grain
+
+    plans = []
+    for num, name in enumerate(disks):
+        if not len(assigned[num]):
+            continue
+        table = tables[num]
+        if free[num] < 0:
+            # what the check compares: the space left after alignment
+            need = sum(bases[i] for i in assigned[num])
+            raise PlanError(L('%s: %s needed, %s available')
+                            % (name, bytes2str(need),
+                               bytes2str(max(0, free[num] + need))))
+        indices = sorted(assigned[num])
+        entries = [profile.entries[i] for i in indices]
+        sizes   = _share(entries, [bases[i] for i in indices], free[num])
+        disk    = DiskPlan(table, candidates[name][1])
+        for pos, entry in enumerate(entries):
+            rest = (pos == len(entries) - 1 and entry.ratio > 0 and
+                    entry.maximum is None)
+            disk.place(entry, sizes[pos], grids[num], rest)
+        plans.append(disk)
+    return Plan(profile, plans)
+
+# ZFS pool layouts
+
+# vfs.zfs.min_auto_ashift
+MIN_ASHIFT = 12
+MAX_RAIDZ_WIDTH = 12
+
+CAMCONTROL_BUS    = re.compile(r'^(scbus\d+) on (\S+)')
+CAMCONTROL_DEVICE = re.compile(r'at (scbus\d+) target .*\((.*)\)\s*$')
+
+def cam_controllers():
+    """Map disk names to the name of the controller (the SIM, eg. ahcich0
+    or mps0) they are attached to, from camcontrol devlist -v. Returns an
+    empty dictionary if camcontrol is not available."""
+    try:
+        out = subprocess.check_output(['camcontrol', 'devlist', '-v'],
+                                      stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return {}
+    buses  = {}
+    result = {}
+    for line in out.decode('utf-8', 'replace').splitlines():
+        match = CAMCONTROL_BUS.match(line)
+        if match is not None:
+            buses[match.group(1)] = match.group(2)
+            continue
+        match = CAMCONTROL_DEVICE.search(line)
+        if match is None:
+            continue
+        for name in match.group(2).split(','):
+            if not name.startswith('pass'):
+                result[name] = buses.get(match.group(1), match.group(1))
+    return result
+
+class PoolDisk(object):
+    """A disk considered by plan_pool(). rotational is None when unknown,
+    controller is None when all disks are considered to be on the same
+    one."""
+    # pylint: disable=too-many-arguments
+    __slots__ = ('name', 'mediasize', 'sectorsize', 'stripesize',
+                 'rotational', 'controller')
+
+    def __init__(self, name, mediasize, sectorsize=512, stripesize=0,
+                 rotational=None, controller=None):
+        self.name       = name
+        self.mediasize  = mediasize
+        self.sectorsize = sectorsize
+        self.stripesize = stripesize
+        self.rotational = rotational
+        self.controller = controller
+
+    def ashift(self, minimum=MIN_ASHIFT):
+        """log2 of the physical sector size, at least minimum."""
+        physical = max(self.sectorsize, self.stripesize, 1)
+        return max(minimum, (physical - 1).bit_length())
+
+    @staticmethod
+    def from_provider(provider, controllers=None):
+        """Create a PoolDisk from an unused provider of part.load(). The
+        rotationrate config entry of disks is 0 for non-rotating media."""
+        rate = provider.cfg_str('rotationrate', None)
+        rotational = None
+        if rate is not None and rate.isdigit():
+            rotational = int(rate) != 0
+        controller = None
+        if controllers is not None:
+            controller = controllers.get(provider.name, None)
+        return PoolDisk(provider.name, provider.mediasize,
+                        provider.sectorsize, provider.stripesize,
+                        rotational, controller)
+
+def pool_disks(inventory, controllers=None):
+    """PoolDisk objects for the unused disks of an Inventory. controllers
+    maps disk names to controllers, by default from cam_controllers()."""
+    if controllers is None:
+        controllers = cam_controllers()
+    return [PoolDisk.from_provider(provider, controllers)
+            for provider in inventory.unused]
+
+class PlannedVDev(object):
+    """A top-level vdev of a PoolPlan: type_ is 'disk', 'mirror' or
+    'raidz', disks a list of PoolDisk objects."""
+    def __init__(self, type_, disks, parity, ashift):
+        self.type   = type_
+        self.disks  = disks
+        self.parity = parity
+        self.ashift = ashift
+
+    @property
+    def name(self):
+        if self.type == 'raidz':
+            return 'raidz%u' % self.parity
+        return self.type
+
+    def capacity(self):
+        """Usable bytes, not accounting for raidz padding and metadata."""
+        smallest = min(disk.mediasize for disk in self.disks)
+        if self.type == 'mirror':
+            return smallest
+        return smallest * (len(self.disks) - self.parity)
+
+    def spread(self):
+        """The largest number of disks sharing a controller."""
+        counts = {}
+        for disk in self.disks:
+            counts[disk.controller] = counts.get(disk.controller, 0) + 1
+        return max(counts.values())
+
+    def config(self):
+        """The vdev's part of an nvroot dictionary."""
+        leaves = [{'type': 'disk', 'path': device_path(disk.name),
+                   'ashift': self.ashift}
+                  for disk in self.disks]
+        if self.type == 'disk':
+            leaf = leaves[0]
+            leaf['is_log'] = 0
+            return leaf
+        config = {'type': self.type, 'is_log': 0, 'children': leaves}
+        if self.type == 'raidz':
+            config['nparity'] = self.parity
+        return config
+
+class PoolPlan(object):
+    """The vdevs and spares proposed by plan_pool(), and the disks which
+    were left out."""
+    def __init__(self, vdevs, spares, unused=None):
+        self.vdevs  = vdevs
+        self.spares = spares
+        self.unused = unused or []
+
+    def capacity(self):
+        return sum(vdev.capacity() for vdev in self.vdevs)
+
+    def spread(self):
+        """The largest number of disks of a vdev sharing a controller."""
+        return max([vdev.spread() for vdev in self.vdevs] or [0])
+
+    def nvroot(self):
+        """The vdev specification for zpool_create() as a dictionary, see
+        geom.zfs.dict_to_nvlist() and geom.zfs.create_pool()."""
+        root = {'type': 'root',
+                'children': [vdev.config() for vdev in self.vdevs]}
+        if len(self.spares):
+            root['spares'] = [{'type': 'disk', 'path': device_path(disk.name)}
+                              for disk in self.spares]
+        return root
+
+    def describe(self):
+        """A list of lines describing the plan."""
+        lines = []
+        for vdev in self.vdevs:
+            lines.append('%-8s ashift=%u %8s  %s'
+                         % (vdev.name, vdev.ashift,
+                            bytes2str(vdev.capacity()),
+                            ' '.join(disk.name for disk in vdev.disks)))
+        for title, disks in (('spares', self.spares),
+                             ('unused', self.unused)):
+            if len(disks):
+                lines.append('%-8s %s' % (title, ' '.join(disk.name
+                                                         for disk in disks)))
+        return lines
+
+def _pool_layouts(redundancy, count, layouts, max_width):
+    """The (type, width, parity) candidates for a redundancy level."""
+    result = []
+    if redundancy == 0:
+        if 'disk' in layouts:
+            result.append(('disk', 1, 0))
+        return result
+    if 'mirror' in layouts and count >= redundancy + 1:
+        result.append(('mirror', redundancy + 1, redundancy))
+    if 'raidz' in layouts and redundancy <= 3:
+        for width in range(redundancy + 2, min(max_width, count) + 1):
+            result.append(('raidz', width, redundancy))
+    return result
+
+def _deal(disks, count):
+    """Distribute disks onto count groups so the disks of each controller
+    are spread as evenly as possible."""
+    by_ctl = {}
+    for disk in disks:
+        by_ctl.setdefault(disk.controller, []).append(disk)
+    order = sorted(by_ctl.values(), key=lambda lst: -len(lst))
+    groups = [[] for _ in range(count)]
+    pos = 0
+    for lst in order:
+        for disk in lst:
+            groups[pos % count].append(disk)
+            pos += 1
+    return groups
+
+def _group(disks, width):
+    """Split disks sorted by size into groups of width disks. The groups
+    are cut in size order, which maximizes the sum of their smallest
+    members, and the disks of groups whose smallest members are of equal
+    size are then dealt out again to spread them across controllers."""
+    groups = [disks[i:i+width] for i in range(0, len(disks), width)]
+    result = []
+    idx = 0
+    while idx < len(groups):
+        smallest = groups[idx][-1].mediasize
+        end = idx + 1
+        while end < len(groups) and groups[end][-1].mediasize == smallest:
+            end += 1
+        members = [disk for grp in groups[idx:end] for disk in grp]
+        result.extend(_deal(members, end - idx))
+        idx = end
+    return result
+
+def _plan_media(disks, redundancy, layouts, spares, min_ashift, max_width):
+    """plan_pool() for disks of the same kind of media, returns None if
+    there are not enough of them."""
+    # pylint: disable=too-many-arguments
+    # pylint: disable=too-many-locals
+    disks = sorted(disks, key=lambda disk: (-disk.mediasize, disk.name))
+    reserved = disks[:spares]
+    disks    = disks[spares:]
+
+    best = None
+    for type_, width, parity in _pool_layouts(redundancy, len(disks),
+                                              layouts, max_width):
+        count = len(disks) // width
+        if not count:
+            continue
+        vdevs = [PlannedVDev(type_, grp, parity,
+                             max(disk.ashift(min_ashift) for disk in grp))
+                 for grp in _group(disks[:count * width], width)]
+        # left over disks only make sense as spares if they are big enough
+        # to replace any member
+        needed = max(min(disk.mediasize for disk in vdev.disks)
+                     for vdev in vdevs)
+        left   = disks[count * width:]
+        plan   = PoolPlan(vdevs,
+                          reserved + [disk for disk in left
+                                      if redundancy and
+                                      disk.mediasize >= needed],
+                          [disk for disk in left
+                           if not redundancy or disk.mediasize < needed])
+        key = (plan.capacity(), -width)
+        if best is None or key > best[0]:
+            best = (key, plan)
+    return best[1] if best is not None else None
+
+def plan_pool(disks, redundancy=1, layouts=('disk', 'mirror', 'raidz'),
+              spares=0, min_ashift=MIN_ASHIFT, max_width=MAX_RAIDZ_WIDTH):
+    """Propose the top-level vdevs for a pool of PoolDisk objects which
+    survives the failure of redundancy disks in every vdev.
+
+    All mirror widths and raidz widths up to max_width allowed by layouts
+    are tried, each grouping the disks in size order; the one with the
+    largest usable capacity wins, narrower vdevs win ties. The largest
+    spares disks are set aside as spares, disks which do not fill a whole
+    vdev become spares too if they are large enough. Rotating and
+    non-rotating disks are not mixed, the kind of media which gives the
+    larger pool is used and the other disks are left unused. The ashift
+    of each vdev is that of its member with the largest physical sectors.
+    Raises a PlanError when there are not enough disks."""
+    # pylint: disable=too-many-arguments
+    media = {}
+    for disk in disks:
+        media.setdefault(disk.rotational is False, []).append(disk)
+    best = None
+    for members in media.values():
+        plan = _plan_media(members, redundancy, layouts, spares, min_ashift,
+                           max_width)
+        if plan is None:
+            continue
+        plan.unused.extend(disk for disk in disks if disk not in members)
+        if best is None or plan.capacity() > best.capacity():
+            best = plan
+    if best is None:
+        raise PlanError(L('not enough disks for redundancy %u')
+                        % redundancy)
+    return best
+
 __all__ = ['find_cfg',
            'Partition',
            'PartitionTable',
+           'ALIGNMENT',
+           'Alignment',
+           'allocate',
+           'misaligned',
+           'VDev',
+           'ZPool',
+           'Inventory',
+           'InventoryCache',
+           'InventoryDiff',
+           'diff',
+           'generation',
+           'device_map',
+           'load_zpools',
            'load',
+           'errstr',
            'bytes2str',
            'str2bytes',
            'create_partition',
            'delete_partition',
            'create_partition_table',
            'destroy_partition_table',
+           'partition_name',
+           'DraftDisk',
+           'Draft',
+           'BOOTCODE',
+           'PlanError',
+           'physical_memory',
+           'scheme_bounds',
+           'LayoutEntry',
+           'LayoutProfile',
+           'DEFAULT_PROFILE',
+           'PlannedPartition',
+           'DiskPlan',
+           'Plan',
+           'plan_layout',
+           'MIN_ASHIFT',
+           'MAX_RAIDZ_WIDTH',
+           'cam_controllers',
+           'PoolDisk',
+           'pool_disks',
+           'PlannedVDev',
+           'PoolPlan',
+           'plan_pool',
           ]
@@ -0,0 +1,229 @@
+"""
+Free space checks for the package installation.
+
+Before downloading anything the download and installed sizes of the
+packages from the sync database are compared against the space available
+on the target mounts. Once the packages are downloaded their installed
+size is split across the target mounts by the directories the files in the
+archives go to. While pacman runs a CapacityMonitor samples the free space
+and interrupts pacman as soon as what is left to be written no longer fits.
+"""
+
+import os
+import re
+import signal
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from geom import util
+from . import part
+
+import gettext
+L = gettext.gettext
+
+# slack for the package database, logs and file system overhead
+RESERVE_FRACTION = 0.05
+RESERVE_BYTES    = 64*1024*1024
+
+INTERVAL = 1.0
+
+# how long pacman gets to roll back and release its lock after SIGINT
+STOP_TIMEOUT = 60.0
+
+MAX_WORKERS = 4
+
+UNITS = {'B': 1, 'KiB': 1024, 'MiB': 1024**2, 'GiB': 1024**3,
+         'TiB': 1024**4}
+
+SIZE_FIELD = re.compile(r'^(Download|Installed) Size\s*:'
+                        r'\s*([0-9.,]+)\s*(\S+)')
+NAME_FIELD = re.compile(r'^Name\s*:\s*(\S+)')
+
+def parse_size(value, unit):
+    """Parse a size as printed by pacman, eg. 12.50 MiB"""
+    return int(float(value.replace(',', '.')) * UNITS.get(unit, 1))
+
+def package_sizes(pacman, packages):
+    """Resolve the targets (including groups and dependencies) using the
+    sync database and sum up their sizes. pacman is the base command line
+    (eg. including --root). Returns a (download, installed) tuple.
+    Packages found in several repositories are counted once, like pacman
+    only installs the one from the first repository."""
+    env = dict(os.environ, LC_ALL='C')
+    names = subprocess.check_output(pacman + ['-Sp', '--print-format', '%n']
+                                    + packages, env=env)
+    names = names.decode('utf-8').split()
+    download  = 0
+    installed = 0
+    if not len(names):
+        return (download, installed)
+    info = subprocess.check_output(pacman + ['-Si'] + names, env=env)
+    seen = set()
+    skip = False
+    for line in info.decode('utf-8').splitlines():
+        match = NAME_FIELD.match(line)
+        if match is not None:
+            skip = match.group(1) in seen
+            seen.add(match.group(1))
+            continue
+        match = SIZE_FIELD.match(line)
+        if match is None or skip:
+            continue
+        size = parse_size(match.group(2), match.group(3))
+        if match.group(1) == 'Download':
+            download += size
+        else:
+            installed += size
+    return (download, installed)
+
+def package_archives(pacman, packages, cache):
+    """The paths of the package files of the targets in the cache
+    directory, which exist after pacman -Sw."""
+    env = dict(os.environ, LC_ALL='C')
+    urls = subprocess.check_output(pacman + ['-Sp', '--print-format', '%l']
+                                   + packages, env=env)
+    return [os.path.join(cache, os.path.basename(url))
+            for url in urls.decode('utf-8').split()]
+
+def archive_sizes(archive):
+    """The sizes of the files of a package archive by their directory,
+    using bsdtar which understands all the compression formats pacman
+    uses. The package's metadata files (.PKGINFO etc.) are skipped."""
+    out = subprocess.check_output(['bsdtar', '-tvf', archive],
+                                  env=dict(os.environ, LC_ALL='C'))
+    sizes = {}
+    for line in out.decode('utf-8', 'replace').splitlines():
+        # mode links owner group size month day time/year path
+        fields = line.split(None, 8)
+        if len(fields) < 9 or not fields[0].startswith('-'):
+            continue
+        path = fields[8]
+        if path.startswith('.'):
+            continue
+        directory = os.path.dirname(path)
+        sizes[directory] = sizes.get(directory, 0) + int(fields[4])
+    return sizes
+
+def installed_paths(root, archives, workers=None):
+    """(path, size) tuples of the directories below root the archives
+    install to, for requirements(). The archives are read in parallel."""
+    totals = {}
+    with ThreadPoolExecutor(max_workers=workers or MAX_WORKERS) as pool:
+        for sizes in pool.map(archive_sizes, archives):
+            for directory, size in sizes.items():
+                totals[directory] = totals.get(directory, 0) + size
+    return [(os.path.join(root, directory), size)
+            for directory, size in sorted(totals.items())]
+
+def reserve(size):
+    """The space to keep free on top of size."""
+    return int(size * RESERVE_FRACTION) + RESERVE_BYTES
+
+def requirements(mounts, paths):
+    """Sum up the bytes needed per mount point. paths is a list of
+    (path, size) tuples, mounts a geom.util.MountTable."""
+    needed = {}
+    for path, size in paths:
+        mnt = mounts.containing(path)
+        target = mnt.target if mnt is not None else '/'
+        needed[target] = needed.get(target, 0) + size
+    return needed
+
+def shortfalls(needed, statfs=util.statfs):
+    """Compare the needed bytes per mount point against what is available.
+    Returns a list of (target, needed, available) tuples."""
+    short = []
+    for target, size in sorted(needed.items()):
+        available = statfs(target).available
+        if size + reserve(size) > available:
+            short.append((target, size, available))
+    return short
+
+def describe(short):
+    """Human readable report of shortfalls."""
+    return '\n'.join(L('%s: %s needed, %s available') %
+                     (target, part.bytes2str(size), part.bytes2str(available))
+                     for target, size, available in short)
+
+class CapacityMonitor(threading.Thread):
+    """Samples the free space of the target mounts while something writes
+    the expected amounts to them. When the remaining expected writes on a
+    mount exceed its available space, abort() is called once and the
+    shortfall is stored in self.short (see describe())."""
+
+    def __init__(self, needed, abort, statfs=util.statfs, interval=INTERVAL):
+        threading.Thread.__init__(self, daemon=True)
+        self.needed   = needed
+        self.abort    = abort
+        self.statfs   = statfs
+        self.interval = interval
+        self.stopped  = threading.Event()
+        self.short    = []
+        self.start_available = dict((target, statfs(target).available)
+                                    for target in needed)
+
+    def check(self):
+        """Take one sample, returns the current shortfalls."""
+        short = []
+        for target, size in self.needed.items():
+            available = self.statfs(target).available
+            written   = max(0, self.start_available[target] - available)
+            remaining = max(0, size - written)
+            if remaining > available:
+                short.append((target, remaining, available))
+        return short
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            short = self.check()
+            if len(short):
+                self.short = short
+                self.abort()
+                return
+
+    def stop(self):
+        """Stop sampling and wait for the thread."""
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+
+def stop(proc, timeout=STOP_TIMEOUT):
+    """Interrupt a process like ^C does and wait for it to exit. pacman
+    then rolls back the current transaction and removes its lock file.
+    Only if it does not exit in time it is terminated."""
+    if proc.poll() is not None:
+        return
+    proc.send_signal(signal.SIGINT)
+    try:
+        proc.wait(timeout)
+    except subprocess.TimeoutExpired:
+        proc.terminate()
+
+def run_monitored(command, needed, statfs=util.statfs, interval=INTERVAL):
+    """Run a command while monitoring the capacity of the targets. Returns
+    the exit status and the list of shortfalls which caused it to be
+    interrupted, if any."""
+    proc = subprocess.Popen(command)
+    monitor = CapacityMonitor(needed, lambda: stop(proc), statfs, interval)
+    monitor.start()
+    try:
+        status = proc.wait()
+    finally:
+        monitor.stop()
+    return (status, monitor.short)
+
+def remove_stale_lock(lockfile):
+    """Remove a pacman lock file left behind by a pacman which was killed.
+    Returns whether there was one. Only to be used when no pacman is
+    running on the same database."""
+    try:
+        os.unlink(lockfile)
+    except FileNotFoundError:
+        return False
+    return True
+
+__all__ = ['package_sizes', 'package_archives', 'archive_sizes',
+           'installed_paths', 'reserve', 'requirements', 'shortfalls',
+           'describe', 'CapacityMonitor', 'stop', 'run_monitored',
+           'remove_stale_lock']
@@ -0,0 +1,95 @@
+"""
+PartitionEditor tests against the simulated libgeom (geom.sim), without a
+curses window.
+"""
+
+import unittest
+
+from geom import geom, sim
+from ABSDInstaller import part, utils
+from ABSDInstaller.PartitionEditor import PartitionEditor
+
+class Stub(object):
+    """Attribute bag standing in for the curses window, list and app."""
+    # pylint: disable=too-few-public-methods
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+def make_editor():
+    """A PartitionEditor loaded from the current library."""
+    editor = PartitionEditor.__new__(PartitionEditor)
+    editor.win  = Stub(clear=lambda: None)
+    editor.draw = lambda: None
+    # there is no window to close when it is garbage collected
+    editor.close = lambda: None
+    editor.app  = Stub(fstab={}, bootcode={}, undone=lambda step: None)
+    editor.partlist = Stub(name='', userdata=0, entries=[],
+                           entry=lambda: editor.partlist.entries[0])
+    editor.inventory  = part.InventoryCache()
+    editor.shown      = None
+    editor.segments   = {}
+    editor.tables     = []
+    editor.unused     = []
+    editor.zpools     = []
+    editor.devices    = {}
+    editor.misaligned = {}
+    editor.draft      = None
+    editor._PartitionEditor__load() # pylint: disable=protected-access
+    return editor
+
+def shown_partitions(editor):
+    """The names of the partitions in the editor's list."""
+    return [data[1].name for _, data in editor.partlist.entries
+            if len(data) == 2]
+
+def shown_free(editor):
+    """The (start, size) tuples of the free space in the editor's list."""
+    return [data[1:] for _, data in editor.partlist.entries
+            if len(data) == 3]
+
+class EditorTest(unittest.TestCase):
+    def setUp(self):
+        self.lib = sim.SimLib()
+        self.lib.add_disk('ada0', 8 * 1024**3)
+        geom.use_library(self.lib)
+        txn = geom.PartTransaction()
+        txn.create('ada0', 'GPT')
+        for _ in range(3):
+            txn.add('ada0', 'freebsd-ufs', size=2048)
+        self.assertEqual(txn.execute(), {})
+        self.assertEqual(txn.commit(), {})
+        self.confirm = utils.no_yes
+        self.message = utils.message
+        utils.no_yes  = lambda app, title, text: True
+        utils.message = self.fail_message
+
+    def tearDown(self):
+        utils.no_yes  = self.confirm
+        utils.message = self.message
+        geom.geom_undo_all()
+
+    def fail_message(self, app, title, text):
+        # pylint: disable=unused-argument
+        self.fail('%s: %s' % (title, text))
+
+    def test_delete_partition(self):
+        editor = make_editor()
+        self.assertEqual(shown_partitions(editor),
+                         ['ada0p1', 'ada0p2', 'ada0p3'])
+        free = shown_free(editor)
+        table = editor.tables[0]
+        editor.part_delete(table, table.partitions[1])
+        self.assertEqual(shown_partitions(editor), ['ada0p1', 'ada0p3'])
+        # the free space of the deleted partition is shown instead
+        self.assertEqual(len(shown_free(editor)), len(free) + 1)
+
+    def test_delete_partition_dry_run(self):
+        editor = make_editor()
+        editor.toggle_draft()
+        table = editor.tables[0]
+        editor.part_delete(table, table.partitions[0])
+        self.assertEqual(shown_partitions(editor), ['ada0p2', 'ada0p3'])
+        self.assertEqual(geom.pending(), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,15 @@
+"""
+The shared libraries must only be opened when they are used, not when the
+installer's modules are imported.
+"""
+
+import unittest
+
+from bench import imports
+
+class ImportTest(unittest.TestCase):
+    def test_no_library_opened(self):
+        for module in imports.MODULES:
+            with self.subTest(module=module):
+                _, loaded = imports.measure_import(module, 1)
+                self.assertEqual(loaded, [])
@@ -0,0 +1,97 @@
+"""
+Tests of the mount ordering and the MountEngine with a RecordingMounter.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from geom import util
+from ABSDInstaller import mount
+
+def targets(wave_list):
+    return [[ent.target for ent in wave] for wave in wave_list]
+
+class StaticMounts(object):
+    """A mount table backend which never changes."""
+    def __init__(self, mounts):
+        self.mounts = mounts
+
+    def changed(self):
+        return False
+
+    def read(self):
+        return list(self.mounts)
+
+class WavesTest(unittest.TestCase):
+    def test_nested(self):
+        entries = [mount.Entry('ada0p4', '/mnt/usr/local'),
+                   mount.Entry('ada0p3', '/mnt/usr'),
+                   mount.Entry('ada0p2', '/mnt')]
+        self.assertEqual(targets(mount.waves(entries)),
+                         [['/mnt'], ['/mnt/usr'], ['/mnt/usr/local']])
+
+    def test_siblings(self):
+        entries = [mount.Entry('ada0p5', '/mnt/var/db'),
+                   mount.Entry('ada0p4', '/mnt/var'),
+                   mount.Entry('ada0p3', '/mnt/home'),
+                   mount.Entry('ada0p2', '/mnt')]
+        self.assertEqual(targets(mount.waves(entries)),
+                         [['/mnt'], ['/mnt/home', '/mnt/var'],
+                          ['/mnt/var/db']])
+
+    def test_skipped_level(self):
+        """Only mounted parents count, not the directories between."""
+        entries = [mount.Entry('ada0p3', '/mnt/usr/local/share'),
+                   mount.Entry('ada0p2', '/mnt')]
+        self.assertEqual(targets(mount.waves(entries)),
+                         [['/mnt'], ['/mnt/usr/local/share']])
+
+    def test_relative(self):
+        entries = [mount.Entry('ada0p3', 'usr/local'),
+                   mount.Entry('ada0p2', 'usr/'),
+                   mount.Entry('ada0p4', 'var')]
+        self.assertEqual(targets(mount.waves(entries)),
+                         [['usr', 'var'], ['usr/local']])
+
+class MountEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def entry(self, source, target):
+        return mount.Entry(source, os.path.join(self.root, target))
+
+    def test_mount_all(self):
+        mounter = mount.RecordingMounter()
+        entries = [self.entry('ada0p4', 'var/db'), self.entry('ada0p3', 'var'),
+                   self.entry('ada0p2', 'home')]
+        mount.MountEngine(mounter).mount_all(entries)
+        calls = [os.path.relpath(ent.target, self.root)
+                 for ent in mounter.calls]
+        self.assertEqual(sorted(calls[:2]), ['home', 'var'])
+        self.assertEqual(calls[2], 'var/db')
+        self.assertTrue(os.path.isdir(os.path.join(self.root, 'var/db')))
+
+    def test_failure(self):
+        """Nothing below a failed wave is mounted."""
+        mounter = mount.RecordingMounter(
+            fail=[os.path.join(self.root, 'var')])
+        entries = [self.entry('ada0p4', 'var/db'), self.entry('ada0p3', 'var'),
+                   self.entry('ada0p2', 'home')]
+        with self.assertRaises(mount.MountError) as ctx:
+            mount.MountEngine(mounter).mount_all(entries)
+        self.assertEqual([ent.target for ent, _ in ctx.exception.failed],
+                         [os.path.join(self.root, 'var')])
+        self.assertEqual(len(mounter.calls), 2)
+
+    def test_already_mounted(self):
+        mounter = mount.RecordingMounter()
+        mounts  = util.MountTable(StaticMounts([
+            ('/dev/ada0p3', os.path.join(self.root, 'var'), 'ufs')]))
+        entries = [self.entry('ada0p4', 'var/db'), self.entry('ada0p3', 'var')]
+        mount.MountEngine(mounter, mounts).mount_all(entries)
+        self.assertEqual([ent.source for ent in mounter.calls], ['ada0p4'])
@@ -0,0 +1,74 @@
+"""
+Tests of the partition helpers against the simulated libgeom (geom.sim).
+"""
+
+import unittest
+
+from geom import geom, sim
+from ABSDInstaller import part
+
+GiB = 1024**3
+
+class PartitionTypeTest(unittest.TestCase):
+    def setUp(self):
+        self.lib = sim.SimLib()
+        self.lib.add_disk('ada0', 8 * GiB)
+        geom.use_library(self.lib)
+        self.assertIsNone(part.create_partition_table(
+            part.load(zpools=[]).unused[0], 'GPT'))
+        self.table = part.load(zpools=[]).tables[0]
+
+    def tearDown(self):
+        geom.geom_undo_all()
+
+    def test_create_uncommon_type(self):
+        start = self.table.gaps()[0][0] * self.table.sectorsize
+        for type_ in ('apple-apfs', 'freebsd-nandfs'):
+            self.assertIsNone(part.create_partition(self.table, '', start,
+                                                    GiB, type_))
+            self.table = part.load(zpools=[]).tables[0]
+            start = self.table.gaps()[-1][0] * self.table.sectorsize
+
+    def test_draft_types(self):
+        draft = part.Draft(part.load(zpools=[]))
+        table = draft.tables[0]
+        start = table.first * table.sectorsize
+        self.assertEqual(draft.add(table, '', start, GiB, 'bogus'),
+                         'invalid type: bogus')
+        self.assertIsNone(draft.add(table, '', start, GiB, 'apple-apfs'))
+
+    def test_draft_other_scheme(self):
+        """Schemes without a type list or entry limit are left to gpart."""
+        table = part.PartitionTable('ada0s4', 'EBR', 63, 1024**2,
+                                    512 * 1024**2, 512)
+        inventory = part.Inventory([table], [], [])
+        draft = part.Draft(inventory)
+        table = draft.tables[0]
+        self.assertIsNone(draft.add(table, '', 63 * 512, 64 * 1024**2,
+                                    'freebsd'))
+        self.assertEqual(table.partitions[0].index, 1)
+
+class PlanLayoutTest(unittest.TestCase):
+    def setUp(self):
+        self.lib = sim.SimLib()
+        self.lib.add_disk('ada0', GiB)
+        geom.use_library(self.lib)
+
+    def tearDown(self):
+        geom.geom_undo_all()
+
+    def test_too_small(self):
+        """The error reports the space left after the alignment, which is
+        what the layout has to fit into."""
+        profile = part.LayoutProfile([
+            part.LayoutEntry(None, 'freebsd-boot', size=512 * 1024),
+            part.LayoutEntry('/', 'freebsd-ufs', size=2 * GiB)])
+        with self.assertRaises(part.PlanError) as ctx:
+            part.plan_layout(part.load(zpools=[]), profile, memory=0)
+        # the first MiB and the rest of the last MiB of the disk are lost
+        # to the alignment, and each partition is charged one more MiB
+        self.assertEqual(str(ctx.exception),
+                         'ada0: 2.0G needed, 1021.0M available')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+"""
+Tests of the free space checks which do not need pacman.
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from ABSDInstaller import space
+
+MiB = 1024**2
+
+SYNC_INFO = b"""Repository      : core
+Name            : zlib
+Download Size   : 1.00 MiB
+Installed Size  : 2.00 MiB
+
+Repository      : extra
+Name            : zlib
+Download Size   : 1.00 MiB
+Installed Size  : 2.00 MiB
+
+Repository      : core
+Name            : bash
+Download Size   : 3.00 MiB
+Installed Size  : 8.00 MiB
+"""
+
+ARCHIVE_LISTING = b"""\
+-rw-r--r--  0 root   wheel     512 Jan  1  2016 .PKGINFO
+drwxr-xr-x  0 root   wheel       0 Jan  1  2016 usr/
+-rwxr-xr-x  0 root   wheel    4096 Jan  1  2016 usr/bin/bash
+-rw-r--r--  0 root   wheel    1024 Jan  1  2016 usr/share/doc/bash/a b
+lrwxr-xr-x  0 root   wheel       0 Jan  1  2016 usr/bin/sh -> bash
+-rw-r--r--  0 root   wheel     100 Jan  1  2016 etc/bash.bashrc
+"""
+
+class PackageSizesTest(unittest.TestCase):
+    def test_duplicates(self):
+        def check_output(command, env=None):
+            if '-Si' in command:
+                return SYNC_INFO
+            return b'zlib\nbash\n'
+        with mock.patch.object(subprocess, 'check_output', check_output):
+            self.assertEqual(space.package_sizes(['pacman'], ['base']),
+                             (4 * MiB, 10 * MiB))
+
+    def test_archive_sizes(self):
+        with mock.patch.object(subprocess, 'check_output',
+                               lambda command, env=None: ARCHIVE_LISTING):
+            self.assertEqual(space.archive_sizes('bash.pkg.tar.xz'),
+                             {'usr/bin': 4096, 'usr/share/doc/bash': 1024,
+                              'etc': 100})
+
+class StopTest(unittest.TestCase):
+    def test_interrupt(self):
+        # the child needs SIGINT to exit cleanly, like pacman does
+        script = ('import signal, sys, time\n'
+                  'signal.signal(signal.SIGINT, lambda *a: sys.exit(3))\n'
+                  'print("ready", flush=True)\n'
+                  'time.sleep(60)\n')
+        proc = subprocess.Popen([sys.executable, '-c', script],
+                                stdout=subprocess.PIPE)
+        self.assertEqual(proc.stdout.readline(), b'ready\n')
+        space.stop(proc, timeout=10)
+        proc.stdout.close()
+        self.assertEqual(proc.returncode, 3)
+
+    def test_remove_stale_lock(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            lockfile = os.path.join(tmp, 'db.lck')
+            open(lockfile, 'w').close()
+            self.assertTrue(space.remove_stale_lock(lockfile))
+            self.assertFalse(space.remove_stale_lock(lockfile))
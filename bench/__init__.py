@@ -0,0 +1,111 @@
+"""
+Benchmarks for the installer's disk handling code.
+
+They run on any system by using the simulated libgeom in geom.sim, see
+bench.topology. bench.imports measures the startup cost of the modules.
+
+Results can be stored as JSON baselines. Later runs fail when a phase uses
+more memory than the baseline allows. Times of a few milliseconds vary too
+much between runs to fail on, phases which got slower are only reported
+unless --strict-time is given. To carry over between machines the times
+are compared relative to a fixed calibration loop timed in the same run.
+"""
+
+import gc
+import json
+import time
+import tracemalloc
+
+def measure(func, repeat=3):
+    """Time func() and record its peak memory usage. Returns the best time
+    of `repeat` runs in seconds (without garbage collection), the peak
+    memory in bytes of an additional traced run, and that run's result."""
+    best = None
+    for _ in range(repeat):
+        # like timeit, keep the garbage collector out of the timings
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            func()
+            took = time.perf_counter() - start
+        finally:
+            gc.enable()
+        if best is None or took < best:
+            best = took
+    tracemalloc.start()
+    try:
+        result = func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best, peak, result
+
+def _calibration_loop():
+    table = {}
+    for i in range(200000):
+        table[i % 1000] = table.get(i % 1000, 0) + i
+    return sorted(table.items())
+
+def calibrate(repeat=5):
+    """The best time in seconds of a fixed pure python workload, the unit
+    the phase times are normalized with."""
+    best, _, _ = measure(_calibration_loop, repeat)
+    return best
+
+def normalize(results, unit):
+    """Add the time relative to the calibration unit to each result."""
+    for result in results.values():
+        result['relative'] = result['time'] / unit
+    return results
+
+def load_baseline(path):
+    """Load a baseline file, returns an empty dict if it does not exist."""
+    try:
+        with open(path, 'r', encoding='utf-8') as jsonfile:
+            return json.load(jsonfile)
+    except OSError:
+        return {}
+
+def save_baseline(path, baseline):
+    with open(path, 'w', encoding='utf-8') as jsonfile:
+        json.dump(baseline, jsonfile, sort_keys=True,
+                  indent=4, separators=(',', ':'))
+        jsonfile.write('\n')
+
+def compare(results, baseline, tolerance, min_time=0.005):
+    """Compare a scenario's {phase: {'time': .., 'relative': ..,
+    'peak': ..}} results with its baseline, see normalize(). Returns a list
+    of messages about phases using more memory and a list of messages about
+    phases which got slower. Times below min_time seconds are considered
+    noise."""
+    regressions = []
+    slower      = []
+    for phase, result in sorted(results.items()):
+        base = baseline.get(phase, None)
+        if base is None:
+            continue
+        # the noise floor in the calibration units of the baseline
+        unit  = base['time'] / base['relative']
+        limit = max(base['relative'], min_time / unit) * tolerance
+        if result['relative'] > limit:
+            slower.append('%s: %.2f > %.2f units (baseline %.2f, '
+                               'now %.4fs)'
+                               % (phase, result['relative'], limit,
+                                  base['relative'], result['time']))
+        limit = base['peak'] * tolerance
+        if result['peak'] > limit:
+            regressions.append('%s: peak %u > %u bytes (baseline %u)'
+                               % (phase, result['peak'], limit,
+                                  base['peak']))
+    return regressions, slower
+
+def report(name, results):
+    """Print a scenario's results."""
+    print('%s:' % name)
+    for phase, result in sorted(results.items()):
+        print('  %-16s %10.4fs %8.2f units %12u bytes peak'
+              % (phase, result['time'], result['relative'], result['peak']))
+
+__all__ = ['measure', 'calibrate', 'normalize', 'load_baseline',
+           'save_baseline', 'compare', 'report']
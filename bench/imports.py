@@ -0,0 +1,100 @@
+"""
+Import time benchmark.
+
+Imports each module in a fresh interpreter and records the best time and
+the shared libraries which were opened during the import:
+
+    python3 -m bench.imports
+    python3 -m bench.imports --save       # store the results as baseline
+
+Exits with status 1 when importing a module opens a library, or with
+--strict-time when an import got slower than the baseline allows.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+from . import calibrate, normalize, load_baseline, save_baseline, compare
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+SCENARIO = 'imports'
+
+# what the installer imports on startup, the package __init__s are empty
+MODULES = ['geom.util', 'geom.geom', 'geom.zfs', 'ABSDInstaller.part',
+           'ABSDInstaller.PartitionEditor', 'ABSDInstaller.Installer']
+
+# run in the child interpreter
+PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+import %s
+took = time.perf_counter() - start
+from geom import util
+print(json.dumps({'time': took,
+                  'loaded': [lib.name for lib in util.libraries
+                             if lib.loaded]}))
+'''
+
+def measure_import(module, repeat):
+    """Returns the best import time and the libraries opened by it."""
+    best   = None
+    loaded = []
+    root   = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for _ in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c', PROBE % module],
+                                      cwd=root)
+        data = json.loads(out.decode('utf-8'))
+        if best is None or data['time'] < best:
+            best = data['time']
+        loaded = data['loaded']
+    return best, loaded
+
+def main(argv):
+    """command line entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat',    type=int,   default=5)
+    parser.add_argument('--tolerance', type=float, default=1.5)
+    parser.add_argument('--baseline',  default=BASELINE)
+    parser.add_argument('--strict-time', action='store_true',
+                        help='also fail when an import got slower')
+    parser.add_argument('--save',      action='store_true',
+                        help='store the results in the baseline file')
+    parser.add_argument('modules', nargs='*', default=MODULES)
+    args = parser.parse_args(argv)
+
+    results = {}
+    eager   = []
+    print('%s:' % SCENARIO)
+    for module in args.modules:
+        took, loaded = measure_import(module, args.repeat)
+        # the peak is not measured, compare() needs one though
+        results[module] = {'time': took, 'peak': 0}
+        print('  %-30s %10.4fs  libraries opened: %s'
+              % (module, took, ', '.join(loaded) or '-'))
+        if len(loaded):
+            eager.append('%s: opens %s' % (module, ', '.join(loaded)))
+
+    normalize(results, calibrate())
+    baseline = load_baseline(args.baseline)
+    if args.save:
+        baseline[SCENARIO] = results
+        save_baseline(args.baseline, baseline)
+        return 0
+    regressions = eager
+    if SCENARIO in baseline:
+        _, slower = compare(results, baseline[SCENARIO], args.tolerance,
+                            min_time=0.02)
+        for line in slower:
+            print('SLOWER %s' % line)
+        if args.strict_time:
+            regressions += slower
+    for line in regressions:
+        print('REGRESSION %s' % line)
+    return 1 if len(regressions) else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
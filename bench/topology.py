@@ -0,0 +1,213 @@
+"""
+Disk discovery benchmark on synthetic topologies.
+
+Builds N simulated disks with M partitions each, some ELI providers on top
+of partitions, RAID volumes made of disk pairs and zpools using the last
+partition of every disk, then times the phases of opening the partition
+editor:
+
+    python3 -m bench.topology --disks 1000 --partitions 8
+    python3 -m bench.topology --save       # store the results as baseline
+
+Exits with status 1 when a phase uses more memory than the baseline (times
+--tolerance), or with --strict-time when it is slower relative to the
+calibration loop, see bench.
+"""
+
+import argparse
+import os
+import sys
+
+from geom import geom, sim
+from ABSDInstaller import part
+from ABSDInstaller.PartitionEditor import PartitionEditor, misaligned_notes
+
+from . import (measure, calibrate, normalize, load_baseline, save_baseline,
+               compare, report)
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+GiB = 1024*1024*1024
+
+def build(disks, partitions, eli_every=4, raid_pairs=8, pool_count=4,
+          raidz_width=6):
+    """Create a geom.sim.SimLib with the synthetic topology and install it
+    as libgeom. Returns the list of part.ZPool objects to go with it."""
+    # pylint: disable=too-many-arguments
+    # pylint: disable=too-many-locals
+    lib = sim.SimLib()
+    geom.use_library(lib)
+
+    txn = geom.PartTransaction()
+    for i in range(disks):
+        name = 'da%u' % i
+        lib.add_disk(name, 4096*GiB, 4096 if i % 2 else 512, 4096)
+        txn.create(name, 'GPT')
+        txn.add(name, 'freebsd-boot', size=1024)
+        for _ in range(1, partitions-1):
+            txn.add(name, 'freebsd-ufs', size=1024*1024*16)
+        txn.add(name, 'freebsd-zfs')
+
+    for i in range(raid_pairs):
+        lower = ['ada%u' % (2*i), 'ada%u' % (2*i+1)]
+        for name in lower:
+            lib.add_disk(name, 1024*GiB)
+        volume = 'raid/r%u' % i
+        lib.add_layer('RAID', volume, lower)
+        txn.create(volume, 'GPT')
+        txn.add(volume, 'freebsd-ufs', size=1024*1024)
+        txn.add(volume, 'freebsd-swap')
+
+    errors = txn.execute()
+    errors.update(txn.commit())
+    if len(errors):
+        raise Exception('failed to build the topology: %r' % errors)
+
+    for i in range(0, disks, eli_every):
+        provider = sim.partition_name('da%u' % i, 'GPT', 2)
+        if partitions > 2:
+            lib.add_layer('ELI', provider + '.eli', [provider])
+
+    # zpools with raidz2 vdevs, a mirrored log and a spare
+    zpools = []
+    members = [sim.partition_name('da%u' % i, 'GPT', partitions)
+               for i in range(disks)]
+    per_pool = max(1, len(members) // max(1, pool_count))
+    for pool in range(pool_count):
+        devices = members[pool*per_pool:(pool+1)*per_pool]
+        if not len(devices):
+            break
+        vdevs = []
+        for vdev in range(0, len(devices), raidz_width):
+            leaves = [part.VDev('disk', name, path='/dev/' + name)
+                      for name in devices[vdev:vdev+raidz_width]]
+            vdevs.append(part.VDev('raidz', 'raidz2-%u' % len(vdevs),
+                                   children=leaves))
+        if len(devices) > 2:
+            leaves = [part.VDev('disk', name, 'log', path='/dev/' + name)
+                      for name in devices[-2:]]
+            vdevs.append(part.VDev('mirror', 'mirror-%u' % len(vdevs), 'log',
+                                   children=leaves))
+        zpools.append(part.ZPool('tank%u' % pool, vdevs))
+    return zpools
+
+class _Stub(object):
+    """Attribute container standing in for the UI parts of the editor."""
+    # pylint: disable=too-few-public-methods
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+def editor_for(inventory):
+    """A PartitionEditor without a curses window."""
+    editor = PartitionEditor.__new__(PartitionEditor)
+    editor.win = None
+    fstab = {}
+    for table in inventory.tables[:len(inventory.tables)//2]:
+        for par in table.partitions[1:3]:
+            fstab[par.name] = {'mount': '/data/%s' % par.name}
+    editor.app      = _Stub(fstab=fstab, bootcode={})
+    editor.partlist = _Stub(userdata=0)
+    editor.segments = {}
+    editor.tables, editor.unused, editor.zpools = inventory
+    editor.devices  = inventory.devices
+    editor.misaligned = misaligned_notes(inventory.tables)
+    return editor
+
+def phases(zpools):
+    """The benchmarked phases as (name, function) tuples."""
+    state = {}
+
+    def snapshot():
+        state['mesh'] = geom.snapshot()
+        return state['mesh']
+
+    def load():
+        state['inventory'] = part.load(state['mesh'], zpools)
+        return state['inventory']
+
+    def from_geom():
+        cls = state['mesh'].find_class('PART')
+        return [part.PartitionTable.from_geom(gobj) for gobj in cls.geoms()]
+
+    def class_used():
+        used = set()
+        for cls in state['mesh'].classes():
+            part.load_class_used(cls, used)
+        return used
+
+    def iterate():
+        editor = editor_for(state['inventory'])
+        # pylint: disable=protected-access
+        state['entries'] = list(editor._PartitionEditor__iterate())
+        state['editor']  = editor
+        return state['entries']
+
+    def render():
+        editor = state['editor']
+        return [ent.entry_text(editor, editor.partlist.userdata, 120, *data)
+                for ent, data in state['entries']]
+
+    def diff():
+        return part.diff(state['inventory'], part.load(state['mesh'], zpools))
+
+    return [('snapshot',        snapshot),
+            ('load',            load),
+            ('from_geom',       from_geom),
+            ('load_class_used', class_used),
+            ('iterate',         iterate),
+            ('render',          render),
+            ('diff',            diff)]
+
+def run(args):
+    """Build the topology and measure all phases."""
+    zpools  = build(args.disks, args.partitions, args.eli_every,
+                    args.raid_pairs, args.pools)
+    results = {}
+    for name, func in phases(zpools):
+        took, peak, _ = measure(func, args.repeat)
+        results[name] = {'time': took, 'peak': peak}
+    return normalize(results, calibrate())
+
+def main(argv):
+    """command line entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--disks',      type=int,   default=200)
+    parser.add_argument('--partitions', type=int,   default=8)
+    parser.add_argument('--eli-every',  type=int,   default=4)
+    parser.add_argument('--raid-pairs', type=int,   default=8)
+    parser.add_argument('--pools',      type=int,   default=4)
+    parser.add_argument('--repeat',     type=int,   default=5)
+    parser.add_argument('--tolerance',  type=float, default=1.5)
+    parser.add_argument('--baseline',   default=BASELINE)
+    parser.add_argument('--strict-time', action='store_true',
+                        help='also fail when a phase got slower')
+    parser.add_argument('--save',       action='store_true',
+                        help='store the results in the baseline file')
+    args = parser.parse_args(argv)
+
+    scenario = 'topology-d%u-p%u-e%u-r%u-z%u' % (args.disks, args.partitions,
+                                                 args.eli_every,
+                                                 args.raid_pairs, args.pools)
+    results  = run(args)
+    report(scenario, results)
+
+    baseline = load_baseline(args.baseline)
+    if args.save:
+        baseline[scenario] = results
+        save_baseline(args.baseline, baseline)
+        return 0
+    if scenario not in baseline:
+        print('no baseline for %s' % scenario)
+        return 0
+    regressions, slower = compare(results, baseline[scenario],
+                                  args.tolerance)
+    for line in slower:
+        print('SLOWER %s' % line)
+    if args.strict_time:
+        regressions += slower
+    for line in regressions:
+        print('REGRESSION %s' % line)
+    return 1 if len(regressions) else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
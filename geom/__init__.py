@@ -1 +1 @@
-__all__ = [ 'geom', 'zfs' ]
+__all__ = [ 'geom', 'zfs', 'graph', 'nvlist' ]
@@ -0,0 +1,185 @@
+"""
+Build geom snapshots from the kern.geom.confxml XML.
+
+This does not need libgeom, so it can be used on any system, for instance
+with a topology captured on a FreeBSD machine via:
+
+    python3 -m geom.confxml capture topology.xml
+
+The XML is parsed incrementally and every <geom> and <class> element is
+dropped once it was copied, so memory usage does not depend on the size of
+the XML.
+"""
+
+import subprocess
+import sys
+import xml.etree.ElementTree as ElementTree
+
+if __package__:
+    from . import snapshot as snap
+else:
+    import snapshot as snap
+
+SYSCTL = 'kern.geom.confxml'
+
+def _ident(elem, attr='id'):
+    """Parse an id or ref attribute (a hex pointer value)"""
+    value = elem.get(attr, None)
+    if value is None:
+        return None
+    return int(value, 16)
+
+def _int(value):
+    if value is None:
+        return 0
+    return int(value)
+
+class _Pending(object):
+    """An object whose fields are still being read. The snapshot objects are
+    created as soon as their parent is complete."""
+    # pylint: disable=too-few-public-methods
+    def __init__(self, tag, id_, parent):
+        self.tag     = tag
+        self.id      = id_
+        self.parent  = parent
+        self.fields  = {}
+        self.configs = []
+        self.ref     = None
+        self.obj     = None
+
+class _Builder(object):
+    """Turns iterparse events into snapshot objects."""
+    def __init__(self):
+        self.result    = snap.Snapshot()
+        self.stack     = []
+        self.in_config = False
+
+    def realize(self, pend):
+        """Create the snapshot object of a pending class or geom, needed as
+        soon as a child geom/provider/consumer appears."""
+        if pend.obj is not None:
+            return pend.obj
+        fields = pend.fields
+        if pend.tag == 'class':
+            pend.obj = self.result.add_class(pend.id, fields.get('name', ''),
+                                             pend.configs)
+        elif pend.tag == 'geom':
+            cls = self.realize(pend.parent)
+            pend.obj = self.result.add_geom(cls, pend.id,
+                                            fields.get('name', ''),
+                                            _int(fields.get('rank')),
+                                            pend.configs)
+        return pend.obj
+
+    def start(self, elem):
+        tag = elem.tag
+        if self.in_config:
+            return
+        if tag == 'config':
+            self.in_config = True
+            return
+        parent = self.stack[-1] if len(self.stack) else None
+        if tag in ('class', 'geom', 'provider', 'consumer'):
+            if parent is not None and elem.get('ref', None) is not None:
+                # back references like <geom ref="..."/>
+                if tag == 'provider':
+                    parent.ref = _ident(elem, 'ref')
+                return
+            self.stack.append(_Pending(tag, _ident(elem), parent))
+
+    def end(self, elem):
+        tag = elem.tag
+        if tag == 'config':
+            self.in_config = False
+            return
+        if not len(self.stack):
+            return
+        pend = self.stack[-1]
+        if self.in_config:
+            pend.configs.append(snap.Config(tag, elem.text))
+            return
+        if tag == pend.tag and elem.get('ref', None) is None:
+            self.stack.pop()
+            self.finish(pend)
+        elif elem.get('ref', None) is None:
+            pend.fields[tag] = elem.text
+
+    def finish(self, pend):
+        """An element was completely read."""
+        fields = pend.fields
+        if pend.tag == 'provider':
+            self.result.add_provider(self.realize(pend.parent), pend.id,
+                                     fields.get('name', ''),
+                                     fields.get('mode', None),
+                                     _int(fields.get('mediasize')),
+                                     _int(fields.get('sectorsize')),
+                                     _int(fields.get('stripeoffset')),
+                                     _int(fields.get('stripesize')),
+                                     pend.configs)
+        elif pend.tag == 'consumer':
+            self.result.add_consumer(self.realize(pend.parent), pend.id,
+                                     pend.ref, fields.get('mode', None),
+                                     pend.configs)
+        else:
+            # classes and geoms without children
+            self.realize(pend)
+
+def parse(source):
+    """Create a geom.snapshot.Snapshot from a file name or file object
+    containing kern.geom.confxml data."""
+    builder = _Builder()
+    open_   = []
+    for event, elem in ElementTree.iterparse(source, ('start', 'end')):
+        if event == 'start':
+            if len(open_):
+                builder.start(elem)
+            open_.append(elem)
+            continue
+        open_.pop()
+        if not len(open_):
+            break
+        builder.end(elem)
+        if (elem.tag in ('class', 'geom') and elem.get('ref', None) is None
+            and not builder.in_config):
+            # this is what keeps the memory usage down
+            open_[-1].remove(elem)
+    return builder.result.finish()
+
+def load(path):
+    """Alias for parse() reading from a file name."""
+    return parse(path)
+
+def read_sysctl():
+    """Fetch the current kern.geom.confxml contents."""
+    data = subprocess.check_output(['sysctl', '-b', SYSCTL])
+    return data.rstrip(b'\0')
+
+def capture(path):
+    """Dump the live topology of this machine into a file."""
+    data = read_sysctl()
+    with open(path, 'wb') as xmlfile:
+        xmlfile.write(data)
+    return len(data)
+
+def main(args):
+    """command line: capture FILE | show FILE"""
+    if len(args) != 2 or args[0] not in ('capture', 'show'):
+        print('usage: confxml.py capture|show FILE')
+        return 1
+    if args[0] == 'capture':
+        size = capture(args[1])
+        print('%s: wrote %u bytes' % (args[1], size))
+        return 0
+    mesh = parse(args[1])
+    for cls in mesh.classes():
+        print('%s:' % cls.name)
+        for gobj in cls.geoms():
+            print('  %s' % gobj.name)
+            for prov in gobj.providers():
+                print('    -> %s [%u]' % (prov.name, prov.mediasize))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
+
+__all__ = ['SYSCTL', 'parse', 'load', 'read_sysctl', 'capture']
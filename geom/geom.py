@@ -1,7 +1,14 @@
 from ctypes import *
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import atexit
+import os
+import queue
+import threading
 
 from . import util
+from . import snapshot as snap
+from . import confxml
 
 class GeomException(Exception):
     pass
@@ -54,7 +61,30 @@ class GConfig(Structure):
     def val(self):
         return self.value
 
-class GClass(Structure):
+class LiveConfigMap(snap.ConfigMap):
+    """ConfigMap for the ctypes structures. Every dereference of a pointer
+    creates a new structure object, so a dictionary cached on one would
+    hardly ever be used again: this builds it on every access instead. Keep
+    the result around, or use a snapshot(), to look up several entries."""
+    __slots__ = ()
+
+    @property
+    def config(self):
+        return dict((c.name, c.value) for c in self.configs())
+
+    def cfg_str(self, name, default=None):
+        for cfg in self.configs():
+            if cfg.name == name:
+                return cfg.value
+        return default
+
+    def cfg_int(self, name, default=None):
+        value = self.cfg_str(name, None)
+        if value is None:
+            return default
+        return int(value)
+
+class GClass(Structure, LiveConfigMap):
     @property
     def name(self):
         return self.lg_name.decode('utf-8')
@@ -70,7 +100,7 @@ class GClass(Structure):
     def configs(self):
         return pointer_list(self, 'lg_config')
 
-class GGeom(Structure):
+class GGeom(Structure, LiveConfigMap):
     @property
     def class_(self):
         return self.lg_class[0]
@@ -96,7 +126,7 @@ class GGeom(Structure):
         return pointer_list(self, 'lg_config')
 
 
-class GConsumer(Structure):
+class GConsumer(Structure, LiveConfigMap):
     @property
     def geom(self):
         return self.lg_geom[0]
@@ -127,7 +157,7 @@ class GConsumer(Structure):
     def configs(self):
         return pointer_list(self, 'lg_config')
 
-class GProvider(Structure):
+class GProvider(Structure, LiveConfigMap):
     @property
     def name(self):
         return self.lg_name.decode('utf-8')
@@ -160,6 +190,10 @@ class GProvider(Structure):
     def stripesize(self):
         return self.lg_stripesize
 
+    @property
+    def stripeoffset(self):
+        return self.lg_stripeoffset
+
     def configs(self):
         return pointer_list(self, 'lg_config')
 
@@ -236,13 +270,17 @@ geom_functions = [
     ("g_mediasize",     off_t,      [c_int]),
 ]
 
-lib = CDLL('libgeom.so.5', mode=RTLD_GLOBAL)
-if lib is None:
-    raise Exception('failed to open libgeom.so.5')
-util.load_functions(lib, geom_functions)
+# opened on first use, see util.Library
+lib = util.Library('libgeom.so.5', geom_functions, mode=RTLD_GLOBAL)
+
+# Read the geom tree from a kern.geom.confxml dump instead of libgeom.
+CONFXML = os.environ.get('ABSD_GEOM_CONFXML', None)
 
 class Mesh(object):
     def __init__(self):
+        self.mesh = None
+        if not lib:
+            raise GeomException('failed to open libgeom.so.5')
         self.mesh = GMesh()
         err = lib.geom_gettree(byref(self.mesh))
         if err != 0:
@@ -260,11 +298,104 @@ class Mesh(object):
         return pointer_list(self.mesh, 'lg_class')
 
     def find_class(self, name):
+        if isinstance(name, str):
+            name = name.encode('utf-8')
         for cl in self.classes():
             if cl.lg_name == name:
                 return cl
         return None
 
+    def snapshot(self):
+        """Copy the whole tree into a geom.snapshot.Snapshot."""
+        result = snap.Snapshot()
+        for cl in self.classes():
+            cls = result.add_class(cl.lg_id, cl.name, copy_configs(cl))
+            for gobj in cl.geoms():
+                geo = result.add_geom(cls, gobj.lg_id, gobj.name,
+                                      gobj.lg_rank, copy_configs(gobj))
+                for prov in gobj.providers():
+                    result.add_provider(geo, prov.lg_id, prov.name,
+                                        prov.mode, prov.mediasize,
+                                        prov.sectorsize, prov.stripeoffset,
+                                        prov.stripesize, copy_configs(prov))
+                for cons in gobj.consumers():
+                    provider_id = None
+                    if bool(cons.lg_provider):
+                        provider_id = cons.lg_provider[0].lg_id
+                    result.add_consumer(geo, cons.lg_id, provider_id,
+                                        cons.mode, copy_configs(cons))
+        return result.finish()
+
+def copy_configs(gobj):
+    """Copy the <config> list of a ctypes geom object."""
+    return [snap.Config(cfg.name, cfg.value) for cfg in gobj.configs()]
+
+def snapshot():
+    """Read the current geom tree into a Snapshot and free the C tree right
+    away. If CONFXML is set, the tree is read from that file instead."""
+    if CONFXML is not None:
+        return confxml.load(CONFXML)
+    if not lib:
+        raise GeomException('failed to open libgeom.so.5')
+    if not isinstance(lib, util.Library):
+        # a simulated library, see geom.sim
+        return lib.snapshot()
+    with Mesh() as mesh:
+        return mesh.snapshot()
+
+def use_library(library):
+    """Replace libgeom, eg. with a geom.sim.SimLib instance. The library has
+    to provide the gctl_* functions and a snapshot() method."""
+    # pylint: disable=global-statement
+    global lib
+    lib = library
+
+# Maximum number of entries of the partitioning schemes.
+PART_SCHEMES = {
+    'GPT': 128,
+    'MBR': 4,
+    'BSD': 8,
+}
+
+# Partition type aliases known to gpart per scheme. Raw types can be given
+# as '!<type>' instead. Types of other schemes are not checked.
+PART_TYPES = {
+    'GPT': ('apple-apfs', 'apple-boot', 'apple-core-storage', 'apple-hfs',
+            'apple-label', 'apple-raid', 'apple-raid-offline',
+            'apple-tv-recovery', 'apple-ufs', 'apple-zfs', 'bios-boot',
+            'chromeos-firmware', 'chromeos-kernel', 'chromeos-reserved',
+            'chromeos-root', 'dragonfly-ccd', 'dragonfly-hammer',
+            'dragonfly-hammer2', 'dragonfly-label32', 'dragonfly-label64',
+            'dragonfly-legacy', 'dragonfly-swap', 'dragonfly-ufs1',
+            'dragonfly-vinum', 'efi', 'freebsd', 'freebsd-boot',
+            'freebsd-nandfs', 'freebsd-swap', 'freebsd-ufs', 'freebsd-vinum',
+            'freebsd-zfs', 'linux-data', 'linux-lvm', 'linux-raid',
+            'linux-swap', 'mbr', 'ms-basic-data', 'ms-ldm-data',
+            'ms-ldm-metadata', 'ms-recovery', 'ms-reserved', 'ms-spaces',
+            'netbsd-ccd', 'netbsd-cgd', 'netbsd-ffs', 'netbsd-lfs',
+            'netbsd-raid', 'netbsd-swap', 'openbsd-data', 'prep-boot',
+            'solaris-altsec', 'solaris-backup', 'solaris-boot',
+            'solaris-home', 'solaris-reserved', 'solaris-root',
+            'solaris-swap', 'solaris-var', 'vmware-reserved', 'vmware-vmfs',
+            'vmware-vmkdiag', 'vmware-vsanhdr'),
+    'MBR': ('dragonfly', 'ebr', 'efi', 'fat16', 'fat32', 'fat32lba',
+            'freebsd', 'linux-data', 'linux-lvm', 'linux-raid', 'linux-swap',
+            'ms-ldm-data', 'ntfs', 'prep-boot', 'vmware-vmfs',
+            'vmware-vmkdiag'),
+    'BSD': ('freebsd-nandfs', 'freebsd-swap', 'freebsd-ufs', 'freebsd-vinum',
+            'freebsd-zfs'),
+}
+
+def partition_type_known(scheme, ty):
+    """Check whether gpart accepts a partition type for a scheme. Always
+    true for schemes without a list in PART_TYPES."""
+    if ty.startswith('!') and len(ty) > 1:
+        return True
+    types = PART_TYPES.get(scheme.upper(), None)
+    if types is None:
+        return True
+    return ty in types
+
 def partition_type_for(scheme, ty):
     ty     = ty.lower()
     scheme = scheme.lower()
@@ -281,78 +412,361 @@ def partition_type_for(scheme, ty):
             return 'freebsd'
     return ty
 
+# gctl only reads the parameter buffers, so the names and the values of
+# the header parameters (class, verb, arg0, flags) are created once and
+# shared by all requests.
+SHARED_PARAMS = ('class', 'verb', 'arg0', 'flags')
+_buffers = {}
+
+def _shared_buffer(text):
+    """Get the cached C string buffer for a parameter name or value."""
+    buf = _buffers.get(text, None)
+    if buf is None:
+        buf = _buffers.setdefault(text,
+                                  create_string_buffer(text.encode('utf-8')))
+    return buf
+
 def gctl_param(req, param, ty, value):
-    key = create_string_buffer(param.encode('utf-8'))
+    key = _shared_buffer(param)
     if ty == int:
         v = c_long(value)
         lib.gctl_ro_param(req, key, sizeof(c_long), byref(v))
         return v
     elif ty == str:
-        v = create_string_buffer(value.encode('utf-8'))
+        if param in SHARED_PARAMS:
+            v = _shared_buffer(value)
+        else:
+            v = create_string_buffer(value.encode('utf-8'))
         lib.gctl_ro_param(req, key, sizeof(v), cast(v, c_void_p))
         return v
+    elif ty == bytes:
+        # raw data like bootcode, not NUL terminated
+        v = create_string_buffer(value, len(value))
+        lib.gctl_ro_param(req, key, len(value), cast(v, c_void_p))
+        return v
     else:
         raise ValueError
 
-Uncommitted = []
+# Bumped for every successful gctl request, see generation().
+_generation      = 0
+_generation_lock = threading.Lock()
 
-def geom_part_do(provider, verb, data):
-    req = lib.gctl_get_handle()
-    keeparound = [gctl_param(req, 'class', str, 'PART'),
-                  gctl_param(req, 'verb',  str, verb),
-                  gctl_param(req, 'arg0',  str, provider),
-                  gctl_param(req, 'flags', str, 'x') # don't commit immediately
-                 ]
-    for k,t,v in data:
-        keeparound.append(gctl_param(req, k, t, v))
-    err = lib.gctl_issue(req)
-    lib.gctl_free(req)
-    if err is None and provider not in Uncommitted:
-        Uncommitted.append(provider)
-    return err
+def _bump_generation():
+    global _generation
+    with _generation_lock:
+        _generation += 1
 
-def geom_part_commit(provider):
-    if provider not in Uncommitted:
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
         return None
-    req = lib.gctl_get_handle()
-    keeparound = [gctl_param(req, 'class', str, 'PART'),
-                  gctl_param(req, 'verb',  str, 'commit'),
-                  gctl_param(req, 'arg0',  str, provider)
-                 ]
-    err = lib.gctl_issue(req)
-    lib.gctl_free(req)
-    if err is None:
-        Uncommitted.remove(provider)
-    return err
 
-def geom_part_undo(provider):
-    if provider not in Uncommitted:
-        return None
+def generation():
+    """Cheap check whether the geom tree may have changed: compares unequal
+    after any of our own successful gctl requests, and after devices appear
+    or disappear (which updates the modification time of /dev)."""
+    if CONFXML is not None:
+        return (_generation, _mtime(CONFXML))
+    return (_generation, _mtime('/dev'))
+
+def gctl_part_issue(provider, verb, data, flags=None):
+    """Issue a single request to the PART class.
+    Returns None on success, or the error message."""
     req = lib.gctl_get_handle()
     keeparound = [gctl_param(req, 'class', str, 'PART'),
-                  gctl_param(req, 'verb',  str, 'undo'),
+                  gctl_param(req, 'verb',  str, verb),
                   gctl_param(req, 'arg0',  str, provider)
                  ]
+    if flags is not None:
+        keeparound.append(gctl_param(req, 'flags', str, flags))
+    for k,t,v in data:
+        keeparound.append(gctl_param(req, k, t, v))
     err = lib.gctl_issue(req)
     lib.gctl_free(req)
     if err is None:
-        Uncommitted.remove(provider)
+        _bump_generation()
     return err
 
-def geom_commit_all():
-    while len(Uncommitted):
-        geom_part_commit(Uncommitted[0])
+# Providers with pending changes, used as an ordered set.
+# Modifications happen with _pending_lock held, and requests for a disk are
+# serialized through its disk_lock().
+Uncommitted   = OrderedDict()
+_pending_lock = threading.Lock()
+_disk_locks   = {}
+
+# Upper bound of threads used to commit or undo disks in parallel.
+MAX_WORKERS   = 8
+# Upper bound of threads used by PartTransaction.run(), one per disk of a
+# large chassis.
+RUN_WORKERS   = 32
+
+def disk_lock(provider):
+    """Get the lock serializing the requests for a disk."""
+    with _pending_lock:
+        lock = _disk_locks.get(provider, None)
+        if lock is None:
+            lock = _disk_locks[provider] = threading.Lock()
+        return lock
+
+def pending():
+    """Get a list of the providers with uncommitted changes."""
+    with _pending_lock:
+        return list(Uncommitted)
+
+def geom_part_do(provider, verb, data):
+    with disk_lock(provider):
+        # 'x' flag: don't commit immediately
+        err = gctl_part_issue(provider, verb, data, flags='x')
+        if err is None:
+            with _pending_lock:
+                Uncommitted[provider] = True
+        return err
+
+def _geom_part_finish(provider, verb):
+    """Issue a commit or undo for a provider with pending changes."""
+    with disk_lock(provider):
+        with _pending_lock:
+            if provider not in Uncommitted:
+                return None
+        err = gctl_part_issue(provider, verb, [])
+        if err is None:
+            with _pending_lock:
+                Uncommitted.pop(provider, None)
+        return err
+
+def geom_part_commit(provider):
+    return _geom_part_finish(provider, 'commit')
 
-def geom_undo_all():
-    while len(Uncommitted):
-        geom_part_undo(Uncommitted[0])
+def geom_part_undo(provider):
+    return _geom_part_finish(provider, 'undo')
+
+def geom_part_each(func, providers, workers=None):
+    """Call func(provider) for each provider using a bounded thread pool.
+    Returns a dictionary mapping providers to their errors."""
+    providers = list(providers)
+    errors    = {}
+    if len(providers) == 0:
+        return errors
+    if workers is None:
+        workers = MAX_WORKERS
+    workers = max(1, min(workers, len(providers)))
+    if workers == 1:
+        results = [func(provider) for provider in providers]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(func, providers))
+    for provider, err in zip(providers, results):
+        if err is not None:
+            errors[provider] = err
+    return errors
+
+def geom_commit_all(workers=None):
+    """Commit all pending changes, disks are committed in parallel.
+    Returns a dictionary mapping the disks which failed to their errors, they
+    remain in Uncommitted."""
+    return geom_part_each(geom_part_commit, pending(), workers)
+
+def geom_undo_all(workers=None):
+    """Roll back all pending changes, see geom_commit_all()."""
+    return geom_part_each(geom_part_undo, pending(), workers)
+
+class PartEvent(object):
+    """Progress of a disk in PartTransaction.run(). kind is 'step' after a
+    verb succeeded, 'done' after the last one, or 'failed' when a verb
+    failed and the disk was undone; undo is the error of the undo then, if
+    any. step counts the verbs from 1 up to total."""
+    # pylint: disable=too-few-public-methods
+    # pylint: disable=too-many-arguments
+    __slots__ = ('provider', 'kind', 'step', 'total', 'verb', 'error',
+                 'undo')
+
+    def __init__(self, provider, kind, step, total, verb, error=None,
+                 undo=None):
+        self.provider = provider
+        self.kind     = kind
+        self.step     = step
+        self.total    = total
+        self.verb     = verb
+        self.error    = error
+        self.undo     = undo
+
+    def __repr__(self):
+        return 'PartEvent(%r, %r, %u/%u, %r)' % (self.provider, self.kind,
+                                                 self.step, self.total,
+                                                 self.verb)
+
+def _part_job(provider, ops, post):
+    """Issue the verbs of one disk in order, reporting via post()."""
+    total = len(ops)
+    for step, (verb, data) in enumerate(ops, 1):
+        try:
+            err = geom_part_do(provider, verb, data)
+        except Exception as exc: # pylint: disable=broad-except
+            err = str(exc)
+        if err is not None:
+            try:
+                undo = geom_part_undo(provider)
+            except Exception as exc: # pylint: disable=broad-except
+                undo = str(exc)
+            post(PartEvent(provider, 'failed', step, total, verb, err, undo))
+            return
+        kind = 'done' if step == total else 'step'
+        post(PartEvent(provider, kind, step, total, verb))
+
+class PartTransaction(object):
+    """Collects gpart verbs for any number of disks, validates them when they
+    are queued and issues them back to back. Each disk is treated as a unit:
+    when one of its verbs fails, the remaining ones are skipped and the
+    disk's pending changes are undone.
+
+        txn = PartTransaction()
+        txn.create('ada0', 'GPT')
+        txn.add('ada0', 'freebsd-boot', size='512k')
+        errors = txn.execute()
+        txn.commit()
+
+    The disks are independent of each other, so they are worked on in
+    parallel, see run().
+
+    Note that gpart's undo reverts all uncommitted changes of a disk, not
+    only the ones made by the transaction."""
+
+    # verb: (required parameters, optional parameters)
+    VERBS = {
+        'create':   (('scheme',), ('entries',)),
+        'add':      (('type',),   ('start', 'size', 'label', 'index')),
+        'delete':   (('index',),  ()),
+        'destroy':  ((),          ('force',)),
+        'bootcode': (('bootcode',), ()),
+        'modify':   (('index',),  ('type', 'label')),
+        'resize':   (('index',),  ('size',)),
+    }
 
-atexit.register(geom_undo_all)
+    def __init__(self):
+        self.ops    = []
+        self.disks  = OrderedDict()
+        self.failed = OrderedDict()
+
+    def queue(self, provider, verb, data):
+        """Validate and append a verb, data is a list of (name, type, value)
+        tuples like for geom_part_do. Raises a GeomException for invalid
+        requests."""
+        if not isinstance(provider, str) or len(provider) == 0:
+            raise GeomException('invalid provider: %r' % (provider,))
+        spec = self.VERBS.get(verb, None)
+        if spec is None:
+            raise GeomException('unknown verb: %s' % verb)
+        required, optional = spec
+        names = set()
+        for name, ty, value in data:
+            if name not in required and name not in optional:
+                raise GeomException('%s: invalid parameter for %s: %s'
+                                    % (provider, verb, name))
+            if ty not in (int, str, bytes) or not isinstance(value, ty):
+                raise GeomException('%s: bad value for %s: %r'
+                                    % (provider, name, value))
+            names.add(name)
+        for name in required:
+            if name not in names:
+                raise GeomException('%s: %s requires %s'
+                                    % (provider, verb, name))
+        self.ops.append((provider, verb, list(data)))
+        self.disks[provider] = True
+
+    def create(self, provider, scheme, entries=None):
+        data = [('scheme', str, scheme)]
+        if entries is not None:
+            data.append(('entries', str, str(entries)))
+        self.queue(provider, 'create', data)
+
+    def add(self, provider, type_, start=None, size=None, label=None,
+            index=None):
+        """gpart add, start and size are in sectors or strings with a unit
+        suffix understood by gpart."""
+        # pylint: disable=too-many-arguments
+        data = [('type', str, type_)]
+        for name, value in (('start', start), ('size',  size),
+                            ('label', label), ('index', index)):
+            if value is not None:
+                data.append((name, str, str(value)))
+        self.queue(provider, 'add', data)
+
+    def delete(self, provider, index):
+        self.queue(provider, 'delete', [('index', str, str(index))])
+
+    def destroy(self, provider, force=False):
+        data = []
+        if force:
+            data.append(('force', str, '1'))
+        self.queue(provider, 'destroy', data)
+
+    def bootcode(self, provider, bootcode):
+        """Install the boot code (passed as bytes) of a partition table.
+        Note that gpart writes the partcode to the partition itself, this is
+        not a request to the kernel."""
+        self.queue(provider, 'bootcode', [('bootcode', bytes, bootcode)])
+
+    def run(self, workers=None):
+        """Issue all queued verbs, yielding a PartEvent for every step. Each
+        disk is a job on a pool of up to workers threads (RUN_WORKERS by
+        default) which issues the disk's verbs in order. A disk whose verb
+        fails is undone right away while the others continue. The failed
+        disks are collected in self.failed as the events are consumed, so
+        the generator has to be exhausted."""
+        jobs = OrderedDict()
+        for provider, verb, data in self.ops:
+            if provider not in self.failed:
+                jobs.setdefault(provider, []).append((verb, data))
+        self.ops = []
+        if not len(jobs):
+            return
+        if workers is None:
+            workers = RUN_WORKERS
+        workers = max(1, min(workers, len(jobs)))
+        events  = queue.Queue()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for provider, ops in jobs.items():
+                pool.submit(_part_job, provider, ops, events.put)
+            remaining = len(jobs)
+            while remaining:
+                event = events.get()
+                if event.kind != 'step':
+                    remaining -= 1
+                if event.kind == 'failed':
+                    self.failed[event.provider] = event.error
+                yield event
+
+    def execute(self, workers=None):
+        """Issue all queued verbs, see run(). Returns a dictionary mapping
+        the failed disks to their error message, their changes have been
+        undone."""
+        for _ in self.run(workers):
+            pass
+        return self.failed
+
+    def commit(self):
+        """Commit the disks which did not fail, returns a dictionary of
+        errors like execute()."""
+        return self.__finish(geom_part_commit)
+
+    def undo(self):
+        """Roll back the changes to all the disks."""
+        return self.__finish(geom_part_undo)
+
+    def __finish(self, func):
+        disks = [disk for disk in self.disks if disk not in self.failed]
+        self.disks = OrderedDict()
+        return geom_part_each(func, disks)
+
+# no new threads can be started while the interpreter shuts down
+atexit.register(geom_undo_all, 1)
 
 __all__ = [
     'GIdent',
     'GMesh',
     'GConfig',
+    'LiveConfigMap',
     'GClass',
     'GConsumer',
     'GProvider',
@@ -360,9 +774,24 @@ __all__ = [
     'lib',
     'GeomException',
     'Mesh',
+    'snapshot',
+    'generation',
     'partition_type_for',
+    'partition_type_known',
+    'PART_SCHEMES',
+    'PART_TYPES',
+    'use_library',
     'geom_part_do',
     'geom_part_commit',
     'geom_part_undo',
+    'geom_part_each',
+    'geom_commit_all',
+    'geom_undo_all',
     'gctl_param',
+    'gctl_part_issue',
+    'PartEvent',
+    'PartTransaction',
+    'Uncommitted',
+    'disk_lock',
+    'pending',
 ]
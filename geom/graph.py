@@ -0,0 +1,292 @@
+"""
+Dependency graph of the geoms in a snapshot.
+
+A geom depends on the geoms whose providers it consumes: a PART geom on
+its disk, an ELI geom on the partition it encrypts and so on. The geoms a
+geom is built from are its ancestors, the ones stacked on top of it are its
+descendants.
+
+Before a disk can be reused everything stacked on top of it has to be
+stopped, top-most first. teardown() does this, stopping independent stacks
+(eg. two separate mirror+eli chains) concurrently. Pools are left to the
+caller: the vdevs of an imported pool are reported as held by it.
+
+The module uses relative imports, so it can only be run as part of the
+package:
+
+    python3 -m geom.graph teardown --dry-run ada0 ada1
+"""
+
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from . import geom
+from . import zfs
+
+# The DEV class consumes every provider to create the /dev entries and
+# never has to be stopped.
+IGNORED_CLASSES = ('DEV',)
+
+MAX_WORKERS = 8
+
+def _provider(gobj):
+    return next(gobj.providers(), None)
+
+# class name -> function returning the command to stop a geom
+STOP_COMMANDS = {
+    'PART':   lambda g: ['gpart',   'destroy', '-F', g.name],
+    'ELI':    lambda g: ['geli',    'detach',  '-f', _provider(g).name],
+    'MIRROR': lambda g: ['gmirror', 'stop',    '-f', g.name],
+    'STRIPE': lambda g: ['gstripe', 'stop',    '-f', g.name],
+    'CONCAT': lambda g: ['gconcat', 'stop',    '-f', g.name],
+    'RAID3':  lambda g: ['graid3',  'stop',    '-f', g.name],
+    'RAID':   lambda g: ['graid',   'stop',    '-f', g.name],
+}
+
+def pool_devices():
+    """Map the provider names of the vdevs of the imported pools to the pool
+    names. Empty if libzfs is not available."""
+    try:
+        configs = zfs.session().configs()
+    except Exception: # pylint: disable=broad-except
+        return {}
+    devices = {}
+    def walk(vdev, pool):
+        path = vdev.get('path', None)
+        if path is not None:
+            devices[path[5:] if path.startswith('/dev/') else path] = pool
+        for key in ('children', 'l2cache', 'spares'):
+            for child in vdev.get(key, ()):
+                walk(child, pool)
+    for name, config in configs.items():
+        if config is not None:
+            walk(config.get('vdev_tree', {}), name)
+    return devices
+
+def zpool_of(gobj, devices=None):
+    """The name of the pool a ZFS::VDEV geom belongs to, or None. Pass the
+    pool_devices() along when looking up several geoms."""
+    if devices is None:
+        devices = pool_devices()
+    for cons in gobj.consumers():
+        prov = next(cons.providers(), None)
+        if prov is not None and prov.name in devices:
+            return devices[prov.name]
+    return None
+
+# class name -> function of the geom and the pool_devices() returning why a
+# geom cannot be stopped here, these are released by destroying or exporting
+# what holds them
+HELD_CLASSES = {
+    'ZFS::VDEV': lambda g, devices: 'held by zpool %s' % (
+        zpool_of(g, devices) or '?'),
+}
+
+def held_by(gobj, devices=None):
+    """Why a geom is held by something teardown() does not stop, or None.
+    devices are the pool_devices(), read when needed if not given."""
+    func = HELD_CLASSES.get(gobj.class_.name, None)
+    if func is None:
+        return None
+    if devices is None:
+        devices = pool_devices()
+    return func(gobj, devices)
+
+def stop_command(gobj):
+    """The command to stop a geom, None if there's nothing to do for its
+    class (eg. disks or labels)."""
+    func = STOP_COMMANDS.get(gobj.class_.name, None)
+    if func is None:
+        return None
+    return func(gobj)
+
+def stop_geom(gobj):
+    """Stop a geom using its class' command line tool. Returns None on
+    success, or an error message."""
+    reason = held_by(gobj)
+    if reason is not None:
+        return reason
+    cmd = stop_command(gobj)
+    if cmd is None:
+        return None
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT, check=False)
+    if proc.returncode != 0:
+        return '%s: %s' % (' '.join(cmd),
+                           proc.stdout.decode('utf-8', 'replace').strip())
+    return None
+
+class GeomGraph(object):
+    """Consumer/provider dependency graph of a geom snapshot."""
+
+    def __init__(self, mesh, ignore=IGNORED_CLASSES):
+        self.mesh  = mesh
+        self.pools = None
+        self.nodes = {}
+        self.below = {}
+        self.above = {}
+        for cls in mesh.classes():
+            if cls.name in ignore:
+                continue
+            for gobj in cls.geoms():
+                self.nodes[gobj.id] = gobj
+                self.below[gobj.id] = set()
+                self.above[gobj.id] = set()
+        for gid, gobj in self.nodes.items():
+            for cons in gobj.consumers():
+                prov = next(cons.providers(), None)
+                if prov is None or prov.geom.id not in self.nodes:
+                    continue
+                self.below[gid].add(prov.geom.id)
+                self.above[prov.geom.id].add(gid)
+
+    def held_by(self, gobj):
+        """See held_by(), the pool configs are only read once per graph."""
+        if gobj.class_.name not in HELD_CLASSES:
+            return None
+        if self.pools is None:
+            self.pools = pool_devices()
+        return held_by(gobj, self.pools)
+
+    def geom_of(self, name):
+        """Find the geom providing a provider by name."""
+        prov = self.mesh.find_provider(name)
+        if prov is None:
+            return None
+        return prov.geom
+
+    def __resolve(self, obj):
+        """Accept geoms or provider names."""
+        if isinstance(obj, str):
+            gobj = self.geom_of(obj)
+            if gobj is None:
+                raise geom.GeomException('no such provider: %s' % obj)
+            return gobj
+        return obj
+
+    def __walk(self, start, edges):
+        seen = set()
+        todo = [self.__resolve(start).id]
+        while len(todo):
+            for gid in edges[todo.pop()]:
+                if gid not in seen:
+                    seen.add(gid)
+                    todo.append(gid)
+        return seen
+
+    def ancestors(self, gobj):
+        """All the geoms gobj is built from."""
+        return [self.nodes[gid] for gid in self.__walk(gobj, self.below)]
+
+    def descendants(self, gobj):
+        """All the geoms stacked on top of gobj."""
+        return [self.nodes[gid] for gid in self.__walk(gobj, self.above)]
+
+    def teardown_set(self, targets):
+        """Ids of the geoms which need to be stopped to free the targets."""
+        ids = set()
+        for target in targets:
+            ids.update(self.__walk(target, self.above))
+        return ids
+
+    def teardown_schedule(self, targets):
+        """Waves of geoms to stop in order to free the targets. Each wave
+        only contains geoms whose descendants were stopped in the previous
+        waves, so the geoms of a wave can be stopped concurrently."""
+        todo    = self.teardown_set(targets)
+        pending = dict((gid, len(self.above[gid] & todo)) for gid in todo)
+        wave    = [gid for gid, count in pending.items() if count == 0]
+        waves   = []
+        while len(wave):
+            waves.append([self.nodes[gid] for gid in sorted(wave)])
+            following = []
+            for gid in wave:
+                for lower in self.below[gid]:
+                    if lower in pending:
+                        pending[lower] -= 1
+                        if pending[lower] == 0:
+                            following.append(lower)
+            wave = following
+        return waves
+
+    def teardown(self, targets, stop=stop_geom, workers=None):
+        """Stop everything stacked on the targets (geoms or provider names).
+        A geom is stopped as soon as everything on top of it was stopped, so
+        independent stacks do not wait for each other. Returns a dictionary
+        mapping the geoms which failed, are held (see held_by()) or could
+        not be stopped because something above them failed to their error
+        messages."""
+        todo    = self.teardown_set(targets)
+        pending = dict((gid, len(self.above[gid] & todo)) for gid in todo)
+        errors  = {}
+        if not len(todo):
+            return errors
+        if workers is None:
+            workers = MAX_WORKERS
+
+        def blocked(gid, reason):
+            """skip everything below a failed geom"""
+            for lower in self.__walk(self.nodes[gid], self.below):
+                if lower in todo and self.nodes[lower] not in errors:
+                    errors[self.nodes[lower]] = reason
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            running = {}
+
+            def start(gid):
+                gobj   = self.nodes[gid]
+                reason = self.held_by(gobj)
+                if reason is not None:
+                    errors[gobj] = reason
+                    blocked(gid, 'blocked by %s' % gobj.name)
+                    return
+                running[pool.submit(stop, gobj)] = gid
+
+            for gid, count in pending.items():
+                if count == 0 and self.nodes[gid] not in errors:
+                    start(gid)
+            while len(running):
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    gid = running.pop(future)
+                    err = future.result()
+                    if err is not None:
+                        errors[self.nodes[gid]] = err
+                        blocked(gid, 'blocked by %s' % self.nodes[gid].name)
+                        continue
+                    for lower in self.below[gid]:
+                        if lower not in pending:
+                            continue
+                        pending[lower] -= 1
+                        if (pending[lower] == 0 and
+                            self.nodes[lower] not in errors):
+                            start(lower)
+        return errors
+
+def main(args):
+    """command line: teardown [--dry-run] PROVIDER..."""
+    if len(args) < 2 or args[0] != 'teardown':
+        print('usage: python3 -m geom.graph teardown [--dry-run] PROVIDER...')
+        return 1
+    dry_run = '--dry-run' in args
+    targets = [arg for arg in args[1:] if arg != '--dry-run']
+    graph = GeomGraph(geom.snapshot())
+    if dry_run:
+        for number, wave in enumerate(graph.teardown_schedule(targets)):
+            for gobj in wave:
+                cmd = stop_command(gobj)
+                print('%u: %s %s: %s' % (number, gobj.class_.name, gobj.name,
+                                         ' '.join(cmd) if cmd else
+                                         graph.held_by(gobj) or '-'))
+        return 0
+    errors = graph.teardown(targets)
+    for gobj, err in errors.items():
+        print('%s %s: %s' % (gobj.class_.name, gobj.name, err))
+    return 1 if len(errors) else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
+
+__all__ = ['IGNORED_CLASSES', 'STOP_COMMANDS', 'HELD_CLASSES', 'pool_devices',
+           'zpool_of', 'held_by', 'stop_command', 'stop_geom', 'GeomGraph']
@@ -0,0 +1,480 @@
+"""
+Pure python nvlist encoder and decoder.
+
+Converts complete packed nvlists (as produced by nvlist_pack(), found in
+zpool.cache files or returned by ioctls) to nested python dictionaries and
+back, in both the NATIVE and the XDR encoding. Decoding works on a
+memoryview of the buffer with struct.unpack_from, so reading a pool config
+takes a single nvlist_pack() call instead of one ctypes call per field.
+
+Values are decoded to plain python objects:
+    BOOLEAN             -> True (the pair has no value)
+    BOOLEAN_VALUE       -> bool
+    integer types       -> int
+    DOUBLE              -> float
+    STRING              -> str
+    BYTE_ARRAY          -> bytes
+    other arrays        -> list
+    NVLIST              -> dict
+    NVLIST_ARRAY        -> list of dicts
+
+When encoding, the types are inferred the same way with int meaning UINT64,
+which is what ZFS uses for almost everything. Wrap values in Typed to force
+a specific type, eg. Typed(DATA_TYPE.INT32, -1). unpack(..., typed=True)
+returns Typed values so a list can be re-encoded unchanged.
+"""
+
+import struct
+
+NV_VERSION = 0
+
+NV_ENCODE_NATIVE = 0
+NV_ENCODE_XDR    = 1
+
+NV_UNIQUE_NAME      = 0x1
+NV_UNIQUE_NAME_TYPE = 0x2
+
+class DATA_TYPE(object):
+    """data_type_t"""
+    # pylint: disable=too-few-public-methods
+    UNKNOWN       = 0
+    BOOLEAN       = 1
+    BYTE          = 2
+    INT16         = 3
+    UINT16        = 4
+    INT32         = 5
+    UINT32        = 6
+    INT64         = 7
+    UINT64        = 8
+    STRING        = 9
+    BYTE_ARRAY    = 10
+    INT16_ARRAY   = 11
+    UINT16_ARRAY  = 12
+    INT32_ARRAY   = 13
+    UINT32_ARRAY  = 14
+    INT64_ARRAY   = 15
+    UINT64_ARRAY  = 16
+    STRING_ARRAY  = 17
+    HRTIME        = 18
+    NVLIST        = 19
+    NVLIST_ARRAY  = 20
+    BOOLEAN_VALUE = 21
+    INT8          = 22
+    UINT8         = 23
+    BOOLEAN_ARRAY = 24
+    INT8_ARRAY    = 25
+    UINT8_ARRAY   = 26
+    DOUBLE        = 27
+
+T = DATA_TYPE
+
+# struct format of the scalar types in the native encoding, array types map
+# to the format of their elements
+NATIVE_FORMATS = {
+    T.BYTE: 'B',  T.INT8: 'b',   T.UINT8: 'B',   T.INT16: 'h',
+    T.UINT16: 'H', T.INT32: 'i', T.UINT32: 'I',  T.INT64: 'q',
+    T.UINT64: 'Q', T.HRTIME: 'q', T.DOUBLE: 'd', T.BOOLEAN_VALUE: 'i',
+    T.BYTE_ARRAY: 'B',   T.INT8_ARRAY: 'b',   T.UINT8_ARRAY: 'B',
+    T.INT16_ARRAY: 'h',  T.UINT16_ARRAY: 'H', T.INT32_ARRAY: 'i',
+    T.UINT32_ARRAY: 'I', T.INT64_ARRAY: 'q',  T.UINT64_ARRAY: 'Q',
+    T.BOOLEAN_ARRAY: 'i',
+}
+
+# XDR widens everything smaller than 32 bit to 32 bit
+XDR_FORMATS = {
+    T.BYTE: 'I',  T.INT8: 'i',   T.UINT8: 'I',   T.INT16: 'i',
+    T.UINT16: 'I', T.INT32: 'i', T.UINT32: 'I',  T.INT64: 'q',
+    T.UINT64: 'Q', T.HRTIME: 'q', T.DOUBLE: 'd', T.BOOLEAN_VALUE: 'i',
+    T.INT8_ARRAY: 'i',   T.UINT8_ARRAY: 'I',
+    T.INT16_ARRAY: 'i',  T.UINT16_ARRAY: 'I', T.INT32_ARRAY: 'i',
+    T.UINT32_ARRAY: 'I', T.INT64_ARRAY: 'q',  T.UINT64_ARRAY: 'Q',
+    T.BOOLEAN_ARRAY: 'i',
+}
+
+ARRAY_TYPES = frozenset([T.BYTE_ARRAY, T.INT8_ARRAY, T.UINT8_ARRAY,
+                         T.INT16_ARRAY, T.UINT16_ARRAY, T.INT32_ARRAY,
+                         T.UINT32_ARRAY, T.INT64_ARRAY, T.UINT64_ARRAY,
+                         T.BOOLEAN_ARRAY])
+
+# sizeof(nvpair_t) and sizeof(nvlist_t)
+NVPAIR_SIZE = 16
+NVLIST_SIZE = 24
+
+class NVListError(Exception):
+    """Raised for malformed buffers and values which cannot be encoded."""
+    pass
+
+class Typed(object):
+    """A value with an explicit data type."""
+    # pylint: disable=too-few-public-methods
+    __slots__ = ('type', 'value')
+
+    def __init__(self, type_, value):
+        self.type  = type_
+        self.value = value
+
+    def __eq__(self, other):
+        return (isinstance(other, Typed) and self.type == other.type and
+                self.value == other.value)
+
+    def __repr__(self):
+        return 'Typed(%u, %r)' % (self.type, self.value)
+
+def _align8(size):
+    return (size + 7) & ~7
+
+def _align4(size):
+    return (size + 3) & ~3
+
+def _infer(value):
+    """Returns the (type, value) tuple of a python value."""
+    # pylint: disable=too-many-return-statements
+    if isinstance(value, Typed):
+        return (value.type, value.value)
+    if value is None:
+        return (T.BOOLEAN, None)
+    if isinstance(value, bool):
+        return (T.BOOLEAN_VALUE, value)
+    if isinstance(value, int):
+        return (T.UINT64, value)
+    if isinstance(value, float):
+        return (T.DOUBLE, value)
+    if isinstance(value, str):
+        return (T.STRING, value)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return (T.BYTE_ARRAY, bytes(value))
+    if isinstance(value, dict):
+        return (T.NVLIST, value)
+    if isinstance(value, (list, tuple)):
+        if not len(value):
+            raise NVListError('cannot infer the type of an empty list')
+        first = value[0]
+        if isinstance(first, dict):
+            return (T.NVLIST_ARRAY, value)
+        if isinstance(first, str):
+            return (T.STRING_ARRAY, value)
+        if isinstance(first, bool):
+            return (T.BOOLEAN_ARRAY, value)
+        if isinstance(first, int):
+            return (T.UINT64_ARRAY, value)
+    raise NVListError('cannot encode %r' % (value,))
+
+def _nelem(type_, value):
+    if type_ == T.BOOLEAN:
+        return 0
+    if type_ in ARRAY_TYPES or type_ in (T.STRING_ARRAY, T.NVLIST_ARRAY):
+        return len(value)
+    return 1
+
+def _native_value_size(type_, value):
+    """i_get_value_size()"""
+    if type_ == T.BOOLEAN:
+        return 0
+    if type_ == T.STRING:
+        return len(value.encode('utf-8')) + 1
+    if type_ == T.STRING_ARRAY:
+        return 8 * len(value) + sum(len(s.encode('utf-8')) + 1
+                                    for s in value)
+    if type_ == T.NVLIST:
+        return NVLIST_SIZE
+    if type_ == T.NVLIST_ARRAY:
+        return (8 + NVLIST_SIZE) * len(value)
+    fmt = NATIVE_FORMATS.get(type_, None)
+    if fmt is None:
+        raise NVListError('unknown data type %u' % type_)
+    return struct.calcsize(fmt) * _nelem(type_, value)
+
+def _native_pair_size(name, type_, value):
+    """NVP_SIZE_CALC()"""
+    return (_align8(NVPAIR_SIZE + len(name.encode('utf-8')) + 1) +
+            _align8(_native_value_size(type_, value)))
+
+class _Decoder(object):
+    """Common part of the native and xdr decoders."""
+    def __init__(self, view, order, typed):
+        self.view  = view
+        self.order = order
+        self.typed = typed
+
+    def unpack(self, fmt, offset):
+        return struct.unpack_from(self.order + fmt, self.view, offset)
+
+    def result(self, type_, value):
+        if self.typed:
+            return Typed(type_, value)
+        return value
+
+    def string(self, start, end):
+        """A NUL terminated string within [start, end)"""
+        raw = bytes(self.view[start:end])
+        nul = raw.find(b'\0')
+        if nul >= 0:
+            raw = raw[:nul]
+        return raw.decode('utf-8')
+
+class _NativeDecoder(_Decoder):
+    """Decodes NV_ENCODE_NATIVE data."""
+
+    def nvlist(self, offset):
+        """Returns the dictionary and the offset after the list."""
+        offset += 8 # nvl_version, nvl_nvflag
+        result = {}
+        while True:
+            if offset + 4 > len(self.view):
+                raise NVListError('truncated nvlist')
+            size, = self.unpack('i', offset)
+            if size == 0:
+                return (result, offset + 4)
+            if size < NVPAIR_SIZE or offset + size > len(self.view):
+                raise NVListError('bad nvpair size %d' % size)
+            name, value, offset = self.pair(offset, size)
+            result[name] = value
+        return (result, offset)
+
+    def pair(self, offset, size):
+        # pylint: disable=too-many-locals
+        _, name_sz, _, nelem, type_ = self.unpack('ihhii', offset)
+        name   = self.string(offset + NVPAIR_SIZE,
+                             offset + NVPAIR_SIZE + name_sz)
+        valoff = offset + _align8(NVPAIR_SIZE + name_sz)
+        end    = offset + size
+        if type_ == T.BOOLEAN:
+            return (name, self.result(type_, True), end)
+        if type_ == T.STRING:
+            return (name, self.result(type_, self.string(valoff, end)), end)
+        if type_ == T.STRING_ARRAY:
+            strings = []
+            pos = valoff + 8 * nelem
+            for _ in range(nelem):
+                text = self.string(pos, end)
+                strings.append(text)
+                pos += len(text.encode('utf-8')) + 1
+            return (name, self.result(type_, strings), end)
+        if type_ == T.NVLIST:
+            value, end = self.nvlist(end)
+            return (name, self.result(type_, value), end)
+        if type_ == T.NVLIST_ARRAY:
+            lists = []
+            for _ in range(nelem):
+                value, end = self.nvlist(end)
+                lists.append(value)
+            return (name, self.result(type_, lists), end)
+        fmt = NATIVE_FORMATS.get(type_, None)
+        if fmt is None:
+            raise NVListError('unknown data type %u in pair %s' %
+                              (type_, name))
+        if type_ == T.BYTE_ARRAY:
+            value = bytes(self.view[valoff:valoff+nelem])
+        elif type_ in ARRAY_TYPES:
+            value = list(self.unpack('%u%s' % (nelem, fmt), valoff))
+            if type_ == T.BOOLEAN_ARRAY:
+                value = [bool(v) for v in value]
+        else:
+            value, = self.unpack(fmt, valoff)
+            if type_ == T.BOOLEAN_VALUE:
+                value = bool(value)
+        return (name, self.result(type_, value), end)
+
+class _XDRDecoder(_Decoder):
+    """Decodes NV_ENCODE_XDR data, which is always big endian."""
+
+    def xdr_string(self, offset):
+        length, = self.unpack('I', offset)
+        offset += 4
+        text = bytes(self.view[offset:offset+length]).decode('utf-8')
+        return (text, offset + _align4(length))
+
+    def nvlist(self, offset):
+        offset += 8 # nvl_version, nvl_nvflag
+        result = {}
+        while True:
+            if offset + 8 > len(self.view):
+                raise NVListError('truncated nvlist')
+            encode_size, decode_size = self.unpack('ii', offset)
+            if encode_size == 0 and decode_size == 0:
+                return (result, offset + 8)
+            if encode_size < 0 or offset + encode_size > len(self.view):
+                raise NVListError('bad nvpair size %d' % encode_size)
+            name, value, offset = self.pair(offset + 8)
+            result[name] = value
+
+    def pair(self, offset):
+        # pylint: disable=too-many-return-statements
+        name, offset = self.xdr_string(offset)
+        type_, nelem = self.unpack('ii', offset)
+        offset += 8
+        if type_ == T.BOOLEAN:
+            return (name, self.result(type_, True), offset)
+        if type_ == T.STRING:
+            value, offset = self.xdr_string(offset)
+            return (name, self.result(type_, value), offset)
+        if type_ == T.STRING_ARRAY:
+            strings = []
+            for _ in range(nelem):
+                value, offset = self.xdr_string(offset)
+                strings.append(value)
+            return (name, self.result(type_, strings), offset)
+        if type_ == T.NVLIST:
+            value, offset = self.nvlist(offset)
+            return (name, self.result(type_, value), offset)
+        if type_ == T.NVLIST_ARRAY:
+            lists = []
+            for _ in range(nelem):
+                value, offset = self.nvlist(offset)
+                lists.append(value)
+            return (name, self.result(type_, lists), offset)
+        if type_ == T.BYTE_ARRAY:
+            value = bytes(self.view[offset:offset+nelem])
+            return (name, self.result(type_, value), offset + _align4(nelem))
+        fmt = XDR_FORMATS.get(type_, None)
+        if fmt is None:
+            raise NVListError('unknown data type %u in pair %s' %
+                              (type_, name))
+        if type_ in ARRAY_TYPES:
+            # xdr_array() prefixes the elements with their count
+            count, = self.unpack('I', offset)
+            offset += 4
+            value = list(self.unpack('%u%s' % (count, fmt), offset))
+            offset += struct.calcsize('>%u%s' % (count, fmt))
+            if type_ == T.BOOLEAN_ARRAY:
+                value = [bool(v) for v in value]
+            return (name, self.result(type_, value), offset)
+        value, = self.unpack(fmt, offset)
+        if type_ == T.BOOLEAN_VALUE:
+            value = bool(value)
+        return (name, self.result(type_, value), offset + struct.calcsize(fmt))
+
+def unpack(data, typed=False):
+    """Decode a packed nvlist (bytes, bytearray, memoryview or any other
+    buffer) into a dictionary."""
+    view = memoryview(data).cast('B')
+    if len(view) < 4:
+        raise NVListError('buffer too small')
+    encoding, endian = view[0], view[1]
+    if encoding == NV_ENCODE_NATIVE:
+        decoder = _NativeDecoder(view, '<' if endian else '>', typed)
+    elif encoding == NV_ENCODE_XDR:
+        decoder = _XDRDecoder(view, '>', typed)
+    else:
+        raise NVListError('unknown nvlist encoding %u' % encoding)
+    result, _ = decoder.nvlist(4)
+    return result
+
+class _NativeEncoder(object):
+    """Produces NV_ENCODE_NATIVE data in a given byte order."""
+    def __init__(self, order):
+        self.order = order
+        self.out   = bytearray()
+
+    def put(self, fmt, *values):
+        self.out += struct.pack(self.order + fmt, *values)
+
+    def pad(self, start, size):
+        """pad the data written since start to size bytes"""
+        self.out += bytes(size - (len(self.out) - start))
+
+    def nvlist(self, data, nvflag=NV_UNIQUE_NAME):
+        self.put('iI', NV_VERSION, nvflag)
+        for name, value in data.items():
+            self.pair(name, *_infer(value))
+        self.put('i', 0)
+
+    def pair(self, name, type_, value):
+        raw   = name.encode('utf-8') + b'\0'
+        size  = _native_pair_size(name, type_, value)
+        nelem = _nelem(type_, value)
+        start = len(self.out)
+        self.put('ihhii', size, len(raw), 0, nelem, type_)
+        self.out += raw
+        self.pad(start, _align8(NVPAIR_SIZE + len(raw)))
+        if type_ == T.STRING:
+            self.out += value.encode('utf-8') + b'\0'
+        elif type_ == T.STRING_ARRAY:
+            self.out += bytes(8 * nelem)
+            for text in value:
+                self.out += text.encode('utf-8') + b'\0'
+        elif type_ == T.NVLIST:
+            self.put('iIQIi', NV_VERSION, NV_UNIQUE_NAME, 0, 0, 0)
+        elif type_ == T.NVLIST_ARRAY:
+            self.out += bytes(8 * nelem)
+            for _ in value:
+                self.put('iIQIi', NV_VERSION, NV_UNIQUE_NAME, 0, 0, 0)
+        elif type_ == T.BYTE_ARRAY:
+            self.out += bytes(value)
+        elif type_ in ARRAY_TYPES:
+            self.put('%u%s' % (nelem, NATIVE_FORMATS[type_]), *value)
+        elif type_ != T.BOOLEAN:
+            self.put(NATIVE_FORMATS[type_], value)
+        self.pad(start, size)
+        # embedded lists follow their pair
+        if type_ == T.NVLIST:
+            self.nvlist(value)
+        elif type_ == T.NVLIST_ARRAY:
+            for item in value:
+                self.nvlist(item)
+
+class _XDREncoder(object):
+    """Produces NV_ENCODE_XDR data."""
+    def __init__(self):
+        self.out = bytearray()
+
+    def put(self, fmt, *values):
+        self.out += struct.pack('>' + fmt, *values)
+
+    def xdr_string(self, text):
+        raw = text.encode('utf-8')
+        self.put('I', len(raw))
+        self.out += raw + bytes(_align4(len(raw)) - len(raw))
+
+    def nvlist(self, data, nvflag=NV_UNIQUE_NAME):
+        self.put('iI', NV_VERSION, nvflag)
+        for name, value in data.items():
+            self.pair(name, *_infer(value))
+        self.put('ii', 0, 0)
+
+    def pair(self, name, type_, value):
+        start = len(self.out)
+        # the encoded size is filled in afterwards
+        self.put('ii', 0, _native_pair_size(name, type_, value))
+        self.xdr_string(name)
+        nelem = _nelem(type_, value)
+        self.put('ii', type_, nelem)
+        if type_ == T.STRING:
+            self.xdr_string(value)
+        elif type_ == T.STRING_ARRAY:
+            for text in value:
+                self.xdr_string(text)
+        elif type_ == T.NVLIST:
+            self.nvlist(value)
+        elif type_ == T.NVLIST_ARRAY:
+            for item in value:
+                self.nvlist(item)
+        elif type_ == T.BYTE_ARRAY:
+            self.out += bytes(value) + bytes(_align4(nelem) - nelem)
+        elif type_ in ARRAY_TYPES:
+            self.put('I%u%s' % (nelem, XDR_FORMATS[type_]), nelem, *value)
+        elif type_ != T.BOOLEAN:
+            if type_ not in XDR_FORMATS:
+                raise NVListError('unknown data type %u' % type_)
+            self.put(XDR_FORMATS[type_], value)
+        struct.pack_into('>i', self.out, start, len(self.out) - start)
+
+def pack(data, encoding=NV_ENCODE_NATIVE, little_endian=None,
+         nvflag=NV_UNIQUE_NAME):
+    """Encode a dictionary like nvlist_pack() would. The native encoding
+    uses the host byte order unless little_endian is given."""
+    if little_endian is None:
+        little_endian = struct.pack('=H', 1) == b'\1\0'
+    if encoding == NV_ENCODE_NATIVE:
+        encoder = _NativeEncoder('<' if little_endian else '>')
+    elif encoding == NV_ENCODE_XDR:
+        encoder = _XDREncoder()
+    else:
+        raise NVListError('unknown nvlist encoding %u' % encoding)
+    encoder.out += bytes([encoding, 1 if little_endian else 0, 0, 0])
+    encoder.nvlist(data, nvflag)
+    return bytes(encoder.out)
+
+__all__ = ['NV_VERSION', 'NV_ENCODE_NATIVE', 'NV_ENCODE_XDR',
+           'NV_UNIQUE_NAME', 'NV_UNIQUE_NAME_TYPE', 'DATA_TYPE',
+           'NVListError', 'Typed', 'unpack', 'pack']
@@ -10,3 +10,4 @@ MNAMELEN       = 88
 STATFS_VERSION = 0x20030518
 
 MNT_WAIT       = 1
+MNT_NOWAIT     = 2
@@ -0,0 +1,523 @@
+"""
+In-memory simulation of libgeom's PART class.
+
+SimLib implements the gctl_* functions used by geom.geom against a set of
+simulated disks, and can produce geom snapshots of them. It can be used in
+place of libgeom.so.5 to exercise the partitioning code on any system:
+
+    from geom import geom, sim
+    lib = sim.SimLib()
+    lib.add_disk('ada0', 64 * 1024**3)
+    geom.use_library(lib)
+
+The verbs create, add, delete, destroy, modify, resize, bootcode, commit and
+undo are supported, the errors are reported the way the kernel does
+("<errno> <parameter> '<value>'"). Without the 'x' flag changes are
+committed right away. A failed request leaves the partitions unchanged and
+undoes all pending changes of its disk, like gpart does.
+"""
+
+import copy
+import errno
+import string
+import threading
+from ctypes import string_at
+
+from . import snapshot as snap
+from .geom import PART_SCHEMES, partition_type_known
+
+GPT_ENTRY_SIZE = 128
+MBR_TRACK      = 63
+BSD_BBSIZE     = 8192
+BSD_LETTERS    = string.ascii_lowercase
+
+class SimError(Exception):
+    """Raised inside a verb, turned into the gctl error string."""
+    def __init__(self, err, fmt=None, *args):
+        text = '%d' % err
+        if fmt is not None:
+            text += ' ' + (fmt % args)
+        Exception.__init__(self, text)
+
+class SimPartition(object):
+    """An entry of a simulated partition table."""
+    # pylint: disable=too-few-public-methods
+    __slots__ = ('index', 'start', 'end', 'type', 'label')
+
+    def __init__(self, index, start, end, type_, label):
+        # pylint: disable=too-many-arguments
+        self.index = index
+        self.start = start
+        self.end   = end
+        self.type  = type_
+        self.label = label
+
+class SimTable(object):
+    """A simulated partition table."""
+    def __init__(self, scheme, entries, first, last):
+        self.scheme     = scheme
+        self.entries    = entries
+        self.first      = first
+        self.last       = last
+        self.partitions = {}
+        self.bootcode   = None
+
+    def sorted(self):
+        """The partitions sorted by their position"""
+        return sorted(self.partitions.values(), key=lambda p: p.start)
+
+    def overlaps(self, start, end, skip=None):
+        """Find a partition overlapping the sector range [start, end]."""
+        for par in self.partitions.values():
+            if par is not skip and par.start <= end and start <= par.end:
+                return par
+        return None
+
+    def free_extent(self, start=None):
+        """The first free extent (at or containing start), or None."""
+        sector = self.first
+        for par in self.sorted():
+            if par.start > sector:
+                if start is None or sector <= start < par.start:
+                    return (sector, par.start - 1)
+            sector = max(sector, par.end + 1)
+        if sector <= self.last:
+            if start is None or sector <= start <= self.last:
+                return (sector, self.last)
+        return None
+
+class SimDisk(object):
+    """A simulated provider which can carry a partition table. Layered
+    providers like mirrors or ELI devices consume other providers."""
+    # pylint: disable=too-many-instance-attributes
+    # pylint: disable=too-many-arguments
+    def __init__(self, name, mediasize, sectorsize=512, stripesize=0,
+                 stripeoffset=0, class_name='DISK', consumes=()):
+        self.name         = name
+        self.mediasize    = mediasize
+        self.sectorsize   = sectorsize
+        self.stripesize   = stripesize
+        self.stripeoffset = stripeoffset
+        self.class_name   = class_name
+        self.consumes     = list(consumes)
+        self.config       = {}
+        self.committed    = None
+        self.table        = None
+        self.busy         = set()
+
+    @property
+    def sectors(self):
+        return self.mediasize // self.sectorsize
+
+    @property
+    def modified(self):
+        return self.table is not self.committed
+
+def partition_name(disk, scheme, index):
+    """Name of a partition's provider like gpart names them."""
+    if scheme == 'GPT':
+        return '%sp%u' % (disk, index)
+    elif scheme == 'MBR':
+        return '%ss%u' % (disk, index)
+    return '%s%s' % (disk, BSD_LETTERS[index-1])
+
+def _parse_int(name, value):
+    if isinstance(value, int):
+        return value
+    try:
+        return int(value, 0)
+    except (TypeError, ValueError):
+        raise SimError(errno.EINVAL, "%s '%s'", name, value)
+
+class SimRequest(object):
+    """What gctl_get_handle returns."""
+    # pylint: disable=too-few-public-methods
+    def __init__(self):
+        self.params = {}
+
+class SimLib(object):
+    """Stand-in for libgeom, see the module documentation."""
+
+    def __init__(self):
+        self.disks   = {}
+        self.ids     = 0
+        self.issued  = 0
+        # like the kernel's topology lock
+        self.lock    = threading.Lock()
+
+    def add_disk(self, name, mediasize, sectorsize=512, stripesize=0,
+                 stripeoffset=0, class_name='DISK', consumes=(), config=None):
+        """Add a provider, returns the SimDisk."""
+        # pylint: disable=too-many-arguments
+        disk = SimDisk(name, mediasize, sectorsize, stripesize, stripeoffset,
+                       class_name, consumes)
+        if config is not None:
+            disk.config.update(config)
+        self.disks[name] = disk
+        return disk
+
+    def add_layer(self, class_name, name, consumes, mediasize=None):
+        """Add a provider stacked on top of others, eg. a MIRROR or ELI
+        device. Without a mediasize it uses the smallest consumed one."""
+        lower = [self.provider_geometry(prov) for prov in consumes]
+        if mediasize is None:
+            mediasize = min(size for size, _ in lower)
+        sectorsize = max(sector for _, sector in lower)
+        return self.add_disk(name, mediasize, sectorsize,
+                             class_name=class_name, consumes=consumes)
+
+    def provider_geometry(self, name):
+        """Find a disk or partition, returns its (mediasize, sectorsize)."""
+        disk = self.disks.get(name, None)
+        if disk is not None:
+            return disk.mediasize, disk.sectorsize
+        for disk in self.disks.values():
+            table = disk.table
+            if table is None or not name.startswith(disk.name):
+                continue
+            for par in table.partitions.values():
+                if partition_name(disk.name, table.scheme, par.index) == name:
+                    return ((par.end - par.start + 1) * disk.sectorsize,
+                            disk.sectorsize)
+        raise KeyError(name)
+
+    # libgeom interface
+
+    @staticmethod
+    def gctl_get_handle():
+        return SimRequest()
+
+    @staticmethod
+    def gctl_ro_param(req, key, size, value):
+        """Read the parameters like the kernel would, straight from the
+        ctypes buffers."""
+        name = key.value.decode('utf-8')
+        obj  = getattr(value, '_obj', None)
+        if obj is not None:
+            # byref(c_long)
+            req.params[name] = obj.value
+            return
+        if size < 0:
+            data = string_at(value.value)
+        else:
+            data = string_at(value.value, size)
+        if name in ('bootcode',):
+            req.params[name] = data
+        else:
+            req.params[name] = data.rstrip(b'\0').decode('utf-8')
+
+    gctl_rw_param = gctl_ro_param
+
+    @staticmethod
+    def gctl_free(req):
+        req.params = None
+
+    def gctl_issue(self, req):
+        """Run a request, returns None or the error as bytes."""
+        with self.lock:
+            return self.__issue(req)
+
+    def __issue(self, req):
+        self.issued += 1
+        params = dict(req.params)
+        if params.pop('class', None) != 'PART':
+            return b'Class not found'
+        verb = params.pop('verb', None)
+        func = getattr(self, 'verb_%s' % verb, None)
+        if func is None:
+            return ('%d verb \'%s\'' % (errno.EINVAL, verb)).encode('utf-8')
+        name = params.pop('arg0', None)
+        disk = self.disks.get(name, None)
+        if disk is None:
+            return ('%d geom \'%s\'' % (errno.EINVAL, name)).encode('utf-8')
+        flags = params.pop('flags', '')
+        if verb not in ('commit', 'undo') and disk.table is disk.committed:
+            # start a new set of pending changes
+            disk.table = copy.deepcopy(disk.committed)
+        try:
+            func(disk, params)
+        except SimError as err:
+            self.verb_undo(disk, {})
+            return str(err).encode('utf-8')
+        if 'x' not in flags and verb not in ('commit', 'undo'):
+            self.verb_commit(disk, {})
+        return None
+
+    # verbs
+
+    @staticmethod
+    def __table(disk):
+        if disk.table is None:
+            raise SimError(errno.EINVAL, "geom '%s'", disk.name)
+        return disk.table
+
+    @staticmethod
+    def __check(params, allowed):
+        for name in params:
+            if name not in allowed:
+                raise SimError(errno.EINVAL, "param '%s'", name)
+
+    def verb_create(self, disk, params):
+        """gpart create"""
+        self.__check(params, ('scheme', 'entries'))
+        if disk.table is not None:
+            raise SimError(errno.EEXIST, "geom '%s'", disk.name)
+        scheme = params.get('scheme', '').upper()
+        limit  = PART_SCHEMES.get(scheme, None)
+        if limit is None:
+            raise SimError(errno.EINVAL, "scheme '%s'", params.get('scheme'))
+        entries = limit
+        if 'entries' in params:
+            entries = _parse_int('entries', params['entries'])
+            if entries < 1 or (scheme != 'GPT' and entries > limit):
+                raise SimError(errno.EINVAL, "entries '%s'", entries)
+        sectors = disk.sectors
+        if scheme == 'GPT':
+            tblsz = -(-(entries * GPT_ENTRY_SIZE) // disk.sectorsize)
+            first = 2 + tblsz
+            last  = sectors - 2 - tblsz
+        elif scheme == 'MBR':
+            first = MBR_TRACK
+            last  = min(sectors, 0xffffffff) - 1
+        else:
+            first = BSD_BBSIZE // disk.sectorsize
+            last  = sectors - 1
+        if last <= first:
+            raise SimError(errno.ENOSPC, "geom '%s'", disk.name)
+        disk.table = SimTable(scheme, entries, first, last)
+
+    def verb_destroy(self, disk, params):
+        """gpart destroy"""
+        self.__check(params, ('force',))
+        table = self.__table(disk)
+        if len(table.partitions) and params.get('force', '0') == '0':
+            raise SimError(errno.EBUSY)
+        if disk.busy:
+            raise SimError(errno.EBUSY)
+        disk.table = None
+
+    def verb_add(self, disk, params):
+        """gpart add"""
+        self.__check(params, ('type', 'start', 'size', 'label', 'index'))
+        table = self.__table(disk)
+        type_ = params.get('type', None)
+        if type_ is None:
+            raise SimError(errno.EINVAL, "type")
+        if not partition_type_known(table.scheme, type_):
+            raise SimError(errno.EINVAL, "type '%s'", type_)
+        label = params.get('label', None)
+        if label is not None and table.scheme != 'GPT':
+            raise SimError(errno.ENODEV, "label '%s'", label)
+
+        if 'index' in params:
+            index = _parse_int('index', params['index'])
+            if index < 1 or index > table.entries:
+                raise SimError(errno.EINVAL, "index '%d'", index)
+            if index in table.partitions:
+                raise SimError(errno.EEXIST, "index '%d'", index)
+        else:
+            index = next((i for i in range(1, table.entries+1)
+                          if i not in table.partitions), None)
+            if index is None:
+                raise SimError(errno.ENOSPC)
+
+        if 'start' in params:
+            start = _parse_int('start', params['start'])
+            extent = table.free_extent(start)
+            if start < table.first or start > table.last:
+                raise SimError(errno.EINVAL, "start '%d'", start)
+            if extent is None:
+                raise SimError(errno.EEXIST, "start '%d'", start)
+        else:
+            extent = table.free_extent()
+            if extent is None:
+                raise SimError(errno.ENOSPC)
+            start = extent[0]
+
+        if 'size' in params:
+            size = _parse_int('size', params['size'])
+            if size < 1:
+                raise SimError(errno.EINVAL, "size '%d'", size)
+        else:
+            size = extent[1] - start + 1
+
+        if table.scheme == 'MBR':
+            start, size = self.__mbr_align(start, size)
+        end = start + size - 1
+        if end > table.last:
+            raise SimError(errno.EINVAL, "size '%d'", size)
+        if table.overlaps(start, end) is not None:
+            raise SimError(errno.EEXIST, "size '%d'", size)
+        table.partitions[index] = SimPartition(index, start, end, type_, label)
+
+    @staticmethod
+    def __mbr_align(start, size):
+        """MBR partitions are aligned to tracks."""
+        if start % MBR_TRACK:
+            size  -= MBR_TRACK - start % MBR_TRACK
+            start += MBR_TRACK - start % MBR_TRACK
+        size -= size % MBR_TRACK
+        if size < MBR_TRACK:
+            raise SimError(errno.EINVAL, "size '%d'", size)
+        return start, size
+
+    def __entry(self, disk, params):
+        table = self.__table(disk)
+        if 'index' not in params:
+            raise SimError(errno.EINVAL, "index")
+        index = _parse_int('index', params['index'])
+        par = table.partitions.get(index, None)
+        if par is None:
+            raise SimError(errno.ENOENT, "index '%d'", index)
+        return table, par
+
+    def verb_delete(self, disk, params):
+        """gpart delete"""
+        self.__check(params, ('index',))
+        table, par = self.__entry(disk, params)
+        if partition_name(disk.name, table.scheme, par.index) in disk.busy:
+            raise SimError(errno.EBUSY)
+        del table.partitions[par.index]
+
+    def verb_modify(self, disk, params):
+        """gpart modify"""
+        self.__check(params, ('index', 'type', 'label'))
+        table, par = self.__entry(disk, params)
+        if 'type' in params:
+            if not partition_type_known(table.scheme, params['type']):
+                raise SimError(errno.EINVAL, "type '%s'", params['type'])
+        if 'label' in params:
+            if table.scheme != 'GPT':
+                raise SimError(errno.ENODEV, "label '%s'", params['label'])
+        if 'type' in params:
+            par.type = params['type']
+        if 'label' in params:
+            par.label = params['label']
+
+    def verb_resize(self, disk, params):
+        """gpart resize"""
+        self.__check(params, ('index', 'size'))
+        table, par = self.__entry(disk, params)
+        if 'size' in params:
+            size = _parse_int('size', params['size'])
+        else:
+            extent = table.free_extent(par.end + 1)
+            size = (extent[1] if extent else par.end) - par.start + 1
+        end = par.start + size - 1
+        if size < 1 or end > table.last:
+            raise SimError(errno.EINVAL, "size '%d'", size)
+        if table.overlaps(par.start, end, skip=par) is not None:
+            raise SimError(errno.ENOSPC, "size '%d'", size)
+        par.end = end
+
+    def verb_bootcode(self, disk, params):
+        """gpart bootcode (the -b part)"""
+        self.__check(params, ('bootcode',))
+        table = self.__table(disk)
+        code = params.get('bootcode', None)
+        if code is None:
+            raise SimError(errno.EINVAL, "bootcode")
+        if len(code) > disk.sectorsize:
+            raise SimError(errno.EFBIG, "bootcode size")
+        table.bootcode = code
+
+    @staticmethod
+    def verb_commit(disk, params):
+        """gpart commit"""
+        # pylint: disable=unused-argument
+        disk.committed = disk.table
+
+    @staticmethod
+    def verb_undo(disk, params):
+        """gpart undo"""
+        # pylint: disable=unused-argument
+        disk.table = disk.committed
+
+    # topology
+
+    def __id(self):
+        self.ids += 1
+        return self.ids
+
+    @staticmethod
+    def __configs(pairs):
+        return [snap.Config(name, str(value))
+                for name, value in pairs if value is not None]
+
+    def snapshot(self):
+        """Build a geom.snapshot.Snapshot of the simulated topology,
+        including the uncommitted changes like the kernel does."""
+        with self.lock:
+            return self.__snapshot()
+
+    def __snapshot(self):
+        result  = snap.Snapshot()
+        classes = {}
+        ids     = {}
+        layers  = []
+
+        def provider(gobj, name, mediasize, sectorsize, stripesize,
+                     stripeoffset, configs):
+            # pylint: disable=too-many-arguments
+            ids[name] = self.__id()
+            return result.add_provider(gobj, ids[name], name, 'r0w0e0',
+                                       mediasize, sectorsize, stripeoffset,
+                                       stripesize, self.__configs(configs))
+
+        def geom_class(name):
+            cls = classes.get(name, None)
+            if cls is None:
+                cls = classes[name] = result.add_class(self.__id(), name)
+            return cls
+
+        for disk in self.disks.values():
+            cls  = geom_class(disk.class_name)
+            gobj = result.add_geom(cls, self.__id(), disk.name,
+                                   1 + len(disk.consumes))
+            provider(gobj, disk.name, disk.mediasize, disk.sectorsize,
+                     disk.stripesize, disk.stripeoffset,
+                     sorted(disk.config.items()))
+            layers.append((gobj, disk.consumes))
+
+            if disk.table is None:
+                continue
+            table = disk.table
+            part  = result.add_geom(geom_class('PART'), self.__id(),
+                                    disk.name, 2 + len(disk.consumes),
+                                    self.__configs([
+                                        ('scheme',   table.scheme),
+                                        ('entries',  table.entries),
+                                        ('first',    table.first),
+                                        ('last',     table.last),
+                                        ('state',    'OK'),
+                                        ('modified', str(disk.modified)
+                                                     .lower())]))
+            layers.append((part, [disk.name]))
+            for par in table.sorted():
+                length = (par.end - par.start + 1) * disk.sectorsize
+                offset = par.start * disk.sectorsize
+                stripeoffset = 0
+                if disk.stripesize:
+                    stripeoffset = ((disk.stripeoffset + offset)
+                                    % disk.stripesize)
+                provider(part, partition_name(disk.name, table.scheme,
+                                              par.index),
+                         length, disk.sectorsize, disk.stripesize,
+                         stripeoffset,
+                         [('start',   par.start),
+                          ('end',     par.end),
+                          ('index',   par.index),
+                          ('type',    par.type),
+                          ('offset',  offset),
+                          ('length',  length),
+                          ('rawtype', par.type),
+                          ('label',   par.label)])
+
+        for gobj, consumes in layers:
+            for name in consumes:
+                result.add_consumer(gobj, self.__id(), ids.get(name, None),
+                                    'r1w1e1')
+        return result.finish()
+
+__all__ = ['SimError', 'SimPartition', 'SimTable', 'SimDisk', 'SimLib',
+           'partition_name']
@@ -0,0 +1,230 @@
+"""
+Plain python copies of a geom tree.
+
+Walking the ctypes structures of a libgeom mesh decodes the C strings and
+dereferences the pointers again on every access, and the tree has to stay
+allocated for as long as anything refers to it. A Snapshot is filled in a
+single pass and does not depend on any C memory afterwards.
+
+The objects mimic the accessors of the ctypes structures in geom.geom
+(name, configs(), providers(), ...) so code can work with either.
+"""
+
+class ConfigMap(object):
+    """Mixin providing a dictionary of an object's <config> entries, built
+    on first use with a single walk over configs(), and typed accessors."""
+    __slots__ = ()
+
+    @property
+    def config(self):
+        cfg = getattr(self, '_config', None)
+        if cfg is None:
+            cfg = dict((c.name, c.value) for c in self.configs())
+            self._config = cfg
+        return cfg
+
+    def cfg_str(self, name, default=None):
+        """Get a config entry as string."""
+        return self.config.get(name, default)
+
+    def cfg_int(self, name, default=None):
+        """Get a config entry as integer."""
+        value = self.config.get(name, None)
+        if value is None:
+            return default
+        return int(value)
+
+class Config(object):
+    """A single <config> name/value pair."""
+    __slots__ = ('name', 'value')
+
+    def __init__(self, name, value):
+        self.name  = name
+        self.value = value
+
+    @property
+    def val(self):
+        return self.value
+
+class Class(ConfigMap):
+    """A geom class, eg. PART, DISK, ELI..."""
+    __slots__ = ('id', 'name', '_geoms', '_configs', '_config')
+
+    def __init__(self, id_, name, configs):
+        self.id       = id_
+        self.name     = name
+        self._geoms   = []
+        self._configs = configs
+
+    def geoms(self):
+        return iter(self._geoms)
+
+    def configs(self):
+        return iter(self._configs)
+
+class Geom(ConfigMap):
+    """A geom, an instance of a class, eg. a partition table on a disk."""
+    __slots__ = ('id', 'class_', 'name', 'rank',
+                 '_consumers', '_providers', '_configs', '_config')
+
+    def __init__(self, id_, class_, name, rank, configs):
+        self.id         = id_
+        self.class_     = class_
+        self.name       = name
+        self.rank       = rank
+        self._consumers = []
+        self._providers = []
+        self._configs   = configs
+
+    def consumers(self):
+        return iter(self._consumers)
+
+    def providers(self):
+        return iter(self._providers)
+
+    def configs(self):
+        return iter(self._configs)
+
+class Consumer(ConfigMap):
+    """The lower end of a geom, attached to another geom's provider."""
+    __slots__ = ('id', 'geom', 'provider', 'mode', '_configs', '_config')
+
+    def __init__(self, id_, geom, mode, configs):
+        self.id       = id_
+        self.geom     = geom
+        self.provider = None
+        self.mode     = mode
+        self._configs = configs
+
+    def providers(self):
+        """The provider this consumer is attached to, as an iterator to match
+        the ctypes interface."""
+        if self.provider is not None:
+            yield self.provider
+
+    def configs(self):
+        return iter(self._configs)
+
+class Provider(ConfigMap):
+    """The upper end of a geom, eg. a disk or partition device."""
+    # pylint: disable=too-many-instance-attributes
+    # pylint: disable=too-many-arguments
+    __slots__ = ('id', 'name', 'geom', 'mode', 'mediasize', 'sectorsize',
+                 'stripeoffset', 'stripesize', '_consumers', '_configs',
+                 '_config')
+
+    def __init__(self, id_, geom, name, mode, mediasize, sectorsize,
+                 stripeoffset, stripesize, configs):
+        self.id           = id_
+        self.geom         = geom
+        self.name         = name
+        self.mode         = mode
+        self.mediasize    = mediasize
+        self.sectorsize   = sectorsize
+        self.stripeoffset = stripeoffset
+        self.stripesize   = stripesize
+        self._consumers   = []
+        self._configs     = configs
+
+    def consumers(self):
+        return iter(self._consumers)
+
+    def configs(self):
+        return iter(self._configs)
+
+class Snapshot(object):
+    """A complete copy of a geom tree.
+
+    Backends fill it through the add_* methods, referring to other objects
+    by their id, and call finish() once everything was added to resolve the
+    consumer->provider links.
+
+    After finish() the following indexes are available:
+        classes_by_name:     class name -> Class
+        providers_by_name:   provider name -> Provider
+        geoms_by_id:         geom id -> Geom
+        consumer_provider:   consumer id -> Provider
+        provider_consumers:  provider name -> list of Consumers
+    """
+    # pylint: disable=protected-access
+
+    def __init__(self):
+        self._classes  = []
+        self._links    = []
+
+        self.classes_by_name    = {}
+        self.providers_by_name  = {}
+        self.geoms_by_id        = {}
+        self.consumer_provider  = {}
+        self.provider_consumers = {}
+
+    def add_class(self, id_, name, configs=()):
+        """Add a class, returns the new object."""
+        cls = Class(id_, name, list(configs))
+        self._classes.append(cls)
+        self.classes_by_name[name] = cls
+        return cls
+
+    def add_geom(self, cls, id_, name, rank, configs=()):
+        """Add a geom to a class previously returned by add_class."""
+        gobj = Geom(id_, cls, name, rank, list(configs))
+        cls._geoms.append(gobj)
+        self.geoms_by_id[id_] = gobj
+        return gobj
+
+    def add_provider(self, gobj, id_, name, mode, mediasize, sectorsize,
+                     stripeoffset=0, stripesize=0, configs=()):
+        """Add a provider to a geom previously returned by add_geom."""
+        # pylint: disable=too-many-arguments
+        prov = Provider(id_, gobj, name, mode, mediasize, sectorsize,
+                        stripeoffset, stripesize, list(configs))
+        gobj._providers.append(prov)
+        self.providers_by_name[name] = prov
+        return prov
+
+    def add_consumer(self, gobj, id_, provider_id, mode, configs=()):
+        """Add a consumer to a geom. The provider is referred to by its id and
+        does not need to exist yet."""
+        # pylint: disable=too-many-arguments
+        cons = Consumer(id_, gobj, mode, list(configs))
+        gobj._consumers.append(cons)
+        if provider_id is not None:
+            self._links.append((cons, provider_id))
+        return cons
+
+    def finish(self):
+        """Resolve the consumer->provider links and fill the reverse maps."""
+        providers = {}
+        for prov in self.providers_by_name.values():
+            providers[prov.id] = prov
+        for cons, provider_id in self._links:
+            prov = providers.get(provider_id, None)
+            if prov is None:
+                continue
+            cons.provider = prov
+            prov._consumers.append(cons)
+            self.consumer_provider[cons.id] = prov
+            self.provider_consumers.setdefault(prov.name, []).append(cons)
+        self._links = []
+        return self
+
+    def classes(self):
+        return iter(self._classes)
+
+    def find_class(self, name):
+        if isinstance(name, bytes):
+            name = name.decode('utf-8')
+        return self.classes_by_name.get(name, None)
+
+    def find_provider(self, name):
+        return self.providers_by_name.get(name, None)
+
+__all__ = [
+    'ConfigMap',
+    'Config',
+    'Class',
+    'Geom',
+    'Consumer',
+    'Provider',
+    'Snapshot',
+]
@@ -0,0 +1,125 @@
+"""
+Tests of the kern.geom.confxml parser against a captured topology.
+
+data/confxml-gpt.xml is the topology of a disk installed with a GPT
+table (boot, root and swap partitions), a GPT label and the DEV and SWAP
+geoms which consume the partitions.
+"""
+
+import os
+import unittest
+
+from geom import confxml, geom, sim
+
+DATA = os.path.join(os.path.dirname(__file__), 'data')
+CONFXML = os.path.join(DATA, 'confxml-gpt.xml')
+
+# (type, start, end, label) by index
+PARTITIONS = {
+    1: ('freebsd-boot', 40, 1063, 'gptboot0'),
+    2: ('freebsd-ufs', 2048, 14682111, 'rootfs'),
+    3: ('freebsd-swap', 14682112, 16777175, 'swap0'),
+}
+
+def simulated():
+    """The same topology from the simulated libgeom."""
+    lib = sim.SimLib()
+    geom.use_library(lib)
+    lib.add_disk('ada0', 8 * 1024**3, 512, 4096,
+                 config={'fwheads': '16', 'fwsectors': '63'})
+    txn = geom.PartTransaction()
+    txn.create('ada0', 'GPT')
+    for index, (type_, start, end, label) in sorted(PARTITIONS.items()):
+        txn.add('ada0', type_, start=start, size=end - start + 1,
+                label=label, index=index)
+    errors = txn.execute()
+    errors.update(txn.commit())
+    if len(errors):
+        raise Exception('failed to build the topology: %r' % errors)
+    lib.add_layer('LABEL', 'gpt/rootfs', ['ada0p2'])
+    return lib.snapshot()
+
+class ParseTest(unittest.TestCase):
+    def setUp(self):
+        self.mesh = confxml.parse(CONFXML)
+
+    def tearDown(self):
+        geom.geom_undo_all()
+
+    def test_classes(self):
+        self.assertEqual([cls.name for cls in self.mesh.classes()],
+                         ['FD', 'MD', 'DISK', 'PART', 'LABEL', 'DEV', 'SWAP'])
+        self.assertEqual([gobj.name for gobj in
+                          self.mesh.find_class('DEV').geoms()],
+                         ['ada0', 'ada0p1', 'ada0p2', 'ada0p3'])
+        self.assertEqual(list(self.mesh.find_class('FD').geoms()), [])
+
+    def test_geoms(self):
+        table = next(self.mesh.find_class('PART').geoms())
+        self.assertEqual(table.name, 'ada0')
+        self.assertEqual(table.rank, 2)
+        self.assertEqual(table.cfg_str('scheme'), 'GPT')
+        self.assertEqual(table.cfg_int('last'), 16777182)
+        self.assertEqual(table.cfg_str('modified'), 'false')
+        self.assertEqual([prov.name for prov in table.providers()],
+                         ['ada0p3', 'ada0p2', 'ada0p1'])
+        self.assertEqual([prov.name for cons in table.consumers()
+                          for prov in cons.providers()], ['ada0'])
+
+    def test_providers(self):
+        disk = self.mesh.find_provider('ada0')
+        self.assertEqual((disk.mediasize, disk.sectorsize, disk.stripesize,
+                          disk.stripeoffset, disk.mode),
+                         (8589934592, 512, 4096, 0, 'r2w2e5'))
+        self.assertEqual(disk.cfg_str('descr'), 'VBOX HARDDISK')
+        # empty elements are read as None
+        self.assertIsNone(disk.cfg_str('lunid', ''))
+        for index, (type_, start, end, label) in PARTITIONS.items():
+            prov = self.mesh.find_provider('ada0p%u' % index)
+            self.assertEqual((prov.cfg_str('type'), prov.cfg_int('start'),
+                              prov.cfg_int('end'), prov.cfg_str('label')),
+                             (type_, start, end, label))
+            self.assertEqual(prov.mediasize, (end - start + 1) * 512)
+
+    def test_links(self):
+        swap = self.mesh.find_provider('ada0p3')
+        self.assertEqual(sorted(cons.geom.class_.name
+                                for cons in swap.consumers()),
+                         ['DEV', 'SWAP'])
+        label = self.mesh.find_provider('gpt/rootfs')
+        self.assertEqual(next(next(label.geom.consumers()).providers()).name,
+                         'ada0p2')
+
+    def test_indexes(self):
+        """The indexes agree with a snapshot of the same topology taken
+        through the (simulated) library."""
+        other = simulated()
+        for name in ('DISK', 'PART', 'LABEL'):
+            self.assertIn(name, self.mesh.classes_by_name)
+        self.assertEqual(set(self.mesh.providers_by_name),
+                         set(other.providers_by_name))
+        for name, prov in other.providers_by_name.items():
+            mine = self.mesh.providers_by_name[name]
+            self.assertEqual((mine.mediasize, mine.sectorsize,
+                              mine.geom.class_.name),
+                             (prov.mediasize, prov.sectorsize,
+                              prov.geom.class_.name))
+            if prov.geom.class_.name != 'PART':
+                continue
+            for key in ('start', 'end', 'index', 'type', 'offset', 'length',
+                        'label'):
+                self.assertEqual(mine.cfg_str(key), prov.cfg_str(key))
+        for mesh in (self.mesh, other):
+            self.assertEqual(len(mesh.geoms_by_id),
+                             sum(len(list(cls.geoms()))
+                                 for cls in mesh.classes()))
+            for cons_id, prov in mesh.consumer_provider.items():
+                self.assertIn(cons_id, [cons.id for cons in prov.consumers()])
+        # the DEV and SWAP geoms only exist in the captured topology
+        self.assertEqual(
+            sorted(cons.geom.class_.name for cons in
+                   self.mesh.provider_consumers['ada0p2']),
+            ['DEV', 'LABEL'])
+        self.assertEqual(
+            [cons.geom.class_.name for cons in
+             other.provider_consumers['ada0p2']], ['LABEL'])
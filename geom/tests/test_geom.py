@@ -0,0 +1,40 @@
+"""
+Tests of the ctypes structures of geom.geom, filled in by hand.
+"""
+
+from ctypes import pointer
+import unittest
+
+from geom import geom
+
+def provider(pairs):
+    """A GProvider with a list of <config> entries."""
+    configs = [geom.GConfig(lg_name=name.encode('utf-8'),
+                            lg_val=value.encode('utf-8'))
+               for name, value in pairs]
+    for cfg, following in zip(configs, configs[1:]):
+        cfg.lg_config.le_next = pointer(following)
+    prov = geom.GProvider(lg_name=b'ada0p1')
+    prov.lg_config = pointer(configs[0])
+    # the structures only hold pointers, keep the entries alive
+    return pointer(prov), configs
+
+class LiveConfigMapTest(unittest.TestCase):
+    def test_config(self):
+        prov, _ = provider([('type', 'freebsd-ufs'), ('start', '40'),
+                            ('label', 'rootfs')])
+        self.assertEqual(prov[0].config, {'type': 'freebsd-ufs',
+                                          'start': '40', 'label': 'rootfs'})
+        self.assertEqual(prov[0].cfg_str('label'), 'rootfs')
+        self.assertEqual(prov[0].cfg_int('start'), 40)
+        self.assertIsNone(prov[0].cfg_int('end'))
+        self.assertEqual(prov[0].cfg_str('end', '-'), '-')
+
+    def test_not_cached(self):
+        """Every dereference is a new structure, nothing is kept on them."""
+        prov, configs = provider([('type', 'freebsd-ufs')])
+        self.assertEqual(prov[0].cfg_str('type'), 'freebsd-ufs')
+        self.assertIsNot(prov[0], prov[0])
+        configs[0].lg_val = b'freebsd-zfs'
+        self.assertEqual(prov[0].config, {'type': 'freebsd-zfs'})
+        self.assertFalse(hasattr(prov[0], '_config'))
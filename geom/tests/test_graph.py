@@ -0,0 +1,57 @@
+"""
+Tests of the geom dependency graph on a simulated topology.
+"""
+
+import unittest
+
+from geom import graph, sim
+
+GiB = 1024**3
+
+class TeardownTest(unittest.TestCase):
+    def setUp(self):
+        lib = sim.SimLib()
+        lib.add_disk('ada0', 8 * GiB)
+        lib.add_layer('ELI', 'ada0.eli', ['ada0'])
+        # a pool vdev consumes the device without providing anything
+        lib.add_disk('zfs::vdev', 0, class_name='ZFS::VDEV',
+                     consumes=['ada0.eli'])
+        lib.add_disk('ada1', 8 * GiB)
+        lib.add_disk('zfs::vdev1', 0, class_name='ZFS::VDEV',
+                     consumes=['ada1'])
+        self.snapshot = lib.snapshot()
+        self.graph    = graph.GeomGraph(self.snapshot)
+        self.vdev     = next(gobj for gobj in self.graph.nodes.values()
+                             if gobj.name == 'zfs::vdev')
+
+    def test_zpool_of(self):
+        self.assertEqual(graph.zpool_of(self.vdev, {'ada0.eli': 'zroot'}),
+                         'zroot')
+        self.assertIsNone(graph.zpool_of(self.vdev, {'ada1': 'zroot'}))
+
+    def test_held(self):
+        """A pool's vdev is not treated as stopped, so nothing below it is
+        touched and the error names the pool. The pool configs are read
+        once for all vdevs."""
+        calls = []
+        def pool_devices():
+            calls.append(None)
+            return {'ada0.eli': 'zroot', 'ada1': 'tank'}
+        stopped = []
+        def stop(gobj):
+            stopped.append(gobj.name)
+        original = graph.pool_devices
+        graph.pool_devices = pool_devices
+        try:
+            errors = self.graph.teardown(['ada0', 'ada1'], stop=stop)
+        finally:
+            graph.pool_devices = original
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(stopped, [])
+        held = dict((gobj.name, err) for gobj, err in errors.items()
+                    if gobj.class_.name == 'ZFS::VDEV')
+        self.assertEqual(held, {'zfs::vdev': 'held by zpool zroot',
+                                'zfs::vdev1': 'held by zpool tank'})
+        self.assertEqual(sorted(err for gobj, err in errors.items()
+                                if gobj.class_.name != 'ZFS::VDEV'),
+                         ['blocked by zfs::vdev'])
@@ -0,0 +1,51 @@
+"""
+Tests of the simulated PART class.
+"""
+
+import unittest
+
+from geom import sim
+
+GiB = 1024**3
+
+class ModifyTest(unittest.TestCase):
+    def setUp(self):
+        self.lib = sim.SimLib()
+        self.disk = self.lib.add_disk('ada0', 8 * GiB)
+
+    def issue(self, verb, flags='', **params):
+        req = sim.SimRequest()
+        req.params = dict(params, verb=verb, arg0='ada0', flags=flags)
+        req.params['class'] = 'PART'
+        return self.lib.gctl_issue(req)
+
+    def partition(self, index):
+        par = self.disk.table.partitions[index]
+        return (par.type, par.label)
+
+    def test_failed_modify(self):
+        """The type is not changed when the label is rejected."""
+        self.assertIsNone(self.issue('create', scheme='MBR'))
+        self.assertIsNone(self.issue('add', type='freebsd', size='2097152'))
+        self.assertEqual(self.issue('modify', index='1', type='ntfs',
+                                    label='data'),
+                         b"19 label 'data'")
+        self.assertEqual(self.partition(1), ('freebsd', None))
+
+    def test_failure_undoes_pending(self):
+        """A failed request undoes all pending changes of the disk, not
+        only its own."""
+        self.assertIsNone(self.issue('create', scheme='GPT'))
+        self.assertIsNone(self.issue('add', type='freebsd-ufs',
+                                     size='2097152'))
+        self.assertIsNone(self.issue('add', flags='x', type='freebsd-swap',
+                                     size='2097152'))
+        self.assertIsNone(self.issue('modify', flags='x', index='1',
+                                     label='rootfs'))
+        self.assertTrue(self.disk.modified)
+        self.assertEqual(self.issue('modify', flags='x', index='2',
+                                    type='bogus'),
+                         b"22 type 'bogus'")
+        self.assertFalse(self.disk.modified)
+        self.assertEqual(sorted(self.disk.table.partitions), [1])
+        self.assertEqual(self.partition(1), ('freebsd-ufs', None))
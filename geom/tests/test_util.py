@@ -0,0 +1,114 @@
+"""
+Tests of geom.util which do not need FreeBSD.
+"""
+
+import os
+import threading
+import time
+import unittest
+
+from geom import util
+
+class LibraryTest(unittest.TestCase):
+    def test_concurrent_open(self):
+        """Threads using a library while it is being opened must wait for
+        the handle instead of seeing it as missing."""
+        original = util.open_library
+        def slow_open(*args):
+            time.sleep(0.05)
+            return object()
+        util.open_library = slow_open
+        try:
+            lib = util.Library('libslow.so')
+            results = []
+            threads = [threading.Thread(
+                           target=lambda: results.append(lib.handle()))
+                       for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            util.open_library = original
+            util.libraries.remove(lib)
+        self.assertEqual(len(results), 8)
+        self.assertTrue(all(handle is results[0] for handle in results))
+        self.assertIsNotNone(results[0])
+
+class StaticMounts(object):
+    """A mount table backend which never changes."""
+    def __init__(self, mounts):
+        self.mounts = mounts
+
+    def changed(self):
+        return False
+
+    def read(self):
+        return list(self.mounts)
+
+class MountTableTest(unittest.TestCase):
+    def setUp(self):
+        self.table = util.MountTable(StaticMounts([
+            ('/dev/ada0p2', '/', 'ufs'),
+            ('/dev/ada0p3', '/mnt', 'ufs'),
+            ('/dev/ada0p4', '/mnt/var', 'ufs'),
+        ]))
+
+    def test_containing(self):
+        self.assertEqual(self.table.containing('/mnt/var/cache').target,
+                         '/mnt/var')
+        self.assertEqual(self.table.containing('/mnt/usr/').target, '/mnt')
+        self.assertEqual(self.table.containing('/').target, '/')
+
+    def test_containing_relative(self):
+        cwd = os.getcwd()
+        os.chdir('/')
+        try:
+            self.assertEqual(self.table.containing('mnt/var/db').target,
+                             '/mnt/var')
+            self.assertEqual(self.table.containing('').target, '/')
+        finally:
+            os.chdir(cwd)
+
+    def test_containing_unmounted(self):
+        table = util.MountTable(StaticMounts([('/dev/md0', '/mnt', 'ufs')]))
+        self.assertIsNone(table.containing('usr'))
+
+class FakeLibc(object):
+    """getfsstat(2) on a list of (source, target, fstype) tuples."""
+    def __init__(self, mounts):
+        self.mounts = mounts
+
+    def __bool__(self):
+        return True
+
+    def getfsstat(self, buf, size, flags):
+        # pylint: disable=unused-argument
+        if buf is None:
+            return len(self.mounts)
+        for entry, (source, target, fstype) in zip(buf, self.mounts):
+            entry.f_mntfromname = source.encode('utf-8')
+            entry.f_mnttoname   = target.encode('utf-8')
+            entry.f_fstypename  = fstype.encode('utf-8')
+        return min(len(buf), len(self.mounts))
+
+class StatfsMountsTest(unittest.TestCase):
+    def test_remount(self):
+        """Replacing a mount is noticed although the count is the same."""
+        fake = FakeLibc([('/dev/ada0p2', '/', 'ufs'),
+                         ('/dev/ada1p1', '/mnt', 'ufs')])
+        original = util.libc
+        util.libc = fake
+        try:
+            table = util.MountTable(util.StatfsMounts())
+            self.assertEqual(table.at('/mnt').source, '/dev/ada1p1')
+            self.assertFalse(table.backend.changed())
+            fake.mounts = [('/dev/ada0p2', '/', 'ufs'),
+                           ('/dev/ada2p1', '/mnt', 'ufs')]
+            self.assertTrue(table.backend.changed())
+            self.assertEqual(table.at('/mnt').source, '/dev/ada2p1')
+        finally:
+            util.libc = original
+
+if __name__ == '__main__':
+    unittest.main()
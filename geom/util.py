@@ -1,5 +1,17 @@
 from . import platform
 from ctypes import *
+import os
+import re
+import select
+import threading
+
+def open_library(name, mode=DEFAULT_MODE, use_errno=False):
+    """Open a shared library. Returns None when it is not available (eg. on
+    non-FreeBSD systems) so that the pure python parts remain usable."""
+    try:
+        return CDLL(name, mode=mode, use_errno=use_errno)
+    except OSError:
+        return None
 
 def load_functions(lib, lst):
     def register(fn):
@@ -13,6 +25,115 @@ def load_functions(lib, lst):
     for i in lst:
         register(i)
 
+class LibraryError(Exception):
+    """Raised when using a function of a missing library, or a function
+    missing from a library."""
+    pass
+
+# all Library objects, for report()
+libraries = []
+
+class Library(object):
+    """A shared library which is only opened when it is first used, with
+    function prototypes which are only registered when the function is
+    first looked up. Evaluates to False when the library is not available,
+    so `if not lib:` replaces the old `if lib is None:` checks.
+
+    depends lists Library objects which have to be opened (globally) first,
+    eg. libzfs needs libuutil and libgeom."""
+
+    def __init__(self, name, prototypes=(), mode=DEFAULT_MODE,
+                 use_errno=False, depends=()):
+        # pylint: disable=too-many-arguments
+        self._name       = name
+        self._prototypes = dict((fn[0], fn) for fn in prototypes)
+        self._mode       = mode
+        self._use_errno  = use_errno
+        self._depends    = depends
+        self._handle     = None
+        self._opened     = False
+        self._lock       = threading.Lock()
+        libraries.append(self)
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def loaded(self):
+        """Whether the library was opened, or found to be missing."""
+        return self._opened
+
+    def handle(self):
+        """The CDLL object, opening the library if required. None if it is
+        not available. Threads using the library for the first time at
+        the same time wait for the one opening it."""
+        if not self._opened:
+            with self._lock:
+                if not self._opened:
+                    for dep in self._depends:
+                        dep.handle()
+                    self._handle = open_library(self._name, self._mode,
+                                                self._use_errno)
+                    # only now other threads may skip the lock
+                    self._opened = True
+        return self._handle
+
+    @property
+    def available(self):
+        return self.handle() is not None
+
+    def __bool__(self):
+        return self.available
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        handle = self.handle()
+        if handle is None:
+            raise LibraryError('%s is not available (needed for %s)'
+                               % (self._name, attr))
+        func = getattr(handle, attr, None)
+        if func is None:
+            raise LibraryError('failed to find function %s in %s'
+                               % (attr, self._name))
+        proto = self._prototypes.get(attr, None)
+        if proto is not None:
+            func.restype  = proto[1]
+            func.argtypes = proto[2]
+        # cache it, later lookups don't get here anymore
+        setattr(self, attr, func)
+        return func
+
+    def missing(self):
+        """The list of prototyped functions the library does not provide,
+        None if the library itself is missing. Opens the library."""
+        handle = self.handle()
+        if handle is None:
+            return None
+        return sorted(name for name in self._prototypes
+                      if getattr(handle, name, None) is None)
+
+def report():
+    """Describe the state of all known libraries: a list of (name, state)
+    tuples where state is 'not loaded', 'missing', 'ok' or lists the
+    missing functions. Libraries which were not used yet are left alone,
+    for the others the prototyped functions are looked up."""
+    result = []
+    for lib in libraries:
+        if not lib.loaded:
+            state = 'not loaded'
+        elif lib.handle() is None:
+            state = 'missing'
+        else:
+            missing = lib.missing()
+            if len(missing):
+                state = 'missing functions: %s' % ', '.join(missing)
+            else:
+                state = 'ok'
+        result.append((lib.name, state))
+    return result
+
 class Struct_statfs(Structure):
     _fields_ = [('f_version',     c_uint32),
                 ('f_type',        c_uint32),
@@ -37,22 +158,214 @@ class Struct_statfs(Structure):
                 ('f_mntfromname', c_char * platform.MNAMELEN),
                 ('f_mnttoname',   c_char * platform.MNAMELEN)]
 
+class Struct_iovec(Structure):
+    _fields_ = [('iov_base', c_void_p),
+                ('iov_len',  c_size_t)]
+
 util_functions = [
     ("getfsstat", c_int,    [POINTER(Struct_statfs), c_long, c_int]),
+    ("nmount",    c_int,    [POINTER(Struct_iovec), c_uint, c_int]),
+    ("statfs",    c_int,    [c_char_p, POINTER(Struct_statfs)]),
 ]
 
-libc = CDLL(platform.LIBC, mode=RTLD_GLOBAL)
-if libc is None:
-    raise Exception('failed to open libgeom.so.5')
-load_functions(libc, util_functions)
+libc = Library(platform.LIBC, util_functions, mode=RTLD_GLOBAL,
+               use_errno=True)
+
+def nmount(options, flags=0):
+    """Mount a file system via nmount(2). options is a list of name/value
+    pairs (eg. ('fstype', 'ufs'), ('fspath', '/mnt'), ('from', '/dev/ada0p2'))
+    where a value of None passes a flag option without value. Raises an
+    OSError on failure."""
+    if not libc:
+        raise Exception('failed to open %s' % platform.LIBC)
+    # the buffers have to stay referenced until the call returned
+    buffers = []
+    for name, value in options:
+        buffers.append(create_string_buffer(name.encode('utf-8')))
+        if value is None:
+            buffers.append(None)
+        else:
+            buffers.append(create_string_buffer(value.encode('utf-8')))
+    iov = (Struct_iovec * len(buffers))()
+    for idx, buf in enumerate(buffers):
+        if buf is not None:
+            iov[idx].iov_base = cast(buf, c_void_p)
+            iov[idx].iov_len  = sizeof(buf)
+    if libc.nmount(iov, len(buffers), flags) != 0:
+        err = get_errno()
+        raise OSError(err, os.strerror(err),
+                      dict(options).get('fspath', None))
+
+class Capacity(object):
+    """Size and free space of a file system in bytes. available is what
+    unprivileged users can still allocate (f_bavail)."""
+    # pylint: disable=too-few-public-methods
+    __slots__ = ('total', 'free', 'available')
+
+    def __init__(self, total, free, available):
+        self.total     = total
+        self.free      = free
+        self.available = available
+
+def statfs(path):
+    """Get the Capacity of the file system containing path, via statfs(2)
+    or os.statvfs where libc is not available."""
+    if not libc:
+        vfs = os.statvfs(path)
+        return Capacity(vfs.f_blocks * vfs.f_frsize,
+                        vfs.f_bfree  * vfs.f_frsize,
+                        vfs.f_bavail * vfs.f_frsize)
+    data = Struct_statfs()
+    if libc.statfs(path.encode('utf-8'), byref(data)) != 0:
+        err = get_errno()
+        raise OSError(err, os.strerror(err), path)
+    # f_bavail is signed and goes negative when the reserve is in use
+    return Capacity(data.f_blocks * data.f_bsize,
+                    data.f_bfree  * data.f_bsize,
+                    max(0, data.f_bavail) * data.f_bsize)
+
+class StatfsMounts(object):
+    """Mount table backend using getfsstat(2). Change detection compares
+    the mounted (source, target, type) entries without decoding them, so
+    an unmount followed by a mount is noticed as well."""
+
+    def __init__(self):
+        if not libc:
+            raise Exception('failed to open %s' % platform.LIBC)
+        self.data    = None
+        self.entries = None
+
+    def __fetch(self):
+        count = libc.getfsstat(None, 0, platform.MNT_NOWAIT)
+        # leave room for a few mounts appearing between the two calls
+        if self.data is None or len(self.data) < count:
+            self.data = (Struct_statfs * (count + 8))()
+        got = libc.getfsstat(self.data, sizeof(self.data),
+                             platform.MNT_NOWAIT)
+        return tuple((entry.f_mntfromname, entry.f_mnttoname,
+                      entry.f_fstypename) for entry in self.data[:got])
+
+    def changed(self):
+        return self.__fetch() != self.entries
+
+    def read(self):
+        self.entries = self.__fetch()
+        for source, target, fstype in self.entries:
+            yield (source.decode('utf-8'), target.decode('utf-8'),
+                   fstype.decode('utf-8'))
+
+def _unescape(field):
+    """mountinfo escapes blanks and backslashes as octal sequences"""
+    if '\\' not in field:
+        return field
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)),
+                  field)
+
+class MountinfoMounts(object):
+    """Mount table backend reading the Linux /proc/self/mountinfo file.
+    The kernel flags the open file with POLLPRI whenever the mount table
+    changes, so change detection does not need to read anything."""
+
+    def __init__(self, path='/proc/self/mountinfo'):
+        self.path   = path
+        self.file   = open(path, 'r', encoding='utf-8')
+        self.poll   = select.poll()
+        self.poll.register(self.file, select.POLLPRI | select.POLLERR)
+        self.loaded = False
+
+    def changed(self):
+        return not self.loaded or len(self.poll.poll(0)) != 0
+
+    def read(self):
+        self.file.seek(0)
+        lines = self.file.read().splitlines()
+        self.loaded = True
+        for line in lines:
+            fields = line.split(' ')
+            # the optional fields end with a lone '-'
+            sep = fields.index('-', 6)
+            yield (_unescape(fields[sep+2]), _unescape(fields[4]),
+                   fields[sep+1])
+
+def default_mount_backend():
+    """getfsstat(2) on FreeBSD, /proc/self/mountinfo elsewhere."""
+    if libc:
+        return StatfsMounts()
+    return MountinfoMounts()
+
+class Mount(object):
+    """A mounted file system."""
+    # pylint: disable=too-few-public-methods
+    __slots__ = ('source', 'target', 'fstype')
+
+    def __init__(self, source, target, fstype):
+        self.source = source
+        self.target = target
+        self.fstype = fstype
+
+class MountTable(object):
+    """The mounted file systems indexed by target and source device. The
+    table is only read again when the backend reports a change."""
+
+    def __init__(self, backend=None):
+        if backend is None:
+            backend = default_mount_backend()
+        self.backend   = backend
+        self.mounts    = []
+        self.by_target = {}
+        self.by_source = {}
+        self.stale     = True
+
+    def invalidate(self):
+        """Force the next query to read the table again."""
+        self.stale = True
+
+    def refresh(self):
+        """Read the table if it changed, returns self."""
+        if not self.stale and not self.backend.changed():
+            return self
+        self.mounts    = []
+        self.by_target = {}
+        self.by_source = {}
+        for source, target, fstype in self.backend.read():
+            mnt = Mount(source, target, fstype)
+            self.mounts.append(mnt)
+            # the last mount on a path hides the previous ones
+            self.by_target[target] = mnt
+            self.by_source.setdefault(source, []).append(mnt)
+        self.stale = False
+        return self
+
+    def __iter__(self):
+        return iter(self.refresh().mounts)
+
+    def __contains__(self, target):
+        return self.is_mounted(target)
+
+    def is_mounted(self, target):
+        """Whether something is mounted on a path."""
+        return target in self.refresh().by_target
+
+    def at(self, target):
+        """The Mount on a path, or None."""
+        return self.refresh().by_target.get(target, None)
+
+    def of(self, source):
+        """All the Mounts of a source device."""
+        return list(self.refresh().by_source.get(source, ()))
+
+    def containing(self, path):
+        """The Mount the file system containing path is mounted on.
+        Relative paths are taken relative to the working directory."""
+        by_target = self.refresh().by_target
+        path = os.path.abspath(path)
+        while True:
+            mnt = by_target.get(path, None)
+            parent = os.path.dirname(path)
+            if mnt is not None or parent == path:
+                return mnt
+            path = parent
 
 def genmounts():
-    count      = max(1024, libc.getfsstat(None, 0, platform.MNT_WAIT))
-    array_type = Struct_statfs * count
-    data       = array_type()
-    got        = libc.getfsstat(data, sizeof(array_type), 0)
-
-    for idx in range(0, got):
-        fromname = data[idx].f_mntfromname.decode('utf-8')
-        toname   = data[idx].f_mnttoname.decode('utf-8')
-        yield (fromname, toname)
+    for source, target, _ in StatfsMounts().read():
+        yield (source, target)
@@ -1,10 +1,14 @@
 from ctypes import *
 import atexit
+import os
+import threading
 
 if __name__ == '__main__':
     import util
+    import nvlist as nvcodec
 else:
     from . import util
+    from . import nvlist as nvcodec
 
 zhandle      = POINTER(c_void_p)
 
@@ -160,6 +164,7 @@ ZPROP_SRC_ALL  = 0x3f
 zfs_functions = [
     ("libzfs_init",          zhandle,      []),
     ("libzfs_fini",          None,         [zhandle]),
+    ("libzfs_error_description", c_char_p, [zhandle]),
 
     ("zpool_get_handle",     zhandle,      [zpool_handle]),
     ("zfs_get_handle",       zhandle,      [zfs_handle]),
@@ -168,6 +173,8 @@ zfs_functions = [
     ("zpool_close",          None,         [zpool_handle]),
     ("zpool_get_name",       c_char_p,     [zpool_handle]),
     ("zpool_free_handles",   None,         [zhandle]),
+    ("zpool_refresh_stats",  c_int,        [zpool_handle,
+                                            POINTER(boolean_t)]),
 
     ("zpool_iter",           c_int,        [zhandle, zpool_iter_f, c_void_p]),
 
@@ -189,6 +196,7 @@ zfs_functions = [
     ("zfs_iter_filesystems", c_int,        [zfs_handle, zfs_iter_f, c_void_p]),
     ("zfs_iter_snapshots",   c_int,        [zfs_handle, zfs_iter_f, c_void_p]),
     ("zfs_type_to_name",     c_char_p,     [c_int]),
+    ("zfs_get_all_props",    nvlist_p,     [zfs_handle]),
 
     ("zfs_prop_set",         c_int,        [zfs_handle, c_char_p, c_char_p]),
     ("zfs_prop_get_written", c_int,
@@ -196,18 +204,20 @@ zfs_functions = [
 ]
 
 # libzfs needs these...
-uutil = CDLL('libuutil.so.2', mode=RTLD_GLOBAL)
-geom  = CDLL('libgeom.so.5',  mode=RTLD_GLOBAL)
+uutil = util.Library('libuutil.so.2', mode=RTLD_GLOBAL)
+geom  = util.Library('libgeom.so.5',  mode=RTLD_GLOBAL)
 
-zfs = CDLL('libzfs.so.2')
-if zfs is None:
-    raise Exception('failed to open libzfs.so.2')
-util.load_functions(zfs, zfs_functions)
+# Opened on first use. False when libzfs is not available.
+zfs = util.Library('libzfs.so.2', zfs_functions, depends=(uutil, geom))
 
 nvpair_functions = [
     ("nvlist_alloc",      c_int,     [POINTER(nvlist_p), c_uint, c_int]),
     ("nvlist_free",       None,      [nvlist_p]),
     ("nvlist_size",       c_int,     [nvlist_p, POINTER(c_size_t), c_int]),
+    ("nvlist_pack",       c_int,     [nvlist_p, POINTER(c_void_p),
+                                      POINTER(c_size_t), c_int, c_int]),
+    ("nvlist_unpack",     c_int,     [c_void_p, c_size_t, POINTER(nvlist_p),
+                                      c_int]),
     ("nvlist_remove_all", c_int,     [nvlist_p, c_char_p]),
     ("nvlist_exists",     boolean_t, [nvlist_p, c_char_p]),
     ("nvlist_lookup_nvlist_array",
@@ -234,11 +244,315 @@ for k,v in [('nvpair',        nvpair_p),
         ('nvlist_lookup_%s'%k, c_int, [nvlist_p, c_char_p, POINTER(v)]),
         ])
 
-nvpair = CDLL('libnvpair.so.2')
-if nvpair is None:
-    raise Exception('failed to open libnvpair.so.2')
-util.load_functions(nvpair, nvpair_functions)
-
+nvpair = util.Library('libnvpair.so.2', nvpair_functions)
+
+
+def nvlist_to_dict(nvl, typed=False):
+    """Convert an nvlist_p into a dictionary with a single nvlist_pack()
+    call (see geom.nvlist)."""
+    size = c_size_t()
+    if nvpair.nvlist_size(nvl, byref(size), nvcodec.NV_ENCODE_NATIVE) != 0:
+        raise Exception('failed to get the nvlist size')
+    buf = create_string_buffer(size.value)
+    ptr = c_void_p(addressof(buf))
+    if nvpair.nvlist_pack(nvl, byref(ptr), byref(size),
+                          nvcodec.NV_ENCODE_NATIVE, 0) != 0:
+        raise Exception('failed to pack nvlist')
+    return nvcodec.unpack(memoryview(buf)[:size.value], typed)
+
+def dict_to_nvlist(data):
+    """Create an nvlist_p from a dictionary. The caller has to release it
+    with nvlist_free()."""
+    packed = nvcodec.pack(data)
+    buf    = create_string_buffer(packed, len(packed))
+    nvl    = nvlist_p()
+    if nvpair.nvlist_unpack(buf, len(packed), byref(nvl), 0) != 0:
+        raise Exception('failed to unpack nvlist')
+    return nvl
+
+def pool_config(pool):
+    """The configuration of a zpool handle as dictionary."""
+    config = zfs.zpool_get_config(pool, None)
+    if not bool(config):
+        return None
+    return nvlist_to_dict(config)
+
+class Session(object):
+    """A long lived libzfs handle with the handles of all imported pools.
+
+    Creating a libzfs handle opens /dev/zfs and reads the mount table, and
+    opening the pools loads their configuration, so this is done once and
+    refresh() merely updates the pool configs via zpool_refresh_stats().
+    All methods lock the session, hold the lock with a 'with' statement to
+    use the handles directly."""
+
+    def __init__(self):
+        self.lock   = threading.RLock()
+        self.handle = None
+        self.pools  = {}
+
+    def __enter__(self):
+        self.lock.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.lock.release()
+
+    def open(self):
+        """Initialize libzfs and open all pools, returns the handle."""
+        with self.lock:
+            if self.handle is None:
+                if not zfs or not nvpair:
+                    raise Exception('libzfs is not available')
+                handle = zfs.libzfs_init()
+                if not bool(handle):
+                    raise Exception('failed to initialize libzfs')
+                self.handle = handle
+                self.__scan()
+            return self.handle
+
+    def close(self):
+        """Close all pool handles and the libzfs handle."""
+        with self.lock:
+            for pool in self.pools.values():
+                zfs.zpool_close(pool)
+            self.pools = {}
+            if self.handle is not None:
+                zfs.libzfs_fini(self.handle)
+                self.handle = None
+
+    def __scan(self):
+        """Pick up newly imported pools."""
+        found = []
+        def pool_iter(pool, _):
+            found.append(pool)
+            return 0
+        zfs.zpool_iter(self.handle, zpool_iter_f(pool_iter), None)
+        for pool in found:
+            name = zfs.zpool_get_name(pool).decode('utf-8')
+            if name in self.pools:
+                zfs.zpool_close(pool)
+            else:
+                self.pools[name] = pool
+
+    def refresh(self):
+        """Update the configs of the open pools, drop the ones which are
+        gone and open newly imported ones."""
+        with self.lock:
+            if self.handle is None:
+                self.open()
+                return
+            missing = boolean_t()
+            for name, pool in list(self.pools.items()):
+                if (zfs.zpool_refresh_stats(pool, byref(missing)) != 0 or
+                    missing.value):
+                    zfs.zpool_close(pool)
+                    del self.pools[name]
+            self.__scan()
+
+    def pool_names(self):
+        with self.lock:
+            self.open()
+            return sorted(self.pools.keys())
+
+    def configs(self):
+        """The configs of all pools as dictionaries, by pool name."""
+        with self.lock:
+            self.open()
+            return dict((name, pool_config(pool))
+                        for name, pool in self.pools.items())
+
+    def datasets(self, snapshots=True):
+        """See datasets()"""
+        with self.lock:
+            return datasets(self.open(), snapshots)
+
+def create_pool(name, nvroot, props=None, fsprops=None):
+    """Create a pool with zpool_create(). nvroot is the vdev specification
+    as dictionary (eg. from ABSDInstaller.part.PoolPlan.nvroot()), props
+    and fsprops the pool and root dataset properties as dictionaries of
+    strings. Returns None or the libzfs error description."""
+    lists = []
+    try:
+        for data in (nvroot, props, fsprops):
+            lists.append(dict_to_nvlist(data) if data else None)
+        with session() as sess:
+            handle = sess.open()
+            if zfs.zpool_create(handle, name.encode('utf-8'), *lists) != 0:
+                return zfs.libzfs_error_description(handle).decode('utf-8')
+            sess.refresh()
+        return None
+    finally:
+        for nvl in lists:
+            if nvl is not None:
+                nvpair.nvlist_free(nvl)
+
+_session      = None
+_session_lock = threading.Lock()
+
+def session():
+    """The shared Session, closed at exit."""
+    global _session # pylint: disable=global-statement
+    with _session_lock:
+        if _session is None:
+            _session = Session()
+            atexit.register(_session.close)
+        return _session
+
+# libzfs rewrites the pool cache file whenever the pool configuration
+# changes.
+ZPOOL_CACHE_FILES = ['/boot/zfs/zpool.cache', '/etc/zfs/zpool.cache']
+
+def generation():
+    """Cheap check whether the pool configuration may have changed, based
+    on the modification time of the zpool.cache files."""
+    stamps = []
+    for path in ZPOOL_CACHE_FILES:
+        try:
+            stamps.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            stamps.append(None)
+    return tuple(stamps)
+
+# properties copied into Dataset objects from the cached property nvlist
+DATASET_NUMBERS = ['used', 'available', 'referenced', 'quota',
+                   'reservation', 'volsize', 'creation']
+DATASET_STRINGS = ['origin']
+CANMOUNT_VALUES = ['off', 'on', 'noauto']
+
+class Dataset(object):
+    """A dataset as listed by datasets(). Number properties missing from
+    the property list (eg. volsize of a file system) are None."""
+    # pylint: disable=too-few-public-methods
+    # pylint: disable=too-many-instance-attributes
+    __slots__ = (['name', 'type', 'parent', 'pool', 'mountpoint',
+                  'canmount'] + DATASET_NUMBERS + DATASET_STRINGS)
+
+    def __init__(self, name, type_):
+        self.name = name
+        self.type = type_
+        for sep in ('@', '/'):
+            if sep in name:
+                self.parent = name.rsplit(sep, 1)[0]
+                break
+        else:
+            self.parent = None
+        self.pool       = name.split('/', 1)[0].split('@', 1)[0]
+        self.mountpoint = None
+        self.canmount   = None
+        for prop in DATASET_NUMBERS + DATASET_STRINGS:
+            setattr(self, prop, None)
+
+def _prop_entry(props, name):
+    """Find a property's nvlist in a property list."""
+    entry = nvlist_p()
+    if nvpair.nvlist_lookup_nvlist(props, name.encode('utf-8'),
+                                   byref(entry)) != 0:
+        return None
+    return entry
+
+def _prop_number(props, name):
+    entry = _prop_entry(props, name)
+    value = c_uint64()
+    if entry is None or nvpair.nvlist_lookup_uint64(entry, b'value',
+                                                    byref(value)) != 0:
+        return None
+    return value.value
+
+def _prop_string(props, name):
+    """Returns a (value, source) tuple."""
+    entry = _prop_entry(props, name)
+    value = c_char_p()
+    source = c_char_p()
+    if entry is None or nvpair.nvlist_lookup_string(entry, b'value',
+                                                    byref(value)) != 0:
+        return (None, None)
+    if nvpair.nvlist_lookup_string(entry, b'source', byref(source)) != 0:
+        return (value.value.decode('utf-8'), None)
+    return (value.value.decode('utf-8'), source.value.decode('utf-8'))
+
+class _DatasetWalker(object):
+    """Walks all datasets of all pools using a single zfs_iter_f callback,
+    reading the properties from the property list libzfs caches in every
+    handle instead of asking for them one by one."""
+    def __init__(self, handle, snapshots):
+        self.handle    = handle
+        self.snapshots = snapshots
+        self.table     = []
+        self.error     = None
+        # the one trampoline used for every level
+        self.callback  = zfs_iter_f(self.__visit)
+
+    def run(self):
+        if zfs.zfs_iter_root(self.handle, self.callback, None) != 0:
+            if self.error is not None:
+                raise self.error
+        return self.table
+
+    def __visit(self, zhp, _):
+        try:
+            self.table.append(self.read(zhp))
+            if self.snapshots:
+                zfs.zfs_iter_children(zhp, self.callback, None)
+            else:
+                zfs.zfs_iter_filesystems(zhp, self.callback, None)
+        except Exception as err: # pylint: disable=broad-except
+            # exceptions cannot pass through the C code
+            self.error = err
+            return 1
+        finally:
+            zfs.zfs_close(zhp)
+        return 0 if self.error is None else 1
+
+    def read(self, zhp):
+        """Create the Dataset object of a handle."""
+        type_ = zfs.zfs_get_type(zhp)
+        dset  = Dataset(zfs.zfs_get_name(zhp).decode('utf-8'),
+                        zfs.zfs_type_to_name(type_).decode('utf-8'))
+        props = zfs.zfs_get_all_props(zhp)
+        if not bool(props):
+            return dset
+        for prop in DATASET_NUMBERS:
+            setattr(dset, prop, _prop_number(props, prop))
+        for prop in DATASET_STRINGS:
+            setattr(dset, prop, _prop_string(props, prop)[0])
+        if type_ == ZFS_TYPE.FILESYSTEM:
+            canmount = _prop_number(props, 'canmount')
+            dset.canmount = CANMOUNT_VALUES[1 if canmount is None
+                                            else canmount]
+            dset.mountpoint = self.mountpoint(dset, props)
+        return dset
+
+    @staticmethod
+    def mountpoint(dset, props):
+        """The property list contains the value where the mountpoint was set,
+        inherited ones get the relative path appended like zfs get does."""
+        value, source = _prop_string(props, 'mountpoint')
+        if value is None:
+            # default
+            return '/' + dset.name
+        if value in ('none', 'legacy') or source is None:
+            return value
+        if source != dset.name and dset.name.startswith(source + '/'):
+            relative = dset.name[len(source):]
+            return value.rstrip('/') + relative
+        return value
+
+def datasets(handle=None, snapshots=True):
+    """List all datasets of all imported pools as Dataset objects, parents
+    before their children. Uses the given libzfs handle or opens one."""
+    if not zfs or not nvpair:
+        raise Exception('libzfs is not available')
+    own = handle is None
+    if own:
+        handle = zfs.libzfs_init()
+        if not bool(handle):
+            raise Exception('failed to initialize libzfs')
+    try:
+        return _DatasetWalker(handle, snapshots).run()
+    finally:
+        if own:
+            zfs.libzfs_fini(handle)
 
 def main():
     ### testing this shit now...
@@ -275,12 +589,8 @@ def main():
 
     res = zfs.zpool_iter(handle, zpool_iter_f(pool_iter), None)
 
-    def fs_iter(fs, data):
-        print('%s: %s' % (zfs.zfs_get_name(fs).decode('utf-8'),
-                          zfs.zfs_type_to_name(zfs.zfs_get_type(fs))))
-        res = zfs.zfs_iter_children(fs, zfs_iter_f(fs_iter), None)
-        return 0
-    res = zfs.zfs_iter_root(handle, zfs_iter_f(fs_iter), None)
+    for dset in datasets(handle):
+        print('%s: %s %s' % (dset.name, dset.type, dset.mountpoint))
 
     zfs.libzfs_fini(handle)
 
@@ -306,5 +616,15 @@ __all__ = ['zhandle',
            'ZPROP_SRC_INHERITED',
            'ZPROP_SRC_RECEIVED',
            'ZPROP_SRC_ALL',
+           'ZPOOL_CACHE_FILES',
+           'generation',
+           'Dataset',
+           'datasets',
+           'nvlist_to_dict',
+           'dict_to_nvlist',
+           'pool_config',
+           'create_pool',
+           'Session',
+           'session',
            'zfs', 'nvpair'
            ]